@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Kino Bot benchmarklari (lokal, haqiqiy Telegram ga ulanmaydi)
+
+Ishlatish:
+    python bench_kino.py webhook [-n 200]   # polling va webhook: update -> javob kechikishi
+    python bench_kino.py caption [-n 200000] # yetkazishdagi caption qurish narxi: eski va yangi
+    python bench_kino.py memory [--sizes 100000 1000000]  # foydalanuvchi yozuvlari xotirasi: dict va UserRecord
+    python bench_kino.py search [--titles 100000]  # kino nomi qidiruvi: trigramma indeksi va to'liq skan
+
+Talablar: kino_bot2.py bilan bir xil (.env dagi BOT_TOKEN kerak, tarmoq kerak emas).
+"""
+
+import argparse
+import asyncio
+import gc
+import html
+import json
+import statistics
+import time
+import tracemalloc
+from typing import Dict, List
+
+from aiohttp import ClientSession, web
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.enums import ParseMode
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+
+import kino_bot2 as kb
+
+
+def _report(title: str, samples: List[float]):
+    ms = sorted(x * 1000 for x in samples)
+    p95 = ms[min(len(ms) - 1, int(len(ms) * 0.95))]
+    print(f"{title:<10} n={len(ms):<5} o'rtacha={statistics.mean(ms):7.2f} ms  "
+          f"p50={statistics.median(ms):7.2f} ms  p95={p95:7.2f} ms  max={ms[-1]:7.2f} ms")
+
+
+# ====== FAKE BOT API ======
+class FakeBotAPI:
+    """Bot API ning minimal lokal o'rnini bosuvchi: getUpdates (long polling), sendMessage va boshqalar."""
+
+    def __init__(self):
+        self.updates: asyncio.Queue = asyncio.Queue()
+        self.replies: Dict[int, asyncio.Future] = {}
+        self.polling = asyncio.Event()
+        self._msg_id = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method == "getUpdates":
+            self.polling.set()
+            result = []
+            try:
+                timeout = float(params.get("timeout", 10))
+                result.append(await asyncio.wait_for(self.updates.get(), timeout=timeout))
+                while not self.updates.empty():
+                    result.append(self.updates.get_nowait())
+            except asyncio.TimeoutError:
+                pass
+        elif method == "sendMessage":
+            chat_id = int(params["chat_id"])
+            self._msg_id += 1
+            result = {"message_id": self._msg_id, "date": int(time.time()),
+                      "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")}
+            fut = self.replies.pop(chat_id, None)
+            if fut is not None and not fut.done():
+                fut.set_result(time.perf_counter())
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    def expect_reply(self, chat_id: int) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        self.replies[chat_id] = fut
+        return fut
+
+
+def _update(i: int) -> dict:
+    # Har bir update alohida chatdan: chat bo'yicha limit o'lchovga aralashmasin
+    chat_id = 10_000 + i
+    return {
+        "update_id": i,
+        "message": {
+            "message_id": i, "date": int(time.time()), "text": "📚 Yordam",
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "bench"},
+        },
+    }
+
+
+async def _serve(app: web.Application, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+def _bench_bot(api_port: int) -> Bot:
+    session = AiohttpSession(api=TelegramAPIServer.from_base(f"http://127.0.0.1:{api_port}"))
+    # OutboundScheduler ulanmaydi: u 30 xabar/s limit bilan transport farqini yashirib qo'yadi
+    return Bot(kb.BOT_TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+
+
+async def bench_webhook(n: int, api_port: int = 18081, hook_port: int = 18082):
+    fake = FakeBotAPI()
+    api_runner = await _serve(fake.app(), api_port)
+    bench_bot = _bench_bot(api_port)
+    try:
+        # --- polling ---
+        polling = asyncio.create_task(kb.dp.start_polling(
+            bench_bot, handle_signals=False, close_bot_session=False, polling_timeout=10,
+            allowed_updates=kb.dp.resolve_used_update_types()))
+        await asyncio.wait_for(fake.polling.wait(), timeout=10)
+        poll_lat = []
+        for i in range(n):
+            upd = _update(i)
+            fut = fake.expect_reply(upd["message"]["chat"]["id"])
+            t0 = time.perf_counter()
+            await fake.updates.put(upd)
+            poll_lat.append(await asyncio.wait_for(fut, timeout=10) - t0)
+        await kb.dp.stop_polling()
+        await polling
+
+        # --- webhook ---
+        secret = "bench-secret"
+        app = web.Application()
+        SimpleRequestHandler(dispatcher=kb.dp, bot=bench_bot, secret_token=secret,
+                             handle_in_background=True).register(app, path="/webhook")
+        hook_runner = await _serve(app, hook_port)
+        hook_lat = []
+        url = f"http://127.0.0.1:{hook_port}/webhook"
+        headers = {"X-Telegram-Bot-Api-Secret-Token": secret, "Content-Type": "application/json"}
+        async with ClientSession() as http:
+            async with http.post(url, data=json.dumps(_update(10**6)), headers={"Content-Type": "application/json"}) as r:
+                assert r.status == 401, f"secret tekshiruvi ishlamadi: {r.status}"
+            for i in range(n, 2 * n):
+                upd = _update(i)
+                fut = fake.expect_reply(upd["message"]["chat"]["id"])
+                t0 = time.perf_counter()
+                async with http.post(url, data=json.dumps(upd), headers=headers) as r:
+                    assert r.status == 200, r.status
+                hook_lat.append(await asyncio.wait_for(fut, timeout=10) - t0)
+        await hook_runner.cleanup()
+
+        print(f"update -> javob kechikishi (lokal fake Bot API, {n} ta update):")
+        _report("polling", poll_lat)
+        _report("webhook", hook_lat)
+    finally:
+        await bench_bot.session.close()
+        await api_runner.cleanup()
+
+
+# ====== CAPTION ======
+def _legacy_combined_caption(rec: dict, code: str, uid: int) -> str:
+    """Oldingi build_combined_caption (har chaqiruvda 9 maydon escape + URL qurish) — solishtirish uchun."""
+    def full_caption(name, year, genre, duration, code, country="-", imdb="-", quality="-", language="-"):
+        s_name = html.escape(name or "-")
+        s_year = html.escape(year or "-")
+        s_genre = html.escape(genre or "-")
+        s_country = html.escape(country or "-")
+        s_imdb = html.escape(imdb or "-")
+        s_quality = html.escape(quality or "-")
+        s_language = html.escape(language or "-")
+        channel_url = f"https://t.me/{kb.PREVIEW_CHANNEL_ID.lstrip('@')}"
+        bot_url = f"https://t.me/{kb.Bot_url.lstrip('@')}"
+        return (
+            f"🎬: &quot;{s_name}&quot; [{s_year}]\n"
+            f"➖➖➖➖➖➖➖➖➖➖\n"
+            f"• 🌍Davlati: {s_country} \n"
+            f"• 🌟IMBD: {s_imdb} \n"
+            f"• 🎭Janri: {s_genre}\n"
+            f"• 📸Sifat: {s_quality}\n"
+            f"• 🇺🇿Tili: {s_language}\n\n"
+            f"🔢 Kino kodi: <code>{html.escape(code)}</code>\n\n"
+            f"🔹Kanal: <a href=\"{channel_url}\">©️KinolarOlami</a>\n"
+        )
+
+    top = full_caption(
+        name=rec.get("name", "Kino"), year=rec.get("year", "-"), genre=rec.get("genre", "-"),
+        duration=rec.get("duration", "-"), code=code, country=rec.get("country", "-"),
+        imdb=rec.get("imdb", "-"), quality=rec.get("quality", "-"), language=rec.get("language", "-"),
+    ).rstrip()
+    stats = rec.get("stats", {})
+    views = stats.get("views", 0)
+    avg = kb._avg_rating(rec)
+    ur = int(stats.get("ratings", {}).get("users", {}).get(str(uid), 0))
+    stars = "".join("⭐" for _ in range(int(round(avg)))) or "-"
+    return top + (
+        f"\n\n📊 Statistika\n"
+        f"👁️ Ko'rishlar: {views}\n"
+        f"⭐ O'rtacha: {avg} {stars}\n"
+        f"👤 Sizning baho: {ur if ur else 0}/5"
+    )
+
+
+def bench_caption(n: int, movies: int = 1000):
+    # Xotiradagi sintetik katalog (diskka yozilmaydi)
+    recs = {}
+    for i in range(movies):
+        code = str(100 + i)
+        recs[code] = {
+            "name": f"Kino <{i}> & \"qism\"", "year": "2024", "genre": "Drama, Tarix", "country": "O'zbekiston",
+            "imdb": "7.4", "quality": "1080p", "language": "O'zbekcha", "duration": "1h50m",
+            "stats": {"views": i, "likes": {"users": [], "count": 0},
+                      "ratings": {"users": {"1": 4}, "sum": (1 + i % 10) * (1 + i % 5), "count": 1 + i % 10}},
+        }
+    kb.db.movies.update(recs)
+    for code in recs:
+        kb.db.ratings.set(code, 1, 4)
+    codes = list(recs)
+    # Oddiy yetkazish oqimi: mashhur kinolar ko'p so'raladi (keshga ~hamma sig'adi)
+    picks = [codes[int(len(codes) * (j * 0.6180339887 % 1) ** 2)] for j in range(n)]
+    for code in codes:
+        assert kb.build_combined_caption(recs[code], code, 1) == _legacy_combined_caption(recs[code], code, 1), code
+
+    results = {}
+    for title, fn in (("eski", _legacy_combined_caption), ("yangi", kb.build_combined_caption)):
+        t0 = time.perf_counter()
+        for j, code in enumerate(picks):
+            fn(recs[code], code, j)
+        results[title] = (time.perf_counter() - t0) / n
+    print(f"build_combined_caption, {n} ta yetkazish, {movies} ta kino:")
+    for title, per in results.items():
+        print(f"{title:<10} {per * 1e6:7.2f} µs/yetkazish")
+    print(f"tezlashish: x{results['eski'] / results['yangi']:.1f}  "
+          f"(kesh: {kb.captions.hits} hit / {kb.captions.misses} miss)")
+
+
+# ====== MEMORY ======
+def _synthetic_user(i: int, rnd) -> dict:
+    # Oddiy taqsimot: ~30% da sevimlilar (1-5), ~20% da random tarixi (5-20)
+    fav = [str(rnd.randrange(10, 1000)) for _ in range(rnd.randint(1, 5))] if rnd.random() < 0.3 else []
+    hist = [str(rnd.randrange(10, 1000)) for _ in range(rnd.randint(5, 20))] if rnd.random() < 0.2 else []
+    return {
+        "name": f"Foydalanuvchi {i}",
+        "phone": f"+99890{rnd.randrange(10**7):07d}",
+        "is_admin": False,
+        "role": "user",
+        "fav": sorted(set(fav), key=int),  # UserRecord sevimlilarni raqam tartibida saqlaydi
+        "rand_hist": list(dict.fromkeys(hist)),
+    }
+
+
+def _measure(build) -> tuple:
+    gc.collect()
+    tracemalloc.start()
+    obj = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return obj, size
+
+
+def bench_memory(sizes: List[int]):
+    import random
+    print("foydalanuvchi yozuvlari xotirasi (tracemalloc, DB.users lug'ati bilan birga):")
+    for n in sizes:
+        rnd = random.Random(n)
+        # JSON dan o'qilgandek: har bir satr alohida obyekt (json.loads kabi)
+        raw = json.dumps({str(i): _synthetic_user(i, rnd) for i in range(n)})
+        dicts, dict_bytes = _measure(lambda: {int(k): v for k, v in json.loads(raw).items()})
+        del dicts
+        def build_records():
+            users = {int(k): v for k, v in json.loads(raw).items()}
+            for uid, u in users.items():
+                users[uid] = kb.UserRecord.from_dict(u)
+            return users
+        records, rec_bytes = _measure(build_records)
+        # Yo'qotishsiz: JSON ga qaytarilganda aynan bir xil
+        assert json.dumps({str(k): dict(v) for k, v in records.items()}) == raw
+        del records, raw
+        print(f"{n:>9} ta  dict: {dict_bytes / n:7.1f} B/foyd ({dict_bytes / 2**20:7.1f} MiB)  "
+              f"UserRecord: {rec_bytes / n:7.1f} B/foyd ({rec_bytes / 2**20:7.1f} MiB)  "
+              f"x{dict_bytes / rec_bytes:.2f}")
+
+
+# ====== SEARCH ======
+_WORDS_LAT = ["qasoskorlar", "yulduzlar", "urushi", "avatar", "suv", "yo'li", "sehrgar", "qirol", "sher", "tun",
+              "shahar", "o'g'ri", "muhabbat", "qaytish", "dengiz", "qaroqchilari", "temir", "odam", "tez",
+              "g'azablangan", "sayyora", "maymunlar", "jang", "oxirgi", "samuray", "kosmos", "sirli", "orol"]
+_WORDS_CYR = ["Қасоскорлар", "Юлдузлар", "уруши", "Аватар", "сув", "йўли", "Сеҳргар", "қирол", "шер", "тун",
+              "шаҳар", "ўғри", "муҳаббат", "қайтиш", "денгиз"]
+
+
+def _typo(word: str, rnd) -> str:
+    # Bitta tasodifiy xato: harf tushib qolishi, almashishi yoki ortiqcha harf
+    i = rnd.randrange(len(word))
+    kind = rnd.randrange(3)
+    if kind == 0 and len(word) > 3:
+        return word[:i] + word[i + 1:]
+    if kind == 1:
+        return word[:i] + rnd.choice("aeiouklmnrst") + word[i + 1:]
+    return word[:i] + word[i] + word[i:]
+
+
+def bench_search(titles: int, queries: int = 500):
+    import random
+    rnd = random.Random(titles)
+    # Lug'at: tanish so'zlar + bo'g'inlardan yasalgan so'zlar (haqiqiy katalogdagi kabi xilma-xil)
+    syll = [c + v for c in "bdfghjklmnpqrstvxyz" for v in "aeiou"] + ["sh", "ch", "ng", "o'", "g'"]
+    vocab = _WORDS_LAT + ["".join(rnd.choices(syll, k=rnd.randint(2, 4))) for _ in range(20_000)]
+    names = {}
+    for i in range(titles):
+        words = _WORDS_CYR if rnd.random() < 0.05 else vocab
+        names[str(10_000 + i)] = " ".join(rnd.sample(words, rnd.randint(1, 4))).capitalize() + f" {rnd.randint(1, 9)}"
+    index = kb.TitleIndex()
+    t0 = time.perf_counter()
+    for code, name in names.items():
+        index.add(code, name)
+    build = time.perf_counter() - t0
+    print(f"{titles} ta nom, indeks qurish: {build:.2f} s ({len(index.postings)} trigramma)")
+
+    # So'rovlar: mavjud nomdagi 1-2 so'z, yarmida xato, ba'zilari boshqa alifboda
+    codes = list(names)
+    qs = []
+    for _ in range(queries):
+        code = rnd.choice(codes)
+        words = names[code].split()[:-1]
+        q = " ".join(words[:rnd.randint(1, 2)])
+        if rnd.random() < 0.5:
+            q = _typo(q, rnd)
+        qs.append(q)
+    samples = []
+    found = 0
+    for q in qs:
+        t0 = time.perf_counter()
+        res = index.search(q, limit=8)
+        samples.append(time.perf_counter() - t0)
+        found += bool(res)
+    _report("trigramma", samples)
+    print(f"natija topildi: {found}/{len(qs)}")
+
+    # Solishtirish: indekssiz — har so'rovda barcha (oldindan normalizatsiya qilingan) nomlar bilan o'xshashlik
+    norm = {code: kb.title_trigrams(kb.normalize_title(n)) for code, n in names.items()}
+    samples = []
+    for q in qs[:20]:
+        t0 = time.perf_counter()
+        g = kb.title_trigrams(kb.normalize_title(q))
+        sorted(norm, key=lambda c: -len(g & norm[c]))[:8]
+        samples.append(time.perf_counter() - t0)
+    _report("skan", samples)
+    for q in ("avatr", "Аватар сув йули", "yulduzlar urshi", "qaroqchilar dengz"):
+        print(f"  {q!r:<22} -> {[names[c] for c in index.search(q, limit=3)]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Kino Bot benchmarklari")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("webhook", help="polling va webhook kechikishini solishtirish")
+    p.add_argument("-n", type=int, default=200)
+    p = sub.add_parser("caption", help="caption qurish narxi: eski va keshlangan shablon")
+    p.add_argument("-n", type=int, default=200_000)
+    p = sub.add_parser("memory", help="foydalanuvchi yozuvlari xotirasi: dict va UserRecord")
+    p.add_argument("--sizes", type=int, nargs="+", default=[100_000, 1_000_000])
+    p = sub.add_parser("search", help="kino nomi qidiruvi: trigramma indeksi va to'liq skan")
+    p.add_argument("--titles", type=int, default=100_000)
+    args = parser.parse_args()
+    if args.cmd == "webhook":
+        asyncio.run(bench_webhook(args.n))
+    elif args.cmd == "caption":
+        bench_caption(args.n)
+    elif args.cmd == "memory":
+        bench_memory(args.sizes)
+    elif args.cmd == "search":
+        bench_search(args.titles)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 """
 Kino Bot (Disk-first minimal version)
-- Admin video/document yuboradi -> bot 'kinolar/' papkaga saqlaydi -> kanalga shablon bilan post qiladi -> faylni lokal diskdan o'chiradi
+- Admin video/document yuboradi -> bot uni file_id bo'yicha (yuklab olmasdan) kanalga shablon bilan post qiladi
 - Bazaga (movies.json) faqat: name, code, channel_message_id saqlanadi
 - Foydalanuvchi kod yuborsa -> bot kanalidagi shu xabarni copy qilib userga yuboradi (fayl qayta yuklanmaydi)
 
@@ -12,27 +12,42 @@ Talablar:
 """
 
 import asyncio
+import bisect
+import contextvars
+import heapq
 import json
 import logging
 import os
 import random
-import string
 import re
+import secrets
+import sqlite3
+import sys
+import threading
 import time
+from array import array
+from collections import Counter, OrderedDict, deque
+from collections.abc import MutableMapping
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Mapping, Optional, Tuple
 import html
 
-from aiogram import Bot, Dispatcher, F, types
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, types
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
-from aiogram.filters import BaseFilter, Command
+from aiogram.filters import BaseFilter, Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.fsm.storage.base import StorageKey
-from aiogram.types import FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.types import FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton, URLInputFile
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 
 try:
     from dotenv import load_dotenv
@@ -58,46 +73,517 @@ try:
     SUPER_ADMIN_ID = int(_super_env) if _super_env.strip() else (ADMIN_IDS[0] if ADMIN_IDS else None)
 except Exception:
     SUPER_ADMIN_ID = (ADMIN_IDS[0] if ADMIN_IDS else None)
+# Ixtiyoriy: fon tekshiruvlari uchun yopiq "qoralama" chat/kanal (bot admin bo'lishi kerak)
+SCRATCH_CHAT_ID = os.getenv("SCRATCH_CHAT_ID", "").strip()
 if not BOT_TOKEN or not ADMIN_PHONES:
     raise RuntimeError(".env da BOT_TOKEN, ADMIN_PHONES to'ldiring. Kanal ID lar uchun FULL_CHANNEL_ID va PREVIEW_CHANNEL_ID ni ham kiriting.")
 
 BASE_DIR = Path(__file__).parent
-KINOLAR_DIR = BASE_DIR / "kinolar"
-KINOLAR_DIR.mkdir(parents=True, exist_ok=True)
+# Ixtiyoriy: o'z Bot API serverimiz (telegram-bot-api). --local rejimida BOT_API_LOCAL=1: fayllar
+# 2 GB gacha va serverdagi disk yo'li orqali uzatiladi
+BOT_API_URL = os.getenv("BOT_API_URL", "").strip().rstrip("/")
+BOT_API_LOCAL = os.getenv("BOT_API_LOCAL", "0").strip().lower() in {"1", "true", "yes"}
 
-bot = Bot(BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher(storage=MemoryStorage())
+# ====== FSM STORAGE ======
+# FSM holatlari: sqlite (standart, restartdan keyin ham saqlanadi) yoki memory
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite").strip().lower()
+FSM_DB_PATH = Path(os.getenv("FSM_DB_PATH", "") or (BASE_DIR / "fsm.db"))
+# Shuncha vaqt tegilmagan holat (masalan, tashlab ketilgan yuklash) o'chiriladi
+FSM_TTL = float(os.getenv("FSM_TTL", str(7 * 24 * 3600)) or 7 * 24 * 3600)
+FSM_SWEEP_INTERVAL = float(os.getenv("FSM_SWEEP_INTERVAL", "600") or 600)
 
-# ====== DB ======
-class DB:
-    def __init__(self, base: Path):
+
+class SqliteFSMStorage(BaseStorage):
+    """SQLite asosidagi aiogram FSM storage.
+
+    Har bir kalit (bot, chat, user, ...) bitta qator; har yozuvda muddati FSM_TTL ga
+    uzaytiriladi. Muddati o'tgan qatorlar o'qishda e'tiborga olinmaydi va fon sweeper
+    tomonidan o'chiriladi. Xotirada hech narsa saqlanmaydi; WAL rejimi tufayli bir
+    nechta worker jarayoni bitta faylni birga ishlata oladi.
+
+    Dispatcher har polling to'xtaganda close() ni chaqiradi; ulanish keyingi murojaatda qayta ochiladi,
+    shuning uchun bitta dispatcher qayta ishga tushirilishi (polling -> webhook) mumkin.
+    """
+
+    def __init__(self, path: Path, ttl: float = FSM_TTL):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.ttl = ttl
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._conn: Optional[sqlite3.Connection] = None
+        self._sweeper: Optional[asyncio.Task] = None
+        self.conn  # sxema darhol yaratiladi (xato bo'lsa ishga tushishda ko'rinadi)
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(str(self.path), timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS fsm ("
+                " key TEXT PRIMARY KEY, state TEXT, data TEXT NOT NULL DEFAULT '{}', expires REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS fsm_expires ON fsm (expires)")
+            self._conn = conn
+        return self._conn
+
+    def _row(self, key: StorageKey) -> Optional[Tuple[Optional[str], str]]:
+        row = self.conn.execute("SELECT state, data, expires FROM fsm WHERE key=?",
+                                (self.key_builder.build(key),)).fetchone()
+        if row is None or row[2] < time.time():
+            return None
+        return row[0], row[1]
+
+    def _write(self, key: StorageKey, state: Optional[str], data: str):
+        k = self.key_builder.build(key)
+        if state is None and data == "{}":
+            # Bo'sh holat — qatorni saqlab o'tirmaymiz
+            self.conn.execute("DELETE FROM fsm WHERE key=?", (k,))
+            return
+        self.conn.execute(
+            "INSERT INTO fsm (key, state, data, expires) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET state=excluded.state, data=excluded.data, expires=excluded.expires",
+            (k, state, data, time.time() + self.ttl),
+        )
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        row = self._row(key)
+        self._write(key, value, row[1] if row else "{}")
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        row = self._row(key)
+        return row[0] if row else None
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        row = self._row(key)
+        self._write(key, row[0] if row else None, json.dumps(dict(data), ensure_ascii=False))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        row = self._row(key)
+        return json.loads(row[1]) if row else {}
+
+    def sweep(self) -> int:
+        cur = self.conn.execute("DELETE FROM fsm WHERE expires < ?", (time.time(),))
+        return cur.rowcount
+
+    async def _sweep_loop(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                n = self.sweep()
+                if n:
+                    logging.info(f"fsm: {n} ta eskirgan holat o'chirildi")
+            except Exception as e:
+                logging.warning(f"fsm sweep xatosi: {e}")
+
+    def start_sweeper(self, interval: float = FSM_SWEEP_INTERVAL):
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(self._sweep_loop(interval))
+
+    async def close(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+def make_fsm_storage() -> BaseStorage:
+    if FSM_STORAGE == "memory":
+        return MemoryStorage()
+    return SqliteFSMStorage(FSM_DB_PATH)
+
+
+def make_bot_session() -> Optional[AiohttpSession]:
+    if not BOT_API_URL:
+        return None
+    return AiohttpSession(api=TelegramAPIServer.from_base(BOT_API_URL, is_local=BOT_API_LOCAL))
+
+
+bot = Bot(BOT_TOKEN, session=make_bot_session(), default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+dp = Dispatcher(storage=make_fsm_storage())
+
+# ====== OUTBOUND SCHEDULER ======
+# Telegram limitlari: ~30 xabar/s umumiy, ~1 xabar/s bitta chatga (qisqa burst ruxsat)
+OUT_GLOBAL_RATE = float(os.getenv("OUT_GLOBAL_RATE", "30") or 30)
+OUT_CHAT_RATE = float(os.getenv("OUT_CHAT_RATE", "1") or 1)
+OUT_CHAT_BURST = float(os.getenv("OUT_CHAT_BURST", "3") or 3)
+OUT_MAX_RETRIES = int(os.getenv("OUT_MAX_RETRIES", "3") or 3)
+
+# Ustuvorlik: kichik son = birinchi
+PRIORITY_CALLBACK = 0    # answerCallbackQuery / answerInlineQuery
+PRIORITY_DELIVERY = 1    # kino va javob xabarlari
+PRIORITY_EDIT = 2        # statistika/caption tahrirlari
+PRIORITY_BACKGROUND = 3  # fon ishlari (tekshiruv, tarqatish)
+PRIORITY_NAMES = {0: "callback", 1: "delivery", 2: "edit", 3: "background"}
+
+# Fon vazifalari o'z so'rovlarini past ustuvorlikda yuborishi uchun
+outbound_priority: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("outbound_priority", default=None)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Bitta token bo'lishigacha qancha kutish kerak (0 = hozir)."""
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity and self.blocked_until <= now
+
+
+class OutboundScheduler:
+    """Chiquvchi Telegram so'rovlari uchun markaziy navbat.
+
+    Har bir so'rov umumiy va chat bo'yicha token bucket dan ruxsat oladi; ruxsat
+    ustuvorlik tartibida (callback > yetkazish > tahrir > fon) beriladi.
+    TelegramRetryAfter kelsa, tegishli bucket retry_after soniyaga to'xtatiladi.
+    """
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: float):
+        self.global_bucket = TokenBucket(global_rate, max(global_rate, 1))
+        self.chat_rate = chat_rate
+        self.chat_burst = max(chat_burst, 1)
+        self.chats: Dict[Any, TokenBucket] = {}
+        self._heap: list = []
+        self._seq = 0
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.max_depth = 0
+        self.retry_after_hits = 0
+        self.waits: Dict[int, list] = {p: [0, 0.0, 0.0] for p in PRIORITY_NAMES}  # soni, jami, max
+
+    @staticmethod
+    def is_limited(api_method: str) -> bool:
+        # Faqat xabar yuboradigan/o'zgartiradigan metodlar limitlanadi (getUpdates, getChatMember, ... emas)
+        return api_method.startswith(("send", "copy", "forward", "edit", "answer", "delete")) \
+            and api_method not in {"deleteWebhook"}
+
+    @staticmethod
+    def priority_for(api_method: str) -> int:
+        override = outbound_priority.get()
+        if override is not None:
+            return override
+        if api_method.startswith("answer"):
+            return PRIORITY_CALLBACK
+        if api_method.startswith("edit"):
+            return PRIORITY_EDIT
+        return PRIORITY_DELIVERY
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        b = self.chats.get(chat_id)
+        if b is None:
+            if len(self.chats) > 10000:
+                now = time.monotonic()
+                self.chats = {k: v for k, v in self.chats.items() if not v.idle(now)}
+            b = self.chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return b
+
+    async def acquire(self, priority: int, chat_id=None):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done():
+            self._wake = asyncio.Event()
+            self._task = loop.create_task(self._pump())
+        fut = loop.create_future()
+        self._seq += 1
+        enq = time.monotonic()
+        heapq.heappush(self._heap, (priority, self._seq, chat_id, fut))
+        self.max_depth = max(self.max_depth, len(self._heap))
+        self._wake.set()
+        await fut
+        w = self.waits[priority]
+        waited = time.monotonic() - enq
+        w[0] += 1
+        w[1] += waited
+        w[2] = max(w[2], waited)
+
+    async def _pump(self):
+        while True:
+            if not self._heap:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            now = time.monotonic()
+            chosen = None
+            min_delay = float("inf")
+            for item in sorted(self._heap):
+                if item[3].done():  # bekor qilingan so'rov
+                    continue
+                d = self._chat_bucket(item[2]).delay(now) if item[2] is not None else 0.0
+                if d <= 0:
+                    chosen = item
+                    break
+                min_delay = min(min_delay, d)
+            self._heap = [it for it in self._heap if not it[3].done()]
+            heapq.heapify(self._heap)
+            if chosen is None:
+                if self._heap:
+                    await self._sleep(min_delay)
+                continue
+            gd = self.global_bucket.delay(now)
+            if gd > 0:
+                await self._sleep(gd)
+                continue
+            self.global_bucket.take(now)
+            if chosen[2] is not None:
+                self._chat_bucket(chosen[2]).take(now)
+            self._heap.remove(chosen)
+            heapq.heapify(self._heap)
+            chosen[3].set_result(None)
+
+    async def _sleep(self, delay: float):
+        # Yangi (ustuvorroq) so'rov kelsa uyg'onamiz
+        self._wake.clear()
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout=max(delay, 0.001))
+        except asyncio.TimeoutError:
+            pass
+
+    def penalize(self, chat_id, retry_after: float):
+        self.retry_after_hits += 1
+        bucket = self._chat_bucket(chat_id) if chat_id is not None else self.global_bucket
+        bucket.blocked_until = max(bucket.blocked_until, time.monotonic() + retry_after)
+
+    def metrics_lines(self):
+        lines = [
+            "📤 Chiquvchi navbat:",
+            f"• navbatda: {len(self._heap)} (max {self.max_depth}) | 429: {self.retry_after_hits}",
+        ]
+        for p, (n, total, mx) in self.waits.items():
+            if n:
+                lines.append(f"• {PRIORITY_NAMES[p]}: {n} ta, o'rtacha kutish {total / n * 1000:.0f} ms, max {mx * 1000:.0f} ms")
+        return lines
+
+
+class OutboundMiddleware(BaseRequestMiddleware):
+    """Bot sessiyasidagi har bir so'rovni OutboundScheduler orqali o'tkazadi."""
+
+    def __init__(self, scheduler: OutboundScheduler, max_retries: int = OUT_MAX_RETRIES):
+        self.scheduler = scheduler
+        self.max_retries = max_retries
+
+    async def __call__(self, make_request, bot: Bot, method):
+        name = method.__api_method__
+        if not self.scheduler.is_limited(name):
+            return await make_request(bot, method)
+        priority = self.scheduler.priority_for(name)
+        chat_id = getattr(method, "chat_id", None)
+        for attempt in range(self.max_retries + 1):
+            await self.scheduler.acquire(priority, chat_id)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                logging.warning(f"{name}: flood control, {e.retry_after}s kutamiz (chat={chat_id})")
+                self.scheduler.penalize(chat_id, e.retry_after)
+                if attempt >= self.max_retries:
+                    raise
+
+
+outbound = OutboundScheduler(OUT_GLOBAL_RATE, OUT_CHAT_RATE, OUT_CHAT_BURST)
+bot.session.middleware(OutboundMiddleware(outbound))
+
+# ====== STORAGE ======
+# Saqlash backendi .env dagi DB_BACKEND orqali tanlanadi: json (standart) yoki sqlite
+DB_BACKEND = os.getenv("DB_BACKEND", "json").strip().lower()
+SQLITE_PATH = Path(os.getenv("SQLITE_PATH", "") or (BASE_DIR / "kino.db"))
+# journal backend: snapshot (users.json/movies.json) + o'zgarishlar jurnali (JSONL)
+JOURNAL_PATH = Path(os.getenv("JOURNAL_PATH", "") or (BASE_DIR / "db_journal.jsonl"))
+JOURNAL_COMPACT_BYTES = int(os.getenv("JOURNAL_COMPACT_BYTES", str(4 * 1024 * 1024)) or 4 * 1024 * 1024)
+# JSON write-behind: o'zgarishlar yig'ilib, eng ko'pi N ms da yoki M ta o'zgarishdan keyin bir marta yoziladi
+JSON_FLUSH_INTERVAL_MS = int(os.getenv("JSON_FLUSH_INTERVAL_MS", "500") or 500)
+JSON_FLUSH_MAX_MUTATIONS = int(os.getenv("JSON_FLUSH_MAX_MUTATIONS", "100") or 100)
+# Yangi kod uchun bron muddati (soniya): yuklash shu vaqtda tugamasa kod qayta bo'shaydi
+CODE_RESERVE_TTL = int(os.getenv("CODE_RESERVE_TTL", "86400") or 86400)
+
+# Ma'lumotlar sxemasi versiyasi: JSON fayllarda shu kalit ostida, SQLite da PRAGMA user_version
+SCHEMA_KEY = "__schema__"
+
+MOVIE_META_FIELDS = ("name", "year", "genre", "country", "imdb", "quality", "language", "duration")
+MOVIE_FIELDS = MOVIE_META_FIELDS + ("full_message_id", "preview_message_id", "broken")
+
+
+class Storage:
+    """Saqlash backendlari uchun umumiy interfeys.
+
+    DB xotiradagi users/movies lug'atlari bilan ishlaydi, backend esa har bir
+    o'zgarishni diskka yozadi. Nozik amallar (inc_view, set_rating, ...) standart
+    holatda butun yozuvni saqlaydi; backend ularni qatorma-qator yangilashi mumkin.
+    schema_version load() dan keyin diskdagi ma'lumotlar versiyasini bildiradi.
+    """
+
+    schema_version = 0
+
+    def load(self) -> Tuple[Dict[int, Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+        raise NotImplementedError
+
+    def save_user(self, uid: int, rec: Dict[str, Any]):
+        raise NotImplementedError
+
+    def save_movie(self, code: str, rec: Dict[str, Any]):
+        raise NotImplementedError
+
+    def save_all_users(self, users: Dict[int, Dict[str, Any]]):
+        raise NotImplementedError
+
+    def save_all_movies(self, movies: Dict[str, Dict[str, Any]]):
+        raise NotImplementedError
+
+    def save_movies(self, movies: Mapping[str, Dict[str, Any]]):
+        """Bir nechta yangi/o'zgargan kinoni bitta yozuv sifatida saqlaydi (ommaviy qo'shish)."""
+        for code, rec in movies.items():
+            self.save_movie(code, rec)
+
+    def inc_view(self, code: str, rec: Dict[str, Any]):
+        self.save_movie(code, rec)
+
+    def set_rating(self, code: str, uid: int, rating: int, rec: Dict[str, Any]):
+        self.save_movie(code, rec)
+
+    def set_favorite(self, uid: int, code: str, on: bool, rec: Dict[str, Any]):
+        self.save_user(uid, rec)
+
+    def set_random_history(self, uid: int, rec: Dict[str, Any]):
+        self.save_user(uid, rec)
+
+    def set_random_histories(self, users: Mapping[int, Dict[str, Any]]):
+        """Bir nechta foydalanuvchi random tarixini bitta yozuvda saqlaydi."""
+        for uid, rec in users.items():
+            self.set_random_history(uid, rec)
+
+    def set_schema_version(self, version: int):
+        """Migratsiyadan keyin yangi sxema versiyasini diskka yozadi."""
+        raise NotImplementedError
+
+    # Baholar kino yozuvidan alohida saqlanadi (DB.ratings — RatingStore)
+    def load_ratings(self) -> Dict[str, Dict[int, int]]:
+        """load() dan keyin chaqiriladi: {code: {uid: baho}}."""
+        return {}
+
+    def bind_ratings(self, store: "RatingStore"):
+        """DB ning RatingStore obyekti (to'liq yozuvlar uchun manba)."""
+
+    def save_all_ratings(self, store: "RatingStore"):
+        raise NotImplementedError
+
+    def reserve_code(self, code: str) -> bool:
+        """Yangi kino kodini band qiladi. Baza bir nechta jarayon orasida umumiy bo'lsa atomar
+        tekshiradi; False — kod boshqa jarayonda band yoki allaqachon ishlatilgan."""
+        return True
+
+    def release_code(self, code: str):
+        """Ishlatilmay qolgan band kodni bo'shatadi."""
+
+    async def start(self):
+        """Event loop ishga tushganda chaqiriladi (fon vazifalar uchun)."""
+
+    def flush(self):
+        """Kutilayotgan o'zgarishlarni diskka yozadi."""
+
+    def close(self):
+        pass
+
+
+class JsonStorage(Storage):
+    """users.json / movies.json / ratings.json fayllari.
+
+    ratings.json ustunli: {code: [[uid, ...], [baho, ...]]}.
+
+    start() chaqirilgunga qadar har bir o'zgarish darhol yoziladi. start() dan keyin
+    write-behind rejimi: o'zgarishlar faqat 'dirty' deb belgilanadi va fon vazifa ularni
+    flush_interval_ms da yoki max_mutations ta o'zgarishdan keyin bitta yozuvga jamlaydi.
+    """
+
+    def __init__(self, base: Path, flush_interval_ms: int = JSON_FLUSH_INTERVAL_MS,
+                 max_mutations: int = JSON_FLUSH_MAX_MUTATIONS):
         self.users_p = base / "users.json"
         self.movies_p = base / "movies.json"
+        self.ratings_p = base / "ratings.json"
+        self._ratings_raw: Dict[str, Dict[int, int]] = {}
+        self.ratings_store: Optional["RatingStore"] = None
         self.users: Dict[int, Dict[str, Any]] = {}
         self.movies: Dict[str, Dict[str, Any]] = {}
-        self.load()
+        self.flush_interval = max(flush_interval_ms, 1) / 1000
+        self.max_mutations = max(max_mutations, 1)
+        self._dirty: set = set()
+        self._pending = 0
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
 
     def load(self):
-        self.users = self._load(self.users_p, key_cast=int)
-        self.movies = self._load(self.movies_p, key_cast=None)
+        self.users, users_ver = self._load(self.users_p, key_cast=int)
+        self.movies, movies_ver = self._load(self.movies_p, key_cast=None)
+        self.schema_version = min(users_ver, movies_ver)
+        cols, _ = self._load(self.ratings_p, key_cast=None)
+        self._ratings_raw = {code: dict(zip(map(int, uids), vals)) for code, (uids, vals) in cols.items()}
+        self.ratings_store = None
+        return self.users, self.movies
 
-    def _load(self, path: Path, key_cast=None):
+    def load_ratings(self):
+        return self._ratings_raw
+
+    def bind_ratings(self, store: "RatingStore"):
+        self.ratings_store = store
+        self._ratings_raw = {}
+
+    def _load(self, path: Path, key_cast=None) -> Tuple[Dict[Any, Any], int]:
+        """(ma'lumotlar, sxema versiyasi). Versiya kaliti bo'lmagan eski fayllar — 0."""
         if not path.exists():
-            return {}
+            return {}, 0
         try:
             data = json.loads(path.read_text(encoding="utf-8"))
+            version = int(data.pop(SCHEMA_KEY, 0))
             if key_cast:
-                return {key_cast(k): v for k, v in data.items()}
-            return data
+                return {key_cast(k): v for k, v in data.items()}, version
+            return data, version
         except Exception as e:
             logging.error(f"JSON load error for {path}: {e}\
             {path.read_text(encoding='utf-8') if path.exists() else ''}")
-            return {}
+            return {}, 0
 
     def _save(self, path: Path, data: Dict[str, Any]):
+        self._write(path, json.dumps(data, ensure_ascii=False, indent=2))
+
+    def _users_doc(self) -> Dict[str, Any]:
+        return {SCHEMA_KEY: self.schema_version, **{str(k): dict(v) for k, v in self.users.items()}}
+
+    def _movies_doc(self) -> Dict[str, Any]:
+        return {SCHEMA_KEY: self.schema_version, **self.movies}
+
+    def _ratings_doc(self) -> Dict[str, Any]:
+        if self.ratings_store is not None:
+            cols = {code: [uids.tolist(), vals.tolist()] for code, uids, vals in self.ratings_store.items()}
+        else:
+            cols = {code: [list(m), list(m.values())] for code, m in self._ratings_raw.items()}
+        return {SCHEMA_KEY: self.schema_version, **cols}
+
+    @staticmethod
+    def _write(path: Path, text: str):
         path.parent.mkdir(parents=True, exist_ok=True)
         tmp = path.with_suffix(path.suffix + ".tmp")
-        tmp.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+        tmp.write_text(text, encoding="utf-8")
         # Atomic replace with retries to survive Windows file locks
         for attempt in range(5):
             try:
@@ -109,7 +595,7 @@ class DB:
         # Fallback: direct write to the target file
         try:
             with open(path, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+                f.write(text)
             # Cleanup tmp if possible
             try:
                 tmp.unlink(missing_ok=True)
@@ -118,399 +604,3054 @@ class DB:
         except Exception as e2:
             logging.error(f"save: fallback direct write failed for {path.name}. Temp left at {tmp}: {e2}")
 
-    def save_users(self):
-        self._save(self.users_p, {str(k): v for k, v in self.users.items()})
+    def save_user(self, uid: int, rec: Dict[str, Any]):
+        self._mark("users")
 
-    def save_movies(self):
-        self._save(self.movies_p, self.movies)
+    def save_movie(self, code: str, rec: Dict[str, Any]):
+        self._mark("movies")
 
-    @staticmethod
-    def norm_phone(phone: str) -> str:
-        t = phone.strip().replace(" ", "").replace("-", "").replace("(", "").replace(")", "")
-        if t.startswith("00"): t = "+" + t[2:]
-        if not t.startswith("+") and t.isdigit():
-            t = "+" + t
-        return t
+    def save_movies(self, movies: Mapping[str, Dict[str, Any]]):
+        self._mark("movies")
 
-    def is_admin_phone(self, phone: str) -> bool:
-        p = self.norm_phone(phone)
-        return p in [self.norm_phone(a) for a in ADMIN_PHONES]
+    def save_all_users(self, users: Dict[int, Dict[str, Any]]):
+        self.users = users
+        self._mark("users")
 
-    def is_admin_id(self, uid: int) -> bool:
-        return uid in ADMIN_IDS
+    def save_all_movies(self, movies: Dict[str, Dict[str, Any]]):
+        self.movies = movies
+        self._mark("movies")
 
-    def upsert_user(self, uid: int, name: str, phone: str, is_admin: bool):
-        # Mavjud foydalanuvchining sevimlilarini saqlab qolamiz
-        existing = self.users.get(uid, {})
-        fav = existing.get("fav", [])
-        rand_hist = existing.get("rand_hist", [])
-        role = existing.get("role")
-        # Agar rol hali belgilanmagan bo'lsa, is_admin True bo'lsa 'admin', aks holda 'user'
-        if not role:
-            role = "admin" if is_admin else "user"
-        self.users[uid] = {
-            "name": name,
-            "phone": self.norm_phone(phone),
-            "is_admin": is_admin,
-            "role": role,
-            "fav": fav,
-            "rand_hist": rand_hist,
-        }
-        self.save_users()
+    def set_rating(self, code: str, uid: int, rating: int, rec: Dict[str, Any]):
+        self._mark("movies")
+        self._mark("ratings")
 
-    def get_user(self, uid: int) -> Optional[Dict[str, Any]]:
-        u = self.users.get(uid)
-        if u is not None:
-            changed = False
-            if "fav" not in u:
-                u["fav"] = []
-                changed = True
-            if "rand_hist" not in u:
-                u["rand_hist"] = []
-                changed = True
-            # Backward compat: rol maydonini to'ldiramiz
-            if "role" not in u:
-                u["role"] = "admin" if u.get("is_admin") else "user"
-                changed = True
-            if changed:
-                self.users[uid] = u
-                self.save_users()
-        return u
+    def save_all_ratings(self, store: "RatingStore"):
+        self.bind_ratings(store)
+        self._mark("ratings")
 
-    def is_admin(self, uid: int) -> bool:
-        u = self.get_user(uid)
-        if not u:
-            return False
-        role = u.get("role")
-        return bool(u.get("is_admin") or role in {"admin", "super_admin"})
+    def set_schema_version(self, version: int):
+        self.schema_version = version
+        self._mark("users")
+        self._mark("movies")
+        self._mark("ratings")
 
-    def is_super_admin(self, uid: int) -> bool:
-        # Rolga ko'ra yoki konfiguratsiyadagi SUPER_ADMIN_ID ga ko'ra
-        if SUPER_ADMIN_ID is not None and uid == SUPER_ADMIN_ID:
-            return True
-        u = self.get_user(uid)
-        return bool(u and u.get("role") == "super_admin")
+    # ---- write-behind ----
+    def _mark(self, kind: str):
+        self._dirty.add(kind)
+        if self._task is None:
+            # Fon vazifa yo'q (masalan, CLI/migratsiya) — darhol yozamiz
+            self.flush()
+            return
+        self._pending += 1
+        if self._pending >= self.max_mutations:
+            self._wake.set()
 
-    def set_role(self, uid: int, role: str):
-        u = self.get_user(uid) or {"name": "?", "phone": "", "fav": [], "rand_hist": []}
-        u["role"] = role
-        u["is_admin"] = True if role in {"admin", "super_admin"} else False
-        self.users[uid] = u
-        self.save_users()
+    def flush(self):
+        dirty, self._dirty = self._dirty, set()
+        self._pending = 0
+        for kind in dirty:
+            try:
+                if kind == "users":
+                    self._save(self.users_p, self._users_doc())
+                elif kind == "ratings":
+                    # Ustunli fayl — ixcham yoziladi (indent raqamlar ro'yxatini qatorlarga yoyib yuboradi)
+                    self._write(self.ratings_p, json.dumps(self._ratings_doc(), separators=(",", ":")))
+                else:
+                    self._save(self.movies_p, self._movies_doc())
+            except Exception as e:
+                logging.error(f"flush: {kind} yozilmadi, keyingi safar qayta urinamiz: {e}")
+                self._dirty.add(kind)
 
-    def add_movie(self, code: str, info: Dict[str, Any]):
-        # Default statistik maydonlarni qo'shib saqlaymiz
-        info = dict(info)
-        stats = info.get("stats", {}) or {}
-        stats.setdefault("views", 0)
-        stats.setdefault("likes", {"users": [], "count": 0})
-        stats.setdefault("ratings", {"users": {}, "sum": 0, "count": 0})
-        info["stats"] = stats
-        # Yaroqsizlik flagi
-        if "broken" not in info:
-            info["broken"] = False
-        self.movies[code] = info
-        self.save_movies()
+    async def start(self):
+        if self._task is not None:
+            return
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._flusher())
 
-    def get_movie(self, code: str) -> Optional[Dict[str, Any]]:
-        return self.movies.get(code)
+    async def _flusher(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            if self._dirty:
+                self.flush()
 
-    def mark_broken(self, code: str):
-        rec = self.movies.get(code)
-        if not rec:
-            return
-        if not rec.get("broken"):
-            rec["broken"] = True
-            self.movies[code] = rec
-            self.save_movies()
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.flush()
 
-    # ==== Movie statistika amallari ====
-    def inc_view(self, code: str):
-        rec = self.get_movie(code)
-        if not rec:
-            return
-        rec.setdefault("stats", {}).setdefault("views", 0)
-        rec["stats"]["views"] += 1
-        self.add_movie(code, rec)
 
-    def toggle_like(self, code: str, uid: int) -> bool:
-        """Like yoqadi/yopadi. True=like qo'shildi, False=olib tashlandi"""
-        rec = self.get_movie(code)
-        if not rec:
-            return False
-        stats = rec.setdefault("stats", {})
-        likes = stats.setdefault("likes", {"users": [], "count": 0})
-        users = set(likes.get("users", []))
-        if uid in users:
-            users.remove(uid)
-            action_added = False
+class JournalStorage(JsonStorage):
+    """Snapshot + append-only jurnal.
+
+    Har bir o'zgarish jurnalga bitta JSON qator bo'lib qo'shiladi (O(1)). Yozuvlar
+    idempotent: ular o'zgargan maydonning yangi qiymatini saqlaydi, shuning uchun
+    jurnalni snapshot ustiga qayta o'ynatish (hatto ikki marta) xavfsiz.
+    Jurnal compact_bytes dan oshsa, u .1 ga aylantiriladi, fon rejimida yangi snapshot
+    yoziladi va .1 o'chiriladi.
+    """
+
+    def __init__(self, base: Path, journal_path: Path = JOURNAL_PATH,
+                 compact_bytes: int = JOURNAL_COMPACT_BYTES):
+        super().__init__(base)
+        self.journal_p = journal_path
+        self.rotated_p = journal_path.with_suffix(journal_path.suffix + ".1")
+        self.compact_bytes = max(compact_bytes, 1)
+        self._fh = None
+        self._size = 0
+        self._background = False
+        self._compacting: Optional[asyncio.Task] = None
+        # Fon va sinxron snapshot yozuvlari bir-birini bosib ketmasligi uchun
+        self._snap_lock = threading.Lock()
+        self._snap_gen = 0
+
+    # ---- load / replay ----
+    def load(self):
+        super().load()
+        replayed = 0
+        for path in (self.rotated_p, self.journal_p):
+            replayed += self._replay(path)
+        if replayed or self.rotated_p.exists():
+            # Qayta o'ynatilgan holatni yangi snapshotga yozib, jurnalni bo'shatamiz
+            self._compact_sync()
+        self._open()
+        return self.users, self.movies
+
+    def _replay(self, path: Path) -> int:
+        if not path.exists():
+            return 0
+        n = 0
+        good = 0
+        torn = False
+        with open(path, "rb") as f:
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    # Oxirgi qator yarim yozilgan (crash paytida) — uni kesib tashlaymiz
+                    torn = True
+                    break
+                try:
+                    self._apply(json.loads(raw))
+                    n += 1
+                except Exception as e:
+                    logging.error(f"journal: {path.name} dagi qator o'tkazib yuborildi: {e}")
+                good += len(raw)
+        if torn:
+            logging.warning(f"journal: {path.name} oxirgi qatori buzilgan, {good}-baytdan kesildi")
+            with open(path, "r+b") as w:
+                w.truncate(good)
+        return n
+
+    def _apply(self, op: Dict[str, Any]):
+        t = op.get("t")
+        if t == "user":
+            self.users[int(op["uid"])] = op["rec"]
+        elif t == "movie":
+            self.movies[op["code"]] = op["rec"]
+        elif t == "view":
+            rec = self.movies.get(op["code"])
+            if rec is not None:
+                rec.setdefault("stats", {})["views"] = op["n"]
+        elif t == "rate":
+            rec = self.movies.get(op["code"])
+            if rec is not None:
+                self._ratings_raw.setdefault(op["code"], {})[int(op["uid"])] = op["r"]
+                ratings = rec.setdefault("stats", {}).setdefault("ratings", {"sum": 0, "count": 0})
+                ratings["sum"], ratings["count"] = op["sum"], op["count"]
+        elif t == "fav":
+            u = self.users.get(int(op["uid"]))
+            if u is not None:
+                favs = u.setdefault("fav", [])
+                if op["on"] and op["code"] not in favs:
+                    favs.append(op["code"])
+                elif not op["on"] and op["code"] in favs:
+                    favs.remove(op["code"])
+        elif t == "rhist":
+            u = self.users.get(int(op["uid"]))
+            if u is not None:
+                u["rand_hist"] = list(op["h"])
         else:
-            users.add(uid)
-            action_added = True
-        likes["users"] = list(users)
-        likes["count"] = len(users)
-        stats["likes"] = likes
-        rec["stats"] = stats
-        self.add_movie(code, rec)
-        return action_added
+            raise ValueError(f"unknown op {t!r}")
 
-    def rate_movie(self, code: str, uid: int, rating: int):
-        """Foydalanuvchi bahosini qo'yadi (1..5). Avvalgi bahosi bo'lsa yangilanadi."""
-        rating = max(1, min(5, int(rating)))
-        rec = self.get_movie(code)
-        if not rec:
+    # ---- append ----
+    def _open(self):
+        self.journal_p.parent.mkdir(parents=True, exist_ok=True)
+        self._fh = open(self.journal_p, "ab")
+        self._size = self._fh.tell()
+
+    def _append(self, op: Dict[str, Any]):
+        self._append_many([op])
+
+    def _append_many(self, ops):
+        # Bir nechta amal bitta write + flush bilan (ommaviy qo'shish uchun)
+        if self._fh is None:
+            self._open()
+        data = b"".join(json.dumps(op, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+                        for op in ops)
+        self._fh.write(data)
+        self._fh.flush()
+        self._size += len(data)
+        if self._size >= self.compact_bytes:
+            self._maybe_compact()
+
+    def save_user(self, uid: int, rec: Dict[str, Any]):
+        self._append({"t": "user", "uid": uid, "rec": dict(rec)})
+
+    def save_movie(self, code: str, rec: Dict[str, Any]):
+        self._append({"t": "movie", "code": code, "rec": rec})
+
+    def save_movies(self, movies: Mapping[str, Dict[str, Any]]):
+        self._append_many([{"t": "movie", "code": code, "rec": rec} for code, rec in movies.items()])
+
+    def inc_view(self, code: str, rec: Dict[str, Any]):
+        self._append({"t": "view", "code": code, "n": rec["stats"]["views"]})
+
+    def set_favorite(self, uid: int, code: str, on: bool, rec: Dict[str, Any]):
+        self._append({"t": "fav", "uid": uid, "code": code, "on": on})
+
+    def set_random_history(self, uid: int, rec: Dict[str, Any]):
+        self._append({"t": "rhist", "uid": uid, "h": rec.get("rand_hist", [])})
+
+    def set_random_histories(self, users: Mapping[int, Dict[str, Any]]):
+        self._append_many([{"t": "rhist", "uid": uid, "h": rec.get("rand_hist", [])} for uid, rec in users.items()])
+
+    def save_all_users(self, users: Dict[int, Dict[str, Any]]):
+        self.users = users
+        self._compact_sync()
+
+    def save_all_movies(self, movies: Dict[str, Dict[str, Any]]):
+        self.movies = movies
+        self._compact_sync()
+
+    def set_rating(self, code: str, uid: int, rating: int, rec: Dict[str, Any]):
+        ratings = rec["stats"]["ratings"]
+        self._append({"t": "rate", "code": code, "uid": uid, "r": rating,
+                      "sum": ratings["sum"], "count": ratings["count"]})
+
+    def save_all_ratings(self, store: "RatingStore"):
+        self.bind_ratings(store)
+        self._compact_sync()
+
+    def set_schema_version(self, version: int):
+        self.schema_version = version
+        self._compact_sync()
+
+    # ---- compaction ----
+    def _snapshot_blobs(self) -> Tuple[str, str, str]:
+        return (
+            json.dumps(self._users_doc(), ensure_ascii=False, indent=2),
+            json.dumps(self._movies_doc(), ensure_ascii=False, indent=2),
+            json.dumps(self._ratings_doc(), separators=(",", ":")),
+        )
+
+    def _rotate(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        if self.journal_p.exists():
+            self.journal_p.replace(self.rotated_p)
+        self._open()
+
+    def _write_blobs(self, blobs: Tuple[str, str, str]):
+        for path, blob in zip((self.users_p, self.movies_p, self.ratings_p), blobs):
+            self._write(path, blob)
+
+    def _write_snapshot(self, gen: int, blobs: Tuple[str, str, str]):
+        with self._snap_lock:
+            if gen != self._snap_gen:
+                return  # undan yangiroq snapshot allaqachon yozilgan
+            self._write_blobs(blobs)
+            self.rotated_p.unlink(missing_ok=True)
+
+    def _compact_sync(self):
+        blobs = self._snapshot_blobs()
+        with self._snap_lock:
+            self._snap_gen += 1
+            self._write_blobs(blobs)
+            # Snapshot to'liq holatni o'z ichiga oladi — ikkala jurnal ham keraksiz
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+            self.rotated_p.unlink(missing_ok=True)
+            self.journal_p.unlink(missing_ok=True)
+        self._open()
+
+    def _maybe_compact(self):
+        if not self._background:
+            self._compact_sync()
             return
-        stats = rec.setdefault("stats", {})
-        ratings = stats.setdefault("ratings", {"users": {}, "sum": 0, "count": 0})
-        users = ratings.setdefault("users", {})
-        old = users.get(str(uid))
-        if old is None:
-            ratings["sum"] += rating
-            ratings["count"] += 1
-        else:
-            ratings["sum"] += rating - int(old)
-        users[str(uid)] = rating
-        stats["ratings"] = ratings
-        rec["stats"] = stats
-        self.add_movie(code, rec)
+        if self._compacting is not None and not self._compacting.done():
+            return
+        if self.rotated_p.exists():
+            # Oldingi compaction tugamagan (.1 hali bor) — uni ustiga yozmaymiz
+            self._compact_sync()
+            return
+        # Aylantirish va snapshot matni bir vaqtda (loop ichida) olinadi — .1 aynan shu holatgacha
+        self._rotate()
+        blobs = self._snapshot_blobs()
+        self._snap_gen += 1
+        self._compacting = asyncio.create_task(self._compact_bg(self._snap_gen, blobs))
 
-    # ==== Favorites (Sevimlilar) ====
-    def toggle_favorite(self, uid: int, code: str) -> bool:
-        """Foydalanuvchining sevimlilariga qo'shadi yoki o'chiradi. True=qo'shildi, False=o'chirildi"""
-        u = self.get_user(uid)
-        if not u:
-            return False
-        favs = set(u.get("fav", []))
-        if code in favs:
-            favs.remove(code)
-            added = False
+    async def _compact_bg(self, gen: int, blobs: Tuple[str, str, str]):
+        try:
+            await asyncio.to_thread(self._write_snapshot, gen, blobs)
+            logging.info("journal: snapshot yangilandi, jurnal siqildi")
+        except Exception as e:
+            logging.error(f"journal: compaction xatosi (.1 keyingi yuklashda qayta o'ynatiladi): {e}")
+
+    async def start(self):
+        self._background = True
+
+    def flush(self):
+        if self._fh is not None:
+            self._fh.flush()
+
+    def close(self):
+        self._background = False
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+
+class SqliteStorage(Storage):
+    """SQLite (WAL) backend: har bir amal faqat tegishli qatorlarni yangilaydi."""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (
+        uid INTEGER PRIMARY KEY,
+        name TEXT, phone TEXT, is_admin INTEGER NOT NULL DEFAULT 0, role TEXT,
+        extra TEXT
+    );
+    CREATE TABLE IF NOT EXISTS movies (
+        code TEXT PRIMARY KEY,
+        name TEXT, year TEXT, genre TEXT, country TEXT, imdb TEXT, quality TEXT,
+        language TEXT, duration TEXT,
+        full_message_id INTEGER, preview_message_id INTEGER,
+        broken INTEGER NOT NULL DEFAULT 0,
+        extra TEXT
+    );
+    CREATE TABLE IF NOT EXISTS stats (
+        code TEXT PRIMARY KEY,
+        views INTEGER NOT NULL DEFAULT 0,
+        likes TEXT NOT NULL DEFAULT '[]',
+        rating_sum INTEGER NOT NULL DEFAULT 0,
+        rating_count INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS favorites (
+        uid INTEGER NOT NULL, code TEXT NOT NULL,
+        PRIMARY KEY (uid, code)
+    );
+    CREATE TABLE IF NOT EXISTS ratings (
+        code TEXT NOT NULL, uid INTEGER NOT NULL, rating INTEGER NOT NULL,
+        PRIMARY KEY (code, uid)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS random_history (
+        uid INTEGER NOT NULL, pos INTEGER NOT NULL, code TEXT NOT NULL,
+        PRIMARY KEY (uid, pos)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS code_reservations (
+        code TEXT PRIMARY KEY, ts REAL NOT NULL
+    ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(str(path), timeout=30, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA foreign_keys=OFF")
+        self.conn.executescript(self.SCHEMA)
+
+    @contextmanager
+    def _tx(self):
+        # isolation_level=None: tranzaksiyani qo'lda boshqaramiz (BEGIN IMMEDIATE -> yozuvchi qulfi)
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.conn
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
         else:
-            favs.add(code)
-            added = True
-        u["fav"] = list(favs)
-        self.users[uid] = u
-        self.save_users()
-        return added
+            self.conn.execute("COMMIT")
 
-    def get_favorites(self, uid: int):
-        u = self.get_user(uid) or {}
-        return list(u.get("fav", []))
+    # ---- load ----
+    def load(self):
+        c = self.conn
+        self.schema_version = c.execute("PRAGMA user_version").fetchone()[0]
+        users: Dict[int, Dict[str, Any]] = {}
+        for uid, name, phone, is_admin, role, extra in c.execute(
+                "SELECT uid, name, phone, is_admin, role, extra FROM users"):
+            rec = json.loads(extra) if extra else {}
+            rec.update({"name": name, "phone": phone, "is_admin": bool(is_admin), "fav": [], "rand_hist": []})
+            if role is not None:
+                rec["role"] = role
+            users[uid] = rec
+        for uid, code in c.execute("SELECT uid, code FROM favorites ORDER BY rowid"):
+            if uid in users:
+                users[uid]["fav"].append(code)
+        for uid, code in c.execute("SELECT uid, code FROM random_history ORDER BY uid, pos"):
+            if uid in users:
+                users[uid]["rand_hist"].append(code)
 
-    # ==== Random history per user ====
-    def get_random_history(self, uid: int):
-        u = self.get_user(uid) or {}
-        return list(u.get("rand_hist", []))
+        movies: Dict[str, Dict[str, Any]] = {}
+        cols = ", ".join(MOVIE_FIELDS)
+        for row in c.execute(f"SELECT code, {cols}, extra FROM movies"):
+            code, values, extra = row[0], row[1:-1], row[-1]
+            rec = json.loads(extra) if extra else {}
+            for k, v in zip(MOVIE_FIELDS, values):
+                if v is not None:
+                    rec[k] = v
+            rec["broken"] = bool(rec.get("broken"))
+            rec["stats"] = {
+                "views": 0,
+                "likes": {"users": [], "count": 0},
+                "ratings": {"sum": 0, "count": 0},
+            }
+            movies[code] = rec
+        for code, views, likes, rsum, rcount in c.execute(
+                "SELECT code, views, likes, rating_sum, rating_count FROM stats"):
+            rec = movies.get(code)
+            if rec is None:
+                continue
+            lk = json.loads(likes or "[]")
+            rec["stats"]["views"] = views
+            rec["stats"]["likes"] = {"users": lk, "count": len(lk)}
+            rec["stats"]["ratings"]["sum"] = rsum
+            rec["stats"]["ratings"]["count"] = rcount
+        return users, movies
 
-    def push_random_history(self, uid: int, code: str, max_len: int = 20):
-        u = self.get_user(uid)
-        if not u:
+    def load_ratings(self):
+        ratings: Dict[str, Dict[int, int]] = {}
+        for code, uid, rating in self.conn.execute("SELECT code, uid, rating FROM ratings"):
+            ratings.setdefault(code, {})[uid] = rating
+        return ratings
+
+    # ---- users ----
+    def _put_user_row(self, c, uid: int, rec: Dict[str, Any]):
+        extra = {k: v for k, v in rec.items() if k not in {"name", "phone", "is_admin", "role", "fav", "rand_hist"}}
+        c.execute(
+            "INSERT INTO users (uid, name, phone, is_admin, role, extra) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(uid) DO UPDATE SET name=excluded.name, phone=excluded.phone, "
+            "is_admin=excluded.is_admin, role=excluded.role, extra=excluded.extra",
+            (uid, rec.get("name"), rec.get("phone"), int(bool(rec.get("is_admin"))), rec.get("role"),
+             json.dumps(extra, ensure_ascii=False) if extra else None),
+        )
+
+    def _put_favorites(self, c, uid: int, favs):
+        c.execute("DELETE FROM favorites WHERE uid=?", (uid,))
+        c.executemany("INSERT OR IGNORE INTO favorites (uid, code) VALUES (?, ?)", [(uid, code) for code in favs])
+
+    def _put_random_history(self, c, uid: int, hist):
+        c.execute("DELETE FROM random_history WHERE uid=?", (uid,))
+        c.executemany("INSERT INTO random_history (uid, pos, code) VALUES (?, ?, ?)",
+                      [(uid, i, code) for i, code in enumerate(hist)])
+
+    def save_user(self, uid: int, rec: Dict[str, Any]):
+        with self._tx() as c:
+            self._put_user_row(c, uid, rec)
+            self._put_favorites(c, uid, rec.get("fav", []))
+            self._put_random_history(c, uid, rec.get("rand_hist", []))
+
+    def save_all_users(self, users: Dict[int, Dict[str, Any]]):
+        with self._tx() as c:
+            for uid, rec in users.items():
+                self._put_user_row(c, uid, rec)
+                self._put_favorites(c, uid, rec.get("fav", []))
+                self._put_random_history(c, uid, rec.get("rand_hist", []))
+
+    def set_favorite(self, uid: int, code: str, on: bool, rec: Dict[str, Any]):
+        with self._tx() as c:
+            if on:
+                c.execute("INSERT OR IGNORE INTO favorites (uid, code) VALUES (?, ?)", (uid, code))
+            else:
+                c.execute("DELETE FROM favorites WHERE uid=? AND code=?", (uid, code))
+
+    def set_random_history(self, uid: int, rec: Dict[str, Any]):
+        with self._tx() as c:
+            self._put_random_history(c, uid, rec.get("rand_hist", []))
+
+    def set_random_histories(self, users: Mapping[int, Dict[str, Any]]):
+        with self._tx() as c:
+            for uid, rec in users.items():
+                self._put_random_history(c, uid, rec.get("rand_hist", []))
+
+    # ---- movies ----
+    def _put_movie_row(self, c, code: str, rec: Dict[str, Any]):
+        extra = {k: v for k, v in rec.items() if k not in MOVIE_FIELDS and k != "stats"}
+        values = [rec.get(k) for k in MOVIE_FIELDS]
+        values[MOVIE_FIELDS.index("broken")] = int(bool(rec.get("broken")))
+        cols = ", ".join(MOVIE_FIELDS)
+        marks = ", ".join("?" for _ in MOVIE_FIELDS)
+        updates = ", ".join(f"{k}=excluded.{k}" for k in MOVIE_FIELDS)
+        c.execute(
+            f"INSERT INTO movies (code, {cols}, extra) VALUES (?, {marks}, ?) "
+            f"ON CONFLICT(code) DO UPDATE SET {updates}, extra=excluded.extra",
+            (code, *values, json.dumps(extra, ensure_ascii=False) if extra else None),
+        )
+
+    def _put_stats_row(self, c, code: str, rec: Dict[str, Any]):
+        stats = rec.get("stats", {}) or {}
+        likes = (stats.get("likes") or {}).get("users", [])
+        ratings = stats.get("ratings") or {}
+        c.execute(
+            "INSERT INTO stats (code, views, likes, rating_sum, rating_count) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(code) DO UPDATE SET views=excluded.views, likes=excluded.likes, "
+            "rating_sum=excluded.rating_sum, rating_count=excluded.rating_count",
+            (code, int(stats.get("views", 0)), json.dumps(likes), int(ratings.get("sum", 0)), int(ratings.get("count", 0))),
+        )
+
+    def save_movie(self, code: str, rec: Dict[str, Any]):
+        # Baholar faqat set_rating orqali o'zgaradi, shu sababli bu yerda ratings jadvaliga tegmaymiz
+        with self._tx() as c:
+            self._put_movie_row(c, code, rec)
+            self._put_stats_row(c, code, rec)
+
+    def save_all_movies(self, movies: Dict[str, Dict[str, Any]]):
+        self.save_movies(movies)
+
+    def save_movies(self, movies: Mapping[str, Dict[str, Any]]):
+        with self._tx() as c:
+            for code, rec in movies.items():
+                self._put_movie_row(c, code, rec)
+                self._put_stats_row(c, code, rec)
+
+    def save_all_ratings(self, store: "RatingStore"):
+        with self._tx() as c:
+            c.execute("DELETE FROM ratings")
+            for code, uids, vals in store.items():
+                c.executemany("INSERT INTO ratings (code, uid, rating) VALUES (?, ?, ?)",
+                              [(code, uid, r) for uid, r in zip(uids, vals)])
+
+    def inc_view(self, code: str, rec: Dict[str, Any]):
+        with self._tx() as c:
+            c.execute("UPDATE stats SET views=? WHERE code=?", (int(rec["stats"]["views"]), code))
+
+    def set_rating(self, code: str, uid: int, rating: int, rec: Dict[str, Any]):
+        ratings = rec["stats"]["ratings"]
+        with self._tx() as c:
+            c.execute("INSERT OR REPLACE INTO ratings (code, uid, rating) VALUES (?, ?, ?)", (code, uid, rating))
+            c.execute("UPDATE stats SET rating_sum=?, rating_count=? WHERE code=?",
+                      (int(ratings["sum"]), int(ratings["count"]), code))
+
+    def set_schema_version(self, version: int):
+        self.conn.execute(f"PRAGMA user_version = {int(version)}")
+        self.schema_version = version
+
+    def reserve_code(self, code: str) -> bool:
+        # Bir nechta jarayon bitta kino.db bilan ishlasa: band qilish BEGIN IMMEDIATE ichida atomar.
+        # Eski bronlar (yuklash yarim yo'lda uzilgan) CODE_RESERVE_TTL dan keyin o'chadi.
+        now = time.time()
+        with self._tx() as c:
+            c.execute("DELETE FROM code_reservations WHERE ts < ?", (now - CODE_RESERVE_TTL,))
+            if c.execute("SELECT 1 FROM movies WHERE code=?", (code,)).fetchone():
+                return False
+            cur = c.execute("INSERT OR IGNORE INTO code_reservations (code, ts) VALUES (?, ?)", (code, now))
+            return cur.rowcount == 1
+
+    def release_code(self, code: str):
+        with self._tx() as c:
+            c.execute("DELETE FROM code_reservations WHERE code=?", (code,))
+
+    def close(self):
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+
+
+def make_storage(base: Path) -> Storage:
+    if DB_BACKEND == "sqlite":
+        return SqliteStorage(SQLITE_PATH)
+    if DB_BACKEND == "journal":
+        return JournalStorage(base)
+    if DB_BACKEND != "json":
+        logging.warning(f"Noma'lum DB_BACKEND={DB_BACKEND!r}, json ishlatiladi")
+    return JsonStorage(base)
+
+
+def migrate_json_to_sqlite(base: Path, sqlite_path: Path) -> Tuple[int, int]:
+    """users.json/movies.json/ratings.json ni bir martada SQLite bazaga ko'chiradi. (users, movies) sonini qaytaradi."""
+    # JSON avval joriy sxemaga migratsiya qilinadi (DB.load), keyin ko'chiriladi
+    src = DB(base, storage=JsonStorage(base))
+    dst = SqliteStorage(sqlite_path)
+    try:
+        dst.save_all_users(src.users)
+        dst.save_all_movies(src.movies)
+        dst.save_all_ratings(src.ratings)
+        dst.set_schema_version(SCHEMA_VERSION)
+    finally:
+        dst.close()
+    return len(src.users), len(src.movies)
+
+
+# ====== DB ======
+# ---- Sxema migratsiyalari ----
+# Har bir migratsiya barcha yozuvlarni bir marta, DB.load ichida yangilaydi. Shundan keyin
+# o'qish amallari (get_user va h.k.) hech narsani o'zgartirmaydi va diskka yozmaydi.
+def _user_defaults(u: Dict[str, Any]) -> Dict[str, Any]:
+    u.setdefault("fav", [])
+    u.setdefault("rand_hist", [])
+    # Backward compat: rol maydonini to'ldiramiz
+    if not u.get("role"):
+        u["role"] = "admin" if u.get("is_admin") else "user"
+    return u
+
+
+def _movie_defaults(rec: Dict[str, Any]) -> Dict[str, Any]:
+    stats = rec.get("stats") or {}
+    stats.setdefault("views", 0)
+    stats.setdefault("likes", {"users": [], "count": 0})
+    stats.setdefault("ratings", {"sum": 0, "count": 0})
+    rec["stats"] = stats
+    # Yaroqsizlik flagi
+    rec.setdefault("broken", False)
+    return rec
+
+
+def _migrate_v1(db: "DB"):
+    """Versiyasiz fayllar: fav/rand_hist/role va kino statistikasi standart qiymatlari."""
+    for u in db.users.values():
+        _user_defaults(u)
+    for rec in db.movies.values():
+        _movie_defaults(rec)
+
+
+def _migrate_v2(db: "DB"):
+    """stats.ratings.users (str(uid) -> baho) kino yozuvidan RatingStore ga ko'chadi.
+
+    Jurnal/SQLite dan kelgan baholar yangiroq — ular ustiga yozilmaydi. sum/count
+    gistogrammadan qayta hisoblanadi.
+    """
+    for code, rec in db.movies.items():
+        ratings = rec.setdefault("stats", {}).setdefault("ratings", {"sum": 0, "count": 0})
+        for uid, r in (ratings.pop("users", None) or {}).items():
+            if not db.ratings.get(code, int(uid)):
+                db.ratings.set(code, int(uid), int(r))
+        ratings["sum"], ratings["count"] = db.ratings.summary(code)
+
+
+# (versiya, funksiya) — tartib bilan; yangi migratsiya ro'yxat oxiriga qo'shiladi
+MIGRATIONS = [
+    (1, _migrate_v1),
+    (2, _migrate_v2),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+RANDOM_HISTORY_SIZE = 20
+RANDOM_HISTORY_FLUSH = float(os.getenv("RANDOM_HISTORY_FLUSH", "30") or 30)  # random tarixini yig'ib saqlash (s)
+RANDOM_MAX_TRIES = 5
+# Tekshirilgan kinolar shundan kam bo'lsa (birinchi health skani paytida) random butun indeksdan tanlaydi
+RANDOM_VERIFIED_MIN = 2 * RANDOM_HISTORY_SIZE
+# Top reytingi: Bayes o'rtachasi = (C*m + sum) / (C + count). m — oldindan berilgan o'rtacha baho,
+# C — "nechta virtual ovozga teng" og'irlik. Bitta 5 yulduzli ovoz ko'p baholangan filmdan o'zib ketmaydi.
+TOP_SIZE = 10
+TOP_PRIOR_MEAN = float(os.getenv("TOP_PRIOR_MEAN", "3.0"))
+TOP_PRIOR_VOTES = float(os.getenv("TOP_PRIOR_VOTES", "5"))
+
+
+class DeliverableIndex:
+    """Kodlar to'plami: O(1) qo'shish/o'chirish va O(1) tasodifiy tanlash (ro'yxat + pozitsiya)."""
+
+    __slots__ = ("_codes", "_pos")
+
+    def __init__(self):
+        self._codes: list = []
+        self._pos: Dict[str, int] = {}
+
+    def __len__(self):
+        return len(self._codes)
+
+    def __contains__(self, code: str):
+        return code in self._pos
+
+    def add(self, code: str):
+        if code not in self._pos:
+            self._pos[code] = len(self._codes)
+            self._codes.append(code)
+
+    def discard(self, code: str):
+        i = self._pos.pop(code, None)
+        if i is None:
+            return
+        last = self._codes.pop()
+        if i < len(self._codes):
+            self._codes[i] = last
+            self._pos[last] = i
+
+    def sample(self, exclude=None, tries: int = 8) -> Optional[str]:
+        """exclude(code) True bo'lganlarni chetlab tasodifiy kod. Odatda O(1);
+        tasodifiy urinishlar tugasa, tasodifiy nuqtadan bir marta aylanib chiqadi."""
+        n = len(self._codes)
+        if not n:
+            return None
+        for _ in range(tries):
+            c = self._codes[random.randrange(n)]
+            if exclude is None or not exclude(c):
+                return c
+        start = random.randrange(n)
+        for k in range(n):
+            c = self._codes[(start + k) % n]
+            if not exclude(c):
+                return c
+        return None
+
+
+class CodeIntern:
+    """Kino kodi <-> kichik butun son (RecentWindow bitmapi va ixcham yozuvlar uchun)."""
+
+    __slots__ = ("ids", "codes")
+
+    def __init__(self):
+        self.ids: Dict[str, int] = {}
+        self.codes: list = []
+
+    def id(self, code: str) -> int:
+        cid = self.ids.get(code)
+        if cid is None:
+            cid = self.ids[code] = len(self.codes)
+            self.codes.append(code)
+        return cid
+
+    def code(self, cid: int) -> str:
+        return self.codes[cid]
+
+
+interned_codes = CodeIntern()
+
+
+class RecentWindow:
+    """Foydalanuvchining oxirgi N ta random kodi: halqa bufer (array('i')).
+
+    Kodlar interned_codes orqali kichik butun songa aylantiriladi. A'zolik N ta int ichida
+    C darajasida qidiriladi (N=20): alohida bitmap saqlanmaydi, chunki katta katalogda u har
+    bir foydalanuvchiga kilobaytlab xotira olardi.
+    """
+
+    __slots__ = ("ids", "head", "count")
+
+    def __init__(self, size: int = RANDOM_HISTORY_SIZE):
+        self.ids = array("i", [-1]) * size
+        self.head = 0   # keyingi yoziladigan joy
+        self.count = 0
+
+    def __contains__(self, cid: int) -> bool:
+        return cid >= 0 and cid in self.ids
+
+    def ordered(self):
+        size = len(self.ids)
+        return [self.ids[(self.head - self.count + k) % size] for k in range(self.count)]
+
+    def last(self) -> Optional[int]:
+        return self.ids[(self.head - 1) % len(self.ids)] if self.count else None
+
+    def push(self, cid: int):
+        size = len(self.ids)
+        if cid in self:
+            # Takror: ro'yxat oxiriga ko'chiramiz (N kichik — qayta quramiz)
+            order = [x for x in self.ordered() if x != cid]
+            self.clear()
+            for x in order:
+                self.push(x)
+        elif self.count == size:
+            self.count -= 1
+        self.ids[self.head] = cid
+        self.head = (self.head + 1) % size
+        self.count += 1
+
+    def clear(self):
+        for i in range(len(self.ids)):
+            self.ids[i] = -1
+        self.head = self.count = 0
+
+
+_PHONE_INT_RE = re.compile(r"\+[1-9]\d{0,17}")
+_FAV_MAX = 2 ** 32
+
+
+class UserRecord(MutableMapping):
+    """Foydalanuvchining ixcham xotiradagi yozuvi (__slots__, lug'atsiz).
+
+    Tashqaridan oddiy dict kabi ishlaydi (u.get("role"), u["fav"], dict(u)) va JSON dagi
+    eski ko'rinishga yo'qotishsiz qaytadi. Ichkarida:
+    - phone "+<raqamlar>" bo'lsa int sifatida saqlanadi;
+    - fav — raqamli kodlarning saralangan array('I') si (a'zolik bisect bilan), raqam
+      ko'rinishida bo'lmagan kodlar (masalan "05") alohida kichik tuple da;
+    - rand_hist — RecentWindow (halqa bufer, interned_codes id lari);
+    - qolgan noma'lum maydonlar extra lug'atida (odatda None).
+    Bo'sh fav/rand_hist uchun obyekt yaratilmaydi (None).
+    """
+
+    __slots__ = ("name", "phone", "admin", "role", "fav", "fav_x", "hist", "extra")
+    _FIELDS = ("name", "phone", "is_admin", "role", "fav", "rand_hist")
+
+    def __init__(self):
+        self.name = self.phone = self.admin = self.role = None
+        self.fav = self.fav_x = self.hist = self.extra = None
+
+    @classmethod
+    def from_dict(cls, d: Mapping[str, Any]) -> "UserRecord":
+        u = cls()
+        for k, v in d.items():
+            u[k] = v
+        return u
+
+    def __bool__(self):
+        return True
+
+    # ---- Mapping ----
+    def __getitem__(self, key: str):
+        if key == "name":
+            v = self.name
+        elif key == "phone":
+            v = self.phone
+            if type(v) is int:
+                return f"+{v}"
+        elif key == "is_admin":
+            v = self.admin
+        elif key == "role":
+            v = self.role
+        elif key == "fav":
+            return self.fav_codes()
+        elif key == "rand_hist":
+            return [interned_codes.code(cid) for cid in self.hist.ordered()] if self.hist else []
+        else:
+            if self.extra is None:
+                raise KeyError(key)
+            return self.extra[key]
+        if v is None:
+            raise KeyError(key)
+        return v
+
+    def __setitem__(self, key: str, value):
+        if key == "name":
+            self.name = value
+        elif key == "phone":
+            self.phone = int(value[1:]) if isinstance(value, str) and _PHONE_INT_RE.fullmatch(value) else value
+        elif key == "is_admin":
+            self.admin = None if value is None else bool(value)
+        elif key == "role":
+            self.role = sys.intern(value) if isinstance(value, str) else value
+        elif key == "fav":
+            self.fav = self.fav_x = None
+            for code in value or ():
+                self.add_fav(code)
+        elif key == "rand_hist":
+            self.hist = None
+            if value:
+                self.hist = RecentWindow()
+                for code in list(value)[-RANDOM_HISTORY_SIZE:]:
+                    self.hist.push(interned_codes.id(code))
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key: str):
+        if key in ("fav", "rand_hist"):
+            self[key] = None
+        elif key in self._FIELDS:
+            if key not in self:
+                raise KeyError(key)
+            setattr(self, "admin" if key == "is_admin" else key, None)
+        else:
+            if self.extra is None:
+                raise KeyError(key)
+            del self.extra[key]
+            if not self.extra:
+                self.extra = None
+
+    def __iter__(self):
+        if self.name is not None:
+            yield "name"
+        if self.phone is not None:
+            yield "phone"
+        if self.admin is not None:
+            yield "is_admin"
+        if self.role is not None:
+            yield "role"
+        yield "fav"
+        yield "rand_hist"
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"UserRecord({dict(self)!r})"
+
+    # ---- Sevimlilar ----
+    @staticmethod
+    def _fav_num(code: str) -> Optional[int]:
+        if code.isdigit() and code[0] != "0":
+            n = int(code)
+            if n < _FAV_MAX:
+                return n
+        return None
+
+    def has_fav(self, code: str) -> bool:
+        n = self._fav_num(code)
+        if n is None:
+            return bool(self.fav_x) and code in self.fav_x
+        fav = self.fav
+        if not fav:
+            return False
+        i = bisect.bisect_left(fav, n)
+        return i < len(fav) and fav[i] == n
+
+    def add_fav(self, code: str) -> bool:
+        if self.has_fav(code):
+            return False
+        n = self._fav_num(code)
+        if n is None:
+            self.fav_x = (self.fav_x or ()) + (code,)
+        else:
+            if self.fav is None:
+                self.fav = array("I")
+            self.fav.insert(bisect.bisect_left(self.fav, n), n)
+        return True
+
+    def remove_fav(self, code: str) -> bool:
+        if not self.has_fav(code):
+            return False
+        n = self._fav_num(code)
+        if n is None:
+            self.fav_x = tuple(c for c in self.fav_x if c != code) or None
+        else:
+            del self.fav[bisect.bisect_left(self.fav, n)]
+            if not self.fav:
+                self.fav = None
+        return True
+
+    def fav_codes(self) -> list:
+        codes = [str(n) for n in self.fav] if self.fav else []
+        if self.fav_x:
+            codes.extend(self.fav_x)
+        return codes
+
+
+class Leaderboard:
+    """Top kinolar: saralangan kalitlar ro'yxati (bisect) — bitta kino o'zgarsa faqat u qayta joylanadi.
+
+    Kalit: (-bayes, -likes, -views, code) — o'sish tartibida saralanganda eng yaxshisi boshida.
+    `version` faqat birinchi TOP_SIZE tarkibi (yoki undagi ko'rsatkichlar) o'zgarganda oshadi —
+    tayyor Top matnini shu bo'yicha keshlash mumkin.
+    """
+
+    __slots__ = ("size", "_keys", "_sorted", "version")
+
+    def __init__(self, size: int = TOP_SIZE):
+        self.size = size
+        self._keys: Dict[str, tuple] = {}
+        self._sorted: list = []
+        self.version = 0
+
+    def __len__(self):
+        return len(self._sorted)
+
+    @staticmethod
+    def score(rec: Dict[str, Any]) -> float:
+        ratings = (rec.get("stats") or {}).get("ratings") or {}
+        s, c = ratings.get("sum", 0), ratings.get("count", 0)
+        return (TOP_PRIOR_VOTES * TOP_PRIOR_MEAN + s) / (TOP_PRIOR_VOTES + c) if (c or TOP_PRIOR_VOTES) else 0.0
+
+    @classmethod
+    def key(cls, code: str, rec: Dict[str, Any]) -> tuple:
+        stats = rec.get("stats") or {}
+        return (-cls.score(rec), -(stats.get("likes") or {}).get("count", 0), -stats.get("views", 0), code)
+
+    def _in_top(self, key: tuple) -> bool:
+        return bisect.bisect_left(self._sorted, key) < self.size
+
+    def rebuild(self, movies: Dict[str, Dict[str, Any]]):
+        self._keys = {code: self.key(code, rec) for code, rec in movies.items()}
+        self._sorted = sorted(self._keys.values())
+        self.version += 1
+
+    def update(self, code: str, rec: Optional[Dict[str, Any]], touched: bool = False):
+        """Kino qo'shildi/o'zgardi (rec=None — o'chirildi). touched=True: kalitga kirmaydigan
+        maydon (masalan nom) o'zgardi — kino Topda bo'lsa kesh baribir eskiradi."""
+        old = self._keys.get(code)
+        new = self.key(code, rec) if rec else None
+        if old == new:
+            if touched and old is not None and self._in_top(old):
+                self.version += 1
+            return
+        changed = False
+        if old is not None:
+            changed = self._in_top(old)
+            i = bisect.bisect_left(self._sorted, old)
+            del self._sorted[i]
+            del self._keys[code]
+        if new is not None:
+            bisect.insort(self._sorted, new)
+            self._keys[code] = new
+            changed = changed or self._in_top(new)
+        if changed:
+            self.version += 1
+
+    def top(self) -> list:
+        return self.ranked(self.size)
+
+    def ranked(self, n: int) -> list:
+        """Reyting bo'yicha birinchi n ta kod (inline rejimdagi bo'sh so'rov uchun)."""
+        return [k[3] for k in self._sorted[:n]]
+
+
+class MovieRatings:
+    """Bitta kinoning baholari: uid bo'yicha saralangan parallel massivlar + 1..5 gistogramma."""
+
+    __slots__ = ("uids", "vals", "hist")
+
+    def __init__(self):
+        self.uids = array("q")   # Telegram user id 32 bitdan oshishi mumkin
+        self.vals = array("B")
+        self.hist = [0] * 5      # hist[n-1] — n yulduzli ovozlar soni
+
+
+class RatingStore:
+    """Ustunli baholar ombori: code -> MovieRatings. Qidiruv va upsert bisect bilan O(log n)."""
+
+    def __init__(self):
+        self._movies: Dict[str, MovieRatings] = {}
+
+    @classmethod
+    def from_dict(cls, data: Mapping[str, Mapping[int, int]]) -> "RatingStore":
+        store = cls()
+        for code, votes in data.items():
+            m = store._movies[code] = MovieRatings()
+            for uid in sorted(votes):
+                r = int(votes[uid])
+                m.uids.append(uid)
+                m.vals.append(r)
+                m.hist[r - 1] += 1
+        return store
+
+    def get(self, code: str, uid: int) -> int:
+        """Foydalanuvchi bahosi, bo'lmasa 0."""
+        m = self._movies.get(code)
+        if m is None:
+            return 0
+        i = bisect.bisect_left(m.uids, uid)
+        return m.vals[i] if i < len(m.uids) and m.uids[i] == uid else 0
+
+    def set(self, code: str, uid: int, rating: int) -> int:
+        """Bahoni qo'yadi/yangilaydi; avvalgi bahoni (yoki 0) qaytaradi."""
+        m = self._movies.get(code)
+        if m is None:
+            m = self._movies[code] = MovieRatings()
+        i = bisect.bisect_left(m.uids, uid)
+        if i < len(m.uids) and m.uids[i] == uid:
+            old = m.vals[i]
+            m.hist[old - 1] -= 1
+            m.vals[i] = rating
+        else:
+            old = 0
+            m.uids.insert(i, uid)
+            m.vals.insert(i, rating)
+        m.hist[rating - 1] += 1
+        return old
+
+    def histogram(self, code: str) -> list:
+        m = self._movies.get(code)
+        return list(m.hist) if m else [0] * 5
+
+    def summary(self, code: str) -> Tuple[int, int]:
+        """(baholar yig'indisi, soni) — gistogrammadan."""
+        hist = self.histogram(code)
+        return sum(n * h for n, h in enumerate(hist, start=1)), sum(hist)
+
+    def items(self):
+        for code, m in self._movies.items():
+            yield code, m.uids, m.vals
+
+
+class UserDirectory:
+    """Admin foydalanuvchilar ro'yxati uchun indekslar.
+
+    - keys/uids: (ism casefold, uid) bo'yicha tartiblangan parallel ro'yxatlar — sahifalash va ism prefiksi
+      bo'yicha qidiruv bisect bilan O(log n + sahifa);
+    - phones: telefon raqami (faqat raqamlar, int) -> uid.
+    Yozuv o'zgarishidan oldin remove(), keyin add() chaqiriladi (DB.upsert_user / DB.set_role).
+    """
+
+    def __init__(self):
+        self.keys: list = []
+        self.uids = array("q")
+        self.phones: Dict[int, int] = {}
+
+    @staticmethod
+    def name_key(name) -> str:
+        return str(name or "").casefold()
+
+    @staticmethod
+    def phone_key(phone) -> Optional[int]:
+        digits = re.sub(r"\D", "", str(phone or ""))
+        return int(digits) if digits else None
+
+    def __len__(self):
+        return len(self.uids)
+
+    def rebuild(self, users: Mapping[int, Mapping[str, Any]]):
+        pairs = sorted((self.name_key(u.get("name")), uid) for uid, u in users.items())
+        self.keys = [k for k, _ in pairs]
+        self.uids = array("q", (uid for _, uid in pairs))
+        self.phones = {}
+        for uid, u in users.items():
+            p = self.phone_key(u.get("phone"))
+            if p is not None:
+                self.phones[p] = uid
+
+    def _find(self, key: str, uid: int) -> int:
+        lo = bisect.bisect_left(self.keys, key)
+        hi = bisect.bisect_right(self.keys, key, lo)
+        return bisect.bisect_left(self.uids, uid, lo, hi)
+
+    def add(self, uid: int, u: Mapping[str, Any]):
+        key = self.name_key(u.get("name"))
+        i = self._find(key, uid)
+        if i < len(self.uids) and self.uids[i] == uid and self.keys[i] == key:
+            return
+        self.keys.insert(i, key)
+        self.uids.insert(i, uid)
+        p = self.phone_key(u.get("phone"))
+        if p is not None:
+            self.phones[p] = uid
+
+    def remove(self, uid: int, u: Mapping[str, Any]):
+        key = self.name_key(u.get("name"))
+        i = self._find(key, uid)
+        if i < len(self.uids) and self.uids[i] == uid and self.keys[i] == key:
+            del self.keys[i]
+            del self.uids[i]
+        p = self.phone_key(u.get("phone"))
+        if p is not None and self.phones.get(p) == uid:
+            del self.phones[p]
+
+    def position(self, uid: int, u: Mapping[str, Any]) -> int:
+        """Foydalanuvchining tartiblangan ro'yxatdagi o'rni (sahifa kursori uchun)."""
+        return self._find(self.name_key(u.get("name")), uid)
+
+    def prefix_range(self, prefix: str) -> Tuple[int, int]:
+        """Ismi prefix bilan boshlanadiganlar oralig'i [lo, hi)."""
+        key = self.name_key(prefix)
+        if not key:
+            return 0, len(self.keys)
+        lo = bisect.bisect_left(self.keys, key)
+        hi = bisect.bisect_left(self.keys, key[:-1] + chr(min(ord(key[-1]) + 1, sys.maxunicode)), lo)
+        return lo, hi
+
+    def page(self, start: int, stop: int) -> list:
+        return self.uids[start:stop].tolist()
+
+
+# Kirill -> lotin (o'zbek) transliteratsiyasi; tutuq belgilari olib tashlanadi (o'/oʻ/ў -> o, g'/ғ -> g)
+_TRANSLIT = str.maketrans({
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ё": "yo", "ж": "j", "з": "z", "и": "i",
+    "й": "y", "к": "k", "л": "l", "м": "m", "н": "n", "о": "o", "п": "p", "р": "r", "с": "s", "т": "t",
+    "у": "u", "ф": "f", "х": "x", "ц": "ts", "ч": "ch", "ш": "sh", "щ": "sh", "ъ": "", "ы": "i", "ь": "",
+    "э": "e", "ю": "yu", "я": "ya", "ў": "o", "қ": "q", "ғ": "g", "ҳ": "h",
+    "'": "", "‘": "", "’": "", "ʻ": "", "ʼ": "", "`": "",
+})
+_NON_WORD_RE = re.compile(r"[^0-9a-z]+")
+SEARCH_MIN_SCORE = 0.5     # so'rov trigrammalarining kamida shuncha qismi nomda bo'lishi kerak
+SEARCH_RESCORE = 200       # aniq baholanadigan nomzodlar soni
+SEARCH_SCAN_BUDGET = 40000  # nomzod yig'ishda o'qiladigan posting lar chegarasi (juda umumiy so'zlar uchun)
+
+
+def normalize_title(text) -> str:
+    """Qidiruv uchun: kichik harf, kirill -> lotin, harf/raqamdan boshqasi bo'shliq."""
+    t = str(text or "").casefold().translate(_TRANSLIT)
+    return _NON_WORD_RE.sub(" ", t).strip()
+
+
+def padded_title(norm: str) -> str:
+    # Har so'z "  so'z " ko'rinishida: trigramma shu satrda bo'lsa, nomda bor (so'zlar orasidagi
+    # "x  " va "   " bo'laklari haqiqiy trigramma bo'lmaydi, shuning uchun `g in padded` aniq)
+    return "  " + norm.replace(" ", "   ") + " " if norm else ""
+
+
+def title_trigrams(norm: str) -> set:
+    # pg_trgm kabi: har so'z oldidan 2 ta, ortidan 1 ta bo'shliq — qisqa so'zlar ham trigramma beradi
+    grams = set()
+    for w in norm.split():
+        w = f"  {w} "
+        grams.update(w[i:i + 3] for i in range(len(w) - 2))
+    return grams
+
+
+class TitleIndex:
+    """Kino nomlari bo'yicha xatoga chidamli qidiruv: trigramma -> kodlar (interned id) inverted indeksi.
+
+    Nomzodlar eng kam uchraydigan trigrammalar ro'yxatlaridan yig'iladi: nomda kamida `need` ta trigramma
+    bo'lishi kerak bo'lsa, u eng noyob (len(q) - need + 1) ta ro'yxatning hech bo'lmasa bittasida bor.
+    So'ng eng yaxshi SEARCH_RESCORE ta nomzod nomining to'liq trigrammalari bilan aniq baholanadi.
+    """
+
+    def __init__(self):
+        self.postings: Dict[str, array] = {}
+        self.names: Dict[int, str] = {}  # code id -> padded_title(normalizatsiya qilingan nom)
+        self.version = 0  # har o'zgarishda oshadi (natija keshlari uchun)
+
+    def __len__(self):
+        return len(self.names)
+
+    def rebuild(self, movies: Mapping[str, Mapping[str, Any]]):
+        self.postings = {}
+        self.names = {}
+        for code, rec in movies.items():
+            self.add(code, rec.get("name"))
+
+    def add(self, code: str, name):
+        cid = interned_codes.id(code)
+        if cid in self.names:
+            self.remove(code)
+        norm = normalize_title(name)
+        self.names[cid] = padded_title(norm)
+        self.version += 1
+        for g in title_trigrams(norm):
+            p = self.postings.get(g)
+            if p is None:
+                p = self.postings[g] = array("I")
+            p.append(cid)
+
+    def remove(self, code: str):
+        cid = interned_codes.ids.get(code)
+        padded = self.names.pop(cid, None)
+        if padded is None:
+            return
+        self.version += 1
+        for g in title_trigrams(padded.strip()):
+            p = self.postings.get(g)
+            if p is not None:
+                p.remove(cid)
+                if not p:
+                    del self.postings[g]
+
+    def search(self, query: str, limit: int = 10, min_score: float = SEARCH_MIN_SCORE) -> list:
+        """Eng mos kodlar (o'xshashlik kamayishi tartibida)."""
+        q = title_trigrams(normalize_title(query))
+        if not q:
+            return []
+        need = max(1, int(len(q) * min_score + 0.999))
+        lists = sorted((self.postings.get(g, ()) for g in q), key=len)
+        counts = Counter()
+        budget = SEARCH_SCAN_BUDGET
+        for p in lists[:len(q) - need + 1]:
+            if budget <= 0:
+                break
+            counts.update(p)
+            budget -= len(p)
+        top = counts if len(counts) <= SEARCH_RESCORE else (c for c, _ in counts.most_common(SEARCH_RESCORE))
+        scored = []
+        for cid in top:
+            padded = self.names[cid]
+            shared = sum(g in padded for g in q)
+            if shared >= need:
+                # Avval mos trigrammalar soni, keyin qisqaroq (aniqroq) nom
+                scored.append((-shared, len(padded), cid))
+        scored.sort()
+        return [interned_codes.code(cid) for _, _, cid in scored[:limit]]
+
+
+class DB:
+    def __init__(self, base: Path, storage: Optional[Storage] = None):
+        self.storage = storage or make_storage(base)
+        self.users: Dict[int, Dict[str, Any]] = {}
+        self.movies: Dict[str, Dict[str, Any]] = {}
+        # Random uchun indekslar: yetkaziladigan (broken/dead emas) va fon tekshiruvidan o'tgan kodlar
+        self.random_index = DeliverableIndex()
+        self.verified_index = DeliverableIndex()
+        self.top = Leaderboard()
+        self.ratings = RatingStore()
+        self.directory = UserDirectory()
+        self.titles = TitleIndex()
+        # Metama'lumot (nom, yil, ...) o'zgarishlari hisoblagichi — caption keshi shunga qaraydi
+        self._meta_rev: Dict[str, int] = {}
+        # Random tarixi o'zgargan, hali saqlanmagan foydalanuvchilar
+        self._hist_dirty: set = set()
+        self.load()
+
+    def load(self):
+        self.users, self.movies = self.storage.load()
+        self.ratings = RatingStore.from_dict(self.storage.load_ratings())
+        self.storage.bind_ratings(self.ratings)
+        self._migrate()
+        self.random_index = DeliverableIndex()
+        self.verified_index = DeliverableIndex()
+        # Yozuvlar joyida ixcham UserRecord ga aylantiriladi (storage ham shu lug'atni saqlaydi)
+        for uid, u in self.users.items():
+            self.users[uid] = UserRecord.from_dict(u)
+        self.directory.rebuild(self.users)
+        for code in self.movies:
+            self._reindex(code)
+        self.top.rebuild(self.movies)
+        self.titles.rebuild(self.movies)
+
+    def _migrate(self):
+        version = self.storage.schema_version
+        if version >= SCHEMA_VERSION:
+            return
+        for target, migrate in MIGRATIONS:
+            if target > version:
+                migrate(self)
+        # Bir martalik to'liq yozuv: yangilangan yozuvlar, so'ng yangi versiya
+        self.storage.save_all_users(self.users)
+        self.storage.save_all_movies(self.movies)
+        self.storage.save_all_ratings(self.ratings)
+        self.storage.set_schema_version(SCHEMA_VERSION)
+        logging.info(f"DB sxemasi {version} -> {SCHEMA_VERSION} ga yangilandi "
+                     f"({len(self.users)} foydalanuvchi, {len(self.movies)} kino)")
+
+    # ==== Indekslar ====
+    def code_id(self, code: str) -> int:
+        return interned_codes.id(code)
+
+    def code_of(self, cid: int) -> str:
+        return interned_codes.code(cid)
+
+    def meta_rev(self, code: str) -> int:
+        return self._meta_rev.get(code, 0)
+
+    def _reindex(self, code: str):
+        rec = self.movies.get(code)
+        state = ((rec or {}).get("health") or {}).get("state")
+        # Kanal posti o'chgan ("dead") bo'lsa ham file_id bilan yetkazish mumkin
+        deliverable = bool(rec) and not rec.get("broken") and bool(rec.get("file_id") or (
+            state != "dead" and (rec.get("full_message_id") or rec.get("preview_message_id"))))
+        if deliverable:
+            self.random_index.add(code)
+        else:
+            self.random_index.discard(code)
+        if deliverable and state == "ok":
+            self.verified_index.add(code)
+        else:
+            self.verified_index.discard(code)
+
+    def save_users(self):
+        self.storage.save_all_users(self.users)
+
+    def save_movies(self):
+        self.storage.save_all_movies(self.movies)
+
+    @staticmethod
+    def norm_phone(phone: str) -> str:
+        t = phone.strip().replace(" ", "").replace("-", "").replace("(", "").replace(")", "")
+        if t.startswith("00"): t = "+" + t[2:]
+        if not t.startswith("+") and t.isdigit():
+            t = "+" + t
+        return t
+
+    def is_admin_phone(self, phone: str) -> bool:
+        p = self.norm_phone(phone)
+        return p in [self.norm_phone(a) for a in ADMIN_PHONES]
+
+    def is_admin_id(self, uid: int) -> bool:
+        return uid in ADMIN_IDS
+
+    def upsert_user(self, uid: int, name: str, phone: str, is_admin: bool):
+        # Mavjud foydalanuvchining sevimlilari va random tarixi joyida qoladi
+        u = self.users.get(uid)
+        if u is None:
+            u = self.users[uid] = UserRecord()
+        else:
+            self.directory.remove(uid, u)
+        role = u.get("role")
+        # Agar rol hali belgilanmagan bo'lsa, is_admin True bo'lsa 'admin', aks holda 'user'
+        if not role:
+            role = "admin" if is_admin else "user"
+        u["name"] = name
+        u["phone"] = self.norm_phone(phone)
+        u["is_admin"] = is_admin
+        u["role"] = role
+        self.directory.add(uid, u)
+        self.storage.save_user(uid, u)
+
+    def get_user(self, uid: int) -> Optional[Dict[str, Any]]:
+        # Faqat o'qish: eski yozuvlar DB.load dagi migratsiyada to'ldirilgan
+        return self.users.get(uid)
+
+    def is_admin(self, uid: int) -> bool:
+        u = self.get_user(uid)
+        if not u:
+            return False
+        role = u.get("role")
+        return bool(u.get("is_admin") or role in {"admin", "super_admin"})
+
+    def is_super_admin(self, uid: int) -> bool:
+        # Rolga ko'ra yoki konfiguratsiyadagi SUPER_ADMIN_ID ga ko'ra
+        if SUPER_ADMIN_ID is not None and uid == SUPER_ADMIN_ID:
+            return True
+        u = self.get_user(uid)
+        return bool(u and u.get("role") == "super_admin")
+
+    def set_role(self, uid: int, role: str):
+        u = self.get_user(uid) or UserRecord.from_dict({"name": "?", "phone": "", "fav": [], "rand_hist": []})
+        u["role"] = role
+        u["is_admin"] = True if role in {"admin", "super_admin"} else False
+        if uid not in self.users:
+            self.users[uid] = u
+            self.directory.add(uid, u)
+        self.storage.save_user(uid, u)
+
+    def set_blocked(self, uid: int, blocked: bool):
+        """Botni bloklagan foydalanuvchini belgilash (yozuv o'chirilmaydi: /start bosilsa bayroq olinadi)."""
+        u = self.users.get(uid)
+        if u is None or bool(u.get("blocked")) == blocked:
+            return
+        if blocked:
+            u["blocked"] = True
+        else:
+            del u["blocked"]
+        self.storage.save_user(uid, u)
+
+    def add_movie(self, code: str, info: Dict[str, Any]):
+        # Yangi yozuv migratsiyadagi bilan bir xil standart maydonlarni oladi
+        info = _movie_defaults(dict(info))
+        self.movies[code] = info
+        self._reindex(code)
+        self.top.update(code, info, touched=True)
+        self.titles.add(code, info.get("name"))
+        self.storage.save_movie(code, info)
+
+    def add_movies(self, items: Mapping[str, Dict[str, Any]]):
+        """add_movie ning ommaviy varianti: indekslar har kino uchun, diskka esa bitta yozuv."""
+        batch = {}
+        for code, info in items.items():
+            info = batch[code] = _movie_defaults(dict(info))
+            self.movies[code] = info
+            self._reindex(code)
+            self.top.update(code, info, touched=True)
+            self.titles.add(code, info.get("name"))
+        if batch:
+            self.storage.save_movies(batch)
+
+    def get_movie(self, code: str) -> Optional[Dict[str, Any]]:
+        return self.movies.get(code)
+
+    def update_movie(self, code: str, fields: Dict[str, Any]):
+        """Mavjud kinoning bir nechta maydonini yangilaydi (statistikaga tegmaydi)."""
+        rec = self.movies.get(code)
+        if not rec:
+            return
+        rec.update(fields)
+        self._reindex(code)
+        if not fields.keys().isdisjoint(MOVIE_META_FIELDS):
+            self._meta_rev[code] = self._meta_rev.get(code, 0) + 1
+        if "name" in fields:
+            self.top.update(code, rec, touched=True)
+            self.titles.add(code, rec.get("name"))
+        self.storage.save_movie(code, rec)
+
+    def mark_broken(self, code: str):
+        rec = self.movies.get(code)
+        if not rec:
+            return
+        if not rec.get("broken"):
+            rec["broken"] = True
+            self.movies[code] = rec
+            self._reindex(code)
+            self.storage.save_movie(code, rec)
+
+    # ==== Movie statistika amallari ====
+    def inc_view(self, code: str):
+        rec = self.get_movie(code)
+        if not rec:
+            return
+        rec.setdefault("stats", {}).setdefault("views", 0)
+        rec["stats"]["views"] += 1
+        self.top.update(code, rec)
+        self.storage.inc_view(code, rec)
+
+    def toggle_like(self, code: str, uid: int) -> bool:
+        """Like yoqadi/yopadi. True=like qo'shildi, False=olib tashlandi"""
+        rec = self.get_movie(code)
+        if not rec:
+            return False
+        stats = rec.setdefault("stats", {})
+        likes = stats.setdefault("likes", {"users": [], "count": 0})
+        users = set(likes.get("users", []))
+        if uid in users:
+            users.remove(uid)
+            action_added = False
+        else:
+            users.add(uid)
+            action_added = True
+        likes["users"] = list(users)
+        likes["count"] = len(users)
+        stats["likes"] = likes
+        rec["stats"] = stats
+        self.top.update(code, rec)
+        self.storage.save_movie(code, rec)
+        return action_added
+
+    def rate_movie(self, code: str, uid: int, rating: int):
+        """Foydalanuvchi bahosini qo'yadi (1..5). Avvalgi bahosi bo'lsa yangilanadi."""
+        rating = max(1, min(5, int(rating)))
+        rec = self.get_movie(code)
+        if not rec:
+            return
+        if self.ratings.set(code, uid, rating) == rating:
+            return
+        # Kino yozuvida faqat yig'indi/son qoladi (Top va caption uchun), ovozlar — RatingStore da
+        ratings = rec.setdefault("stats", {}).setdefault("ratings", {"sum": 0, "count": 0})
+        ratings["sum"], ratings["count"] = self.ratings.summary(code)
+        self.top.update(code, rec)
+        self.storage.set_rating(code, uid, rating, rec)
+
+    # ==== Favorites (Sevimlilar) ====
+    def toggle_favorite(self, uid: int, code: str) -> bool:
+        """Foydalanuvchining sevimlilariga qo'shadi yoki o'chiradi. True=qo'shildi, False=o'chirildi"""
+        u = self.get_user(uid)
+        if not u:
+            return False
+        added = not u.remove_fav(code)
+        if added:
+            u.add_fav(code)
+        self.storage.set_favorite(uid, code, added, u)
+        return added
+
+    def is_favorite(self, uid: int, code: str) -> bool:
+        u = self.users.get(uid)
+        return bool(u) and u.has_fav(code)
+
+    def get_favorites(self, uid: int):
+        u = self.get_user(uid)
+        return u.fav_codes() if u else []
+
+    # ==== Random history per user ====
+    # Tarix foydalanuvchi yozuvidagi RecentWindow da (UserRecord.hist). Har bosishda diskka
+    # yozilmaydi: o'zgargan foydalanuvchilar _hist_dirty ga yig'iladi va flush_random_history
+    # (fon tsikli har RANDOM_HISTORY_FLUSH s da, shutdown da ham) ularni bitta yozuvda saqlaydi.
+    def random_window(self, uid: int) -> RecentWindow:
+        u = self.users.get(uid)
+        if u is None:
+            return RecentWindow()
+        if u.hist is None:
+            u.hist = RecentWindow()
+        return u.hist
+
+    def get_random_history(self, uid: int):
+        return [self.code_of(cid) for cid in self.random_window(uid).ordered()]
+
+    def push_random_history(self, uid: int, code: str):
+        if uid not in self.users:
+            return
+        self.random_window(uid).push(self.code_id(code))
+        self._hist_dirty.add(uid)
+
+    def flush_random_history(self) -> int:
+        dirty, self._hist_dirty = self._hist_dirty, set()
+        batch = {uid: self.users[uid] for uid in dirty if uid in self.users}
+        if batch:
+            try:
+                self.storage.set_random_histories(batch)
+            except Exception as e:
+                logging.error(f"random tarix saqlanmadi, keyingi safar qayta urinamiz: {e}")
+                self._hist_dirty |= dirty
+                return 0
+        return len(batch)
+
+    def clear_random_history(self, uid: int):
+        u = self.get_user(uid)
+        if not u:
+            return
+        u.hist = None
+        self._hist_dirty.discard(uid)
+        self.storage.set_random_history(uid, u)
+
+    def sample_random(self, uid: int) -> Optional[str]:
+        """Foydalanuvchi yaqinda ko'rmagan tasodifiy kod (tekshirilganlar ustuvor). Odatda O(1)."""
+        w = self.random_window(uid)
+        seen = lambda c: self.code_id(c) in w
+        code = None
+        if len(self.verified_index) >= RANDOM_VERIFIED_MIN:
+            code = self.verified_index.sample(seen)
+        if code is None:
+            # Tekshirilganlar kam yoki hammasi yaqinda ko'rilgan — butun indeksdan
+            code = self.random_index.sample(seen)
+        if code is None:
+            # Hammasi yaqinda ko'rilgan — hech bo'lmasa oxirgisini takrorlamaymiz
+            index, last = self.random_index, w.last()
+            code = index.sample(lambda c: len(index) > 1 and self.code_id(c) == last)
+        return code
+
+
+db = DB(BASE_DIR)
+
+# ====== HELPERS ======
+CODE_MIN_LEN = 2
+CODE_BASE_LEN = 3  # boshlang'ich nomlar maydoni: 10..999
+
+
+class CodeAllocator:
+    """Bo'sh kodlar hovuzi: aralashtirilgan ro'yxat, O(1) ajratish va qaytarish.
+
+    Boshida 10..999 oralig'i ishlatiladi; u tugasa keyingi uzunlikka o'tiladi (1000..9999 va h.k.).
+    Ajratish sinxron (await yo'q), shuning uchun bitta event loop ichida ikki admin bir kodni
+    ololmaydi; boshqa jarayonlar bilan to'qnashuvni storage.reserve_code hal qiladi.
+    """
+
+    def __init__(self, db: "DB"):
+        self.db = db
+        self._lock = threading.Lock()
+        self._pool: list = []
+        self.width = CODE_BASE_LEN
+        self._longest = max((len(c) for c in db.movies), default=0)
+        self._fill(CODE_MIN_LEN, CODE_BASE_LEN)
+        while not self._pool:
+            self._grow()
+
+    @property
+    def max_len(self) -> int:
+        """IsCode qabul qiladigan eng uzun kod (oldindan mavjud uzun kodlar ham hisobga olinadi)."""
+        return max(self.width, self._longest)
+
+    def _fill(self, lo_len: int, hi_len: int):
+        used = self.db.movies
+        lo, hi = 10 ** (lo_len - 1), 10 ** hi_len
+        pool = [c for c in map(str, range(lo, hi)) if c not in used]
+        random.shuffle(pool)
+        self._pool = pool
+
+    def _grow(self):
+        self.width += 1
+        logging.info(f"Kod maydoni kengaytirildi: {self.width} xonali kodlar")
+        self._fill(self.width, self.width)
+
+    def __len__(self):
+        return len(self._pool)
+
+    def allocate(self) -> str:
+        with self._lock:
+            while True:
+                if not self._pool:
+                    self._grow()
+                code = self._pool.pop()
+                if code in self.db.movies:
+                    continue
+                if self.db.storage.reserve_code(code):
+                    return code
+
+    def hold(self, code: str):
+        """Restartdan keyin ham band turishi kerak bo'lgan kodni (tugallanmagan yuklash ishi) hovuzdan olib qo'yadi."""
+        with self._lock:
+            try:
+                self._pool.remove(code)
+            except ValueError:
+                pass
+            self.db.storage.reserve_code(code)
+
+    def release(self, code: str):
+        """Kino saqlanmay qolgan kodni hovuzga qaytaradi (tasodifiy joyga — tartib aralash qoladi)."""
+        with self._lock:
+            if code in self.db.movies:
+                return
+            self.db.storage.release_code(code)
+            self._pool.append(code)
+            k = random.randrange(len(self._pool))
+            self._pool[k], self._pool[-1] = self._pool[-1], self._pool[k]
+
+
+code_alloc = CodeAllocator(db)
+
+
+def gen_code() -> str:
+    """Unikal kino kodi (avval 2-3 xonali raqam, maydon to'lsa uzunroq)."""
+    return code_alloc.allocate()
+
+class KB:
+    """Reply klaviaturalar o'zgarmas: import paytida bir marta quriladi va har javobda qayta ishlatiladi."""
+
+    ADMIN = types.ReplyKeyboardMarkup(
+        keyboard=[
+            [types.KeyboardButton(text="🎬 Kanalga kino joylash")],
+            [types.KeyboardButton(text="👥 Foydalanuvchilar")],
+            [types.KeyboardButton(text="👥 Botdagi azolar")],
+            [types.KeyboardButton(text="📣 Kanaldagi azolar")],
+            [types.KeyboardButton(text="📢 Xabar tarqatish")]
+        ], resize_keyboard=True
+    )
+    SUPER_ADMIN = types.ReplyKeyboardMarkup(
+        keyboard=[
+            [types.KeyboardButton(text="🎬 Kanalga kino joylash")],
+            [types.KeyboardButton(text="👥 Foydalanuvchilar")],
+            [types.KeyboardButton(text="👥 Botdagi azolar")],
+            [types.KeyboardButton(text="📣 Kanaldagi azolar")],
+            [types.KeyboardButton(text="📢 Xabar tarqatish")],
+            [types.KeyboardButton(text="➕ Yangi admin qo'shish")],
+            [types.KeyboardButton(text="🗑️ Adminni o'chirish")],
+        ], resize_keyboard=True
+    )
+    USER = types.ReplyKeyboardMarkup(
+        keyboard=[
+            [types.KeyboardButton(text="🎟 Kod yuborish")],
+            [types.KeyboardButton(text="🔍 Random"), types.KeyboardButton(text="⭐ Top")],
+            [types.KeyboardButton(text="💖 Sevimlilar"), types.KeyboardButton(text="📚 Yordam")],
+            [types.KeyboardButton(text="🔔 Obuna tekshirish")]
+        ], resize_keyboard=True
+    )
+    REMOVE = types.ReplyKeyboardRemove()
+
+    @staticmethod
+    def admin():
+        return KB.ADMIN
+
+    @staticmethod
+    def super_admin():
+        return KB.SUPER_ADMIN
+
+    @staticmethod
+    def remove():
+        return KB.REMOVE
+
+    @staticmethod
+    def user():
+        return KB.USER
+
+
+# Caption shabloni bir marta tuziladi: kanal havolasi import paytida qo'yiladi, qolgani format() bilan
+_CAPTION_CHANNEL_LINE = f"🔹Kanal: <a href=\"https://t.me/{PREVIEW_CHANNEL_ID.lstrip('@')}\">©️KinolarOlami</a>\n"
+_CAPTION_TPL = (
+    "🎬: &quot;{name}&quot; [{year}]\n"
+    "➖➖➖➖➖➖➖➖➖➖\n"
+    "• 🌍Davlati: {country} \n"
+    "• 🌟IMBD: {imdb} \n"
+    "• 🎭Janri: {genre}\n"
+    "• 📸Sifat: {quality}\n"
+    "• 🇺🇿Tili: {language}\n\n"
+    "🔢 Kino kodi: <code>{code}</code>\n\n"
+)
+CAPTION_CACHE_SIZE = int(os.getenv("CAPTION_CACHE_SIZE", "5000") or 5000)
+
+
+def full_caption(name: str, year: str, genre: str, duration: str, code: str,
+                 country: str = "-", imdb: str = "-", quality: str = "-", language: str = "-") -> str:
+    # HTML parse mode: maxsus belgilarni escape qilamiz
+    esc = html.escape
+    return _CAPTION_TPL.format(
+        name=esc(name or "-"), year=esc(year or "-"), genre=esc(genre or "-"),
+        country=esc(country or "-"), imdb=esc(imdb or "-"), quality=esc(quality or "-"),
+        language=esc(language or "-"), code=esc(code),
+    ) + _CAPTION_CHANNEL_LINE
+
+
+class CaptionCache:
+    """Kinoning statik caption qismi (full_caption) uchun LRU kesh.
+
+    Yozuv (rec, meta_rev, matn) ko'rinishida: add_movie yangi lug'at yaratadi, update_movie esa
+    db.meta_rev ni oshiradi — ikkala holatda ham eski matn o'z-o'zidan yaroqsiz bo'ladi.
+    """
+
+    def __init__(self, size: int = CAPTION_CACHE_SIZE):
+        self.size = size
+        self._items: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, code: str, rec: Dict[str, Any]) -> str:
+        rev = db.meta_rev(code)
+        item = self._items.get(code)
+        if item is not None and item[0] is rec and item[1] == rev:
+            self._items.move_to_end(code)
+            self.hits += 1
+            return item[2]
+        self.misses += 1
+        text = full_caption(
+            name=rec.get("name", "Kino"), year=rec.get("year", "-"), genre=rec.get("genre", "-"),
+            duration=rec.get("duration", "-"), code=code, country=rec.get("country", "-"),
+            imdb=rec.get("imdb", "-"), quality=rec.get("quality", "-"), language=rec.get("language", "-"),
+        ).rstrip()
+        self._items[code] = (rec, rev, text)
+        self._items.move_to_end(code)
+        if len(self._items) > self.size:
+            self._items.popitem(last=False)
+        return text
+
+
+captions = CaptionCache()
+
+def preview_channel_caption(code: str) -> str:
+    # Kod orqali bazadan nomni olamiz
+    bot_url = f"https://t.me/{Bot_url.lstrip('@')}"
+    job = None if db.get_movie(code) else upload_queue.pending_job(code)
+    rec = job["meta"] if job else db.get_movie(code) or {}
+    s_name = html.escape(rec.get("name", "Kino"))
+    channel_url = f"https://t.me/{PREVIEW_CHANNEL_ID.lstrip('@')}"
+    s_code = html.escape(code)
+    return (
+        f"🎬: \"{s_name}\" botimizga to'liq holda joylandi❗\n"
+        "➖➖➖➖➖➖➖➖➖➖\n"
+        "• Filmni yuklab olish uchun botga kino kodini yuboring\n\n"
+        f"• 🔢 Kino kodi: <code>{s_code}</code>\n\n"
+        "📥 Kino kodini bu yerga  yuboring: 👇\n"
+        f"🔹Bot: <a href=\"{bot_url}\">CinemadiaUz bot</a>"
+    )
+
+# ====== MOVIE INTERACTIVE (likes/ratings) ======
+def _avg_rating(rec: Dict[str, Any]) -> float:
+    stats = (rec or {}).get("stats", {})
+    ratings = stats.get("ratings", {})
+    s, c = ratings.get("sum", 0), ratings.get("count", 0)
+    # Butun songa yaxlitlab ko'rsatamiz
+    return int(round((s / c))) if c else 0
+
+def _user_rating(code: str, uid: int) -> int:
+    return db.ratings.get(code, uid)
+
+# O'rtacha baho yulduzlari (0..5) oldindan tayyor
+_STARS = ["-"] + ["⭐" * n for n in range(1, 6)]
+
+def build_stats_text(code: str, uid: int) -> str:
+    rec = db.get_movie(code) or {}
+    stats = rec.get("stats", {})
+    views = stats.get("views", 0)
+    avg = _avg_rating(rec)
+    ur = _user_rating(code, uid)
+    stars = _STARS[avg]
+    my = f"Sizning baho: {ur}/5" if ur else "Baholanmagan"
+    hist = db.ratings.histogram(code)
+    dist = " · ".join(f"{n}⭐ {hist[n - 1]}" for n in range(5, 0, -1)) if any(hist) else "-"
+    return (
+        "📊 Statistika\n"
+        f"👁️ Ko'rishlar: {views}\n"
+        f"⭐ O'rtacha: {avg} {stars}\n"
+        f"📈 {dist}\n"
+        f"👤 {my}"
+    )
+
+STATS_KB_CACHE_SIZE = int(os.getenv("STATS_KB_CACHE_SIZE", "20000") or 20000)
+# (code, user_rating, fav_on) -> tayyor InlineKeyboardMarkup; bir kino uchun ko'pi bilan 12 variant
+_stats_kb_cache: "OrderedDict[tuple, InlineKeyboardMarkup]" = OrderedDict()
+
+def _make_stats_kb(code: str, ur: int, fav_on: bool) -> InlineKeyboardMarkup:
+    rate_row = []
+    for n in range(1, 6):
+        text = f"{('✅' if ur==n else '')}⭐{n}"
+        rate_row.append(InlineKeyboardButton(text=text, callback_data=f"rate:{code}:{n}"))
+    share_btn = InlineKeyboardButton(text="Ulashish 🔗", callback_data=f"share:{code}")
+    fav_btn = InlineKeyboardButton(text=("💖 Sevimli" if fav_on else "🤍 Sevimlilar"), callback_data=f"fav:{code}")
+    # Like va Yangilash tugmalari olib tashlandi
+    rows = [rate_row, [fav_btn, share_btn]]
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+def build_stats_kb(code: str, uid: int) -> InlineKeyboardMarkup:
+    key = (code, _user_rating(code, uid), db.is_favorite(uid, code))
+    kb = _stats_kb_cache.get(key)
+    if kb is None:
+        kb = _stats_kb_cache[key] = _make_stats_kb(*key)
+        if len(_stats_kb_cache) > STATS_KB_CACHE_SIZE:
+            _stats_kb_cache.popitem(last=False)
+    else:
+        _stats_kb_cache.move_to_end(key)
+    return kb
+
+# Yagona caption yaratish: kanaldagi asosiy tafsilotlar (keshdan) + pastdagi statistika
+def build_combined_caption(rec: Dict[str, Any], code: str, uid: int) -> str:
+    # Statistikada endi kod, nom va like ko'rsatilmaydi
+    views = rec.get("stats", {}).get("views", 0)
+    avg = _avg_rating(rec)
+    ur = _user_rating(code, uid)
+    return (
+        f"{captions.get(code, rec)}\n\n📊 Statistika\n"
+        f"👁️ Ko'rishlar: {views}\n"
+        f"⭐ O'rtacha: {avg} {_STARS[avg]}\n"
+        f"👤 Sizning baho: {ur}/5"
+    )
+
+# ====== MOVIE DELIVERY ======
+class MovieDelivery:
+    """Kinoni foydalanuvchiga yetkazish: bitta copy_message da birlashtirilgan caption va
+    statistika tugmalari yuboriladi (avval copy + edit_message_caption edi).
+
+    Agar caption o'rnatib bo'lmasa (masalan, juda uzun yoki media captionsiz), eski usulga
+    qaytiladi: oddiy nusxa + alohida statistika xabari.
+    """
+
+    SOURCE_GONE = ("message to copy not found", "message to forward not found", "message_id_invalid",
+                   "message not found")
+
+    def __init__(self):
+        self.count = 0
+        self.failed = 0
+        self.fallbacks = 0
+        self.by_file_id = 0
+        self.api_calls = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    async def deliver(self, chat_id: int, code: str, uid: int, *, from_chat_id=None,
+                      message_id: Optional[int] = None, protect_content: bool = False) -> None:
+        """Xato bo'lsa istisno ko'taradi (chaqiruvchi o'zi javob beradi).
+
+        Manba ko'rsatilmasa va kinoning file_id si bo'lsa, send_video/send_document bilan
+        yuboriladi; bo'lmasa (yoki file_id ishlamasa) FULL kanal xabaridan nusxa olinadi.
+        """
+        rec = db.get_movie(code)
+        if not rec:
+            raise KeyError(code)
+        cached = rec.get("file_id") if from_chat_id is None and message_id is None else None
+        if from_chat_id is None:
+            from_chat_id = FULL_CHANNEL_ID
+        if message_id is None:
+            message_id = rec.get("full_message_id")
+        if not message_id and not cached:
+            raise ValueError("full_message_id missing")
+        started = time.monotonic()
+        calls = 0
+        try:
+            db.inc_view(code)
+            caption = build_combined_caption(rec, code, uid)
+            kb = build_stats_kb(code, uid)
+            sent = False
+            if cached:
+                send = bot.send_document if rec.get("media_type") == "document" else bot.send_video
+                try:
+                    calls += 1
+                    await send(chat_id, cached, caption=caption, reply_markup=kb, protect_content=protect_content)
+                    self.by_file_id += 1
+                    sent = True
+                except TelegramBadRequest as e:
+                    if not message_id:
+                        raise
+                    logging.warning(f"deliver: file_id ishlamadi ({code}): {e}; kanal nusxasiga o'tamiz")
+            if not sent:
+                try:
+                    calls += 1
+                    await bot.copy_message(chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_id,
+                                           caption=caption, reply_markup=kb, protect_content=protect_content)
+                except TelegramBadRequest as e:
+                    if any(x in str(e).lower() for x in self.SOURCE_GONE):
+                        raise
+                    logging.warning(f"deliver: caption bilan nusxa bo'lmadi ({code}): {e}; fallback")
+                    self.fallbacks += 1
+                    calls += 1
+                    await bot.copy_message(chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_id,
+                                           protect_content=protect_content)
+                    calls += 1
+                    await bot.send_message(chat_id, build_stats_text(code, uid), reply_markup=kb)
+        except Exception:
+            self.failed += 1
+            self.api_calls += calls
+            raise
+        elapsed = time.monotonic() - started
+        self.count += 1
+        self.api_calls += calls
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        logging.info(f"deliver: code={code} chat={chat_id} {elapsed * 1000:.0f} ms, {calls} API chaqiruv")
+
+    def metrics_lines(self):
+        attempts = self.count + self.failed
+        avg_calls = self.api_calls / attempts if attempts else 0.0
+        avg_ms = self.total_time / self.count * 1000 if self.count else 0.0
+        return [
+            "🎬 Yetkazish:",
+            f"• muvaffaqiyatli: {self.count} (file_id: {self.by_file_id}) | xato: {self.failed} | fallback: {self.fallbacks}",
+            f"• o'rtacha: {avg_ms:.0f} ms (max {self.max_time * 1000:.0f} ms), {avg_calls:.2f} API chaqiruv",
+        ]
+
+
+delivery = MovieDelivery()
+
+
+def media_ref(msg: types.Message) -> Dict[str, str]:
+    """Xabardagi video/hujjatning file_id lari (bazada saqlash uchun)."""
+    if msg.video:
+        return {"media_type": "video", "file_id": msg.video.file_id, "file_unique_id": msg.video.file_unique_id}
+    if msg.document:
+        return {"media_type": "document", "file_id": msg.document.file_id,
+                "file_unique_id": msg.document.file_unique_id}
+    return {}
+
+
+# Yuklash yo'llari uchun so'rov vaqti chegarasi (s): katta fayl uzatish daqiqalab davom etishi mumkin
+UPLOAD_TIMEOUT = int(os.getenv("UPLOAD_TIMEOUT", "1800") or 1800)
+
+
+class Republisher:
+    """Admin yuborgan faylni kanalga qayta joylash: eng arzon yo'ldan boshlab.
+
+    1) file_id — fayl Telegram ichida qoladi, hech narsa uzatilmaydi (odatiy yo'l);
+    2) local — o'z Bot API serverimiz --local rejimida bo'lsa (BOT_API_LOCAL=1), get_file qaytargan disk
+       yo'li file:// orqali beriladi: server faylni o'z diskidan oladi;
+    3) stream — fayl bo'laklab o'qiladi va shu zahoti yuklanadi (diskka yozilmaydi). Bulutli Bot API da
+       get_file faqat 20 MB gacha ishlaydi, shuning uchun katta fayllar uchun (1) yoki (2) kerak.
+    Qaysi yo'l ishlatilgani kino yozuvida ("upload_path") va metrikada saqlanadi.
+    """
+
+    PATHS = ("file_id", "local", "stream")
+
+    def __init__(self):
+        self.counts = dict.fromkeys(self.PATHS, 0)
+        self.failed = 0
+
+    async def publish(self, chat_id, file_id: str, file_type: str, caption: str,
+                      filename: Optional[str] = None) -> Tuple[types.Message, str]:
+        """(kanal xabari, ishlatilgan yo'l). Hech bir yo'l ishlamasa oxirgi xato ko'tariladi."""
+        send = bot.send_document if file_type == "document" else bot.send_video
+        try:
+            return await send(chat_id, file_id, caption=caption), self._done("file_id")
+        except TelegramBadRequest as e:
+            logging.warning(f"republish: file_id bilan bo'lmadi: {e}; faylni uzatishga o'tamiz")
+        try:
+            tg_file = await bot.get_file(file_id)
+            api = bot.session.api
+            if api.is_local:
+                try:
+                    msg = await send(chat_id, f"file://{tg_file.file_path}", caption=caption,
+                                     request_timeout=UPLOAD_TIMEOUT)
+                    return msg, self._done("local")
+                except TelegramBadRequest as e:
+                    logging.warning(f"republish: lokal yo'l bilan bo'lmadi: {e}; stream ga o'tamiz")
+                # Server bilan bitta diskda bo'lsak faylni o'zimiz o'qib yuboramiz
+                media = FSInputFile(tg_file.file_path, filename=filename)
+            else:
+                media = URLInputFile(api.file_url(bot.token, tg_file.file_path), filename=filename,
+                                     timeout=UPLOAD_TIMEOUT, bot=bot)
+            msg = await send(chat_id, media, caption=caption, request_timeout=UPLOAD_TIMEOUT)
+            return msg, self._done("stream")
+        except Exception:
+            self.failed += 1
+            raise
+
+    def _done(self, path: str) -> str:
+        self.counts[path] += 1
+        logging.info(f"republish: {path} yo'li bilan joylandi")
+        return path
+
+    def metrics_lines(self):
+        paths = " | ".join(f"{p}: {n}" for p, n in self.counts.items())
+        return ["📤 Kanalga joylash:", f"• {paths} | xato: {self.failed}"]
+
+
+republisher = Republisher()
+
+
+# ====== UPLOAD QUEUE ======
+# Kanalga joylash admin handleridan ajratilgan: ishlar faylga yoziladi va fon ishchilari bajaradi
+UPLOAD_JOBS_PATH = Path(os.getenv("UPLOAD_JOBS_PATH", "") or BASE_DIR / "upload_jobs.json")
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "2") or 2)
+UPLOAD_MAX_ATTEMPTS = int(os.getenv("UPLOAD_MAX_ATTEMPTS", "5") or 5)
+UPLOAD_RETRY_BASE = float(os.getenv("UPLOAD_RETRY_BASE", "5") or 5)  # 5, 10, 20, ... s
+UPLOAD_RETRY_MAX = 300.0
+UPLOAD_PROGRESS_EVERY = float(os.getenv("UPLOAD_PROGRESS_EVERY", "5") or 5)  # progress tahriri (s)
+UPLOAD_REPORT_LINES = 40  # progress xabaridagi eng ko'p ish qatori (4096 belgi chegarasi)
+
+
+class UploadQueue:
+    """Kinolarni FULL kanalga joylash ishlari navbati.
+
+    Har ish (admin chati, kod, file_id, metama'lumot) UPLOAD_JOBS_PATH ga yoziladi; UPLOAD_WORKERS ta ishchi
+    ularni republisher orqali bajaradi. Tarmoq xatolarida ish eksponensial kutish bilan qayta
+    urinadi, TelegramBadRequest (fayl yaroqsiz) esa darhol xato deb belgilanadi. Xato ishning kodi
+    hovuzga qaytmaydi — preview kanalda shu kod e'lon qilingan bo'lishi mumkin: admin "qayta urinish"
+    yoki "bekor qilish" (preview posti o'chiriladi, keyin kod bo'shaydi) tugmasini bosguncha ish
+    ``parked`` da saqlanadi. Restartdan keyin tugallanmagan ishlar qayta navbatga qo'yiladi (joylangan,
+    lekin saqlanmay qolgan ish ikkinchi marta joylanishi mumkin). Har admin chatida bitta progress
+    xabari vaqti-vaqti bilan tahrirlanadi; partiya tugagach keyingi ishlar uchun yangi xabar ochiladi.
+
+    ``batch`` li ishlar (ommaviy qo'shish) joylangach darhol bazaga yozilmaydi: natija ish faylida
+    "published" holatida saqlanadi va partiya yopilib, undagi barcha ishlar tugagach bitta
+    db.add_movies bilan bazaga o'tadi. Restartda ochiq partiyalar yopilgan hisoblanadi.
+    """
+
+    def __init__(self, path: Path, workers: int):
+        self.path = path
+        self.workers = max(workers, 1)
+        self.jobs: Dict[str, Dict[str, Any]] = {}   # id -> ish (tugaganlari partiya tugaguncha qoladi)
+        self.parked: Dict[str, Dict[str, Any]] = {}  # id -> xato ish, admin qaroriga qadar kodi band
+        self.progress: Dict[int, int] = {}          # admin chat -> progress xabari id
+        self._dirty: set = set()
+        self._queue: Optional[asyncio.Queue] = None
+        self.open_batches: set = set()
+        self.done = 0
+        self.failed = 0
+        self.retries = 0
+
+    # ---- saqlash ----
+    def _save(self):
+        pending = [j for j in self.jobs.values() if j["state"] != "done"]
+        doc = {"jobs": pending, "parked": list(self.parked.values()),
+               "progress": {str(k): v for k, v in self.progress.items()}}
+        JsonStorage._write(self.path, json.dumps(doc, ensure_ascii=False))
+
+    def _load(self):
+        try:
+            doc = json.loads(self.path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logging.warning(f"upload: navbat fayli o'qilmadi ({self.path.name}): {e}")
+            return
+        for job in doc.get("jobs", []):
+            if job["state"] == "failed":
+                self.parked[job["id"]] = job
+                continue
+            self.jobs[job["id"]] = job
+            self._dirty.add(job["chat"])
+        for job in doc.get("parked", []):
+            self.parked[job["id"]] = job
+        self.progress = {int(k): v for k, v in (doc.get("progress") or {}).items()}
+
+    # ---- navbat ----
+    def start(self):
+        """on_startup dan: saqlangan ishlarni tiklash, ishchilar va progress tsiklini ishga tushirish."""
+        self._queue = asyncio.Queue()
+        self._load()
+        now = time.time()
+        for job in self.parked.values():
+            code_alloc.hold(job["code"])
+        for job in self.jobs.values():
+            code_alloc.hold(job["code"])
+            if job["state"] != "published":
+                self._schedule(job, max(job.get("next_try", 0) - now, 0))
+        # Restartgacha joylanib, bazaga yozilmay qolgan partiya natijalari
+        for batch in {j["batch"] for j in self.jobs.values() if j.get("batch")}:
+            self._commit_batch(batch)
+        for _ in range(self.workers):
+            spawn(self._worker())
+        spawn(self._progress_loop())
+        if self.jobs:
+            logging.info(f"upload: {len(self.jobs)} ta tugallanmagan ish navbatga qaytarildi")
+
+    def submit(self, chat_id: int, code: str, data: Mapping[str, Any],
+               batch: Optional[str] = None) -> Dict[str, Any]:
+        job = {
+            "id": f"{code}-{int(time.time() * 1000)}", "chat": chat_id, "code": code,
+            "file_id": data["file_id"], "file_type": data.get("file_type", "video"),
+            "filename": data.get("filename"),
+            "meta": {k: data.get(k, "-") for k in MOVIE_META_FIELDS},
+            "state": "queued", "attempts": 0, "next_try": 0, "error": None,
+        }
+        if batch:
+            job["batch"] = batch
+            self.open_batches.add(batch)
+        self.jobs[job["id"]] = job
+        self._save()
+        self._schedule(job, 0)
+        return job
+
+    def _schedule(self, job: Dict[str, Any], delay: float):
+        self._dirty.add(job["chat"])
+        if delay <= 0:
+            self._queue.put_nowait(job)
+        else:
+            asyncio.get_running_loop().call_later(delay, self._queue.put_nowait, job)
+
+    def pending_job(self, code: str) -> Optional[Dict[str, Any]]:
+        """Kod bo'yicha hal qilinmagan ish: navbatdagi, jarayondagi yoki xato bo'lib admin qarorini kutayotgan."""
+        for job in (*self.jobs.values(), *self.parked.values()):
+            if job["code"] == code and job["state"] != "done":
+                return job
+        return None
+
+    def close_batch(self, batch: str):
+        """Partiyaga yangi ish qo'shilmaydi: tugagan bo'lsa natijalar darhol bazaga yoziladi."""
+        self.open_batches.discard(batch)
+        self._commit_batch(batch)
+
+    def _commit_batch(self, batch: str):
+        if batch in self.open_batches:
+            return
+        jobs = [j for j in self.jobs.values() if j.get("batch") == batch]
+        if any(j["state"] in ("queued", "running", "retry") for j in jobs):
+            return
+        published = [j for j in jobs if j["state"] == "published"]
+        if not published:
+            return
+        # N ta alohida saqlash o'rniga bitta yozuv (bitta tranzaksiya / jurnal yozuvi)
+        db.add_movies({j["code"]: {**j["record"], "preview_message_id": j.get("preview_message_id")}
+                       for j in published})
+        for j in published:
+            del j["record"]
+            j["state"] = "done"
+            self._dirty.add(j["chat"])
+        self.done += len(published)
+        self._save()
+        logging.info(f"upload: {batch} partiyasidan {len(published)} ta kino bazaga yozildi")
+
+    def _get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return self.jobs.get(job_id) or self.parked.get(job_id)
+
+    def retry(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Xato ishni (kodi o'zgarmagan holda) navbatga qaytaradi; ish topilmasa yoki xato bo'lmasa None."""
+        job = self._get(job_id)
+        if job is None or job["state"] != "failed":
+            return None
+        self.parked.pop(job_id, None)
+        self.jobs[job_id] = job
+        job.update(state="queued", attempts=0, next_try=0, error=None)
+        self._save()
+        self._schedule(job, 0)
+        return job
+
+    async def drop(self, job_id: str) -> str:
+        """Xato ishni bekor qilish: avval preview posti o'chiriladi, shundan keyingina kod hovuzga qaytadi."""
+        job = self._get(job_id)
+        if job is None or job["state"] != "failed":
+            return "Ish topilmadi yoki allaqachon hal qilingan."
+        mid = job.get("preview_message_id")
+        if mid:
+            try:
+                await bot.delete_message(PREVIEW_CHANNEL_ID, mid)
+            except Exception as e:
+                logging.warning(f"upload: {job['code']} preview posti o'chirilmadi: {e}")
+                return (f"⚠️ Preview posti o'chirilmadi ({html.escape(str(e)[:200])}). "
+                        f"Kod {job['code']} band qoldi; postni qo'lda o'chirib qayta bosing.")
+        self.parked.pop(job_id, None)
+        self.jobs.pop(job_id, None)
+        code_alloc.release(job["code"])
+        self._dirty.add(job["chat"])
+        self._save()
+        return f"🗑 «{html.escape(str(job['meta'].get('name', '?')))}» bekor qilindi, kod {job['code']} bo'shatildi."
+
+    # ---- ishchi ----
+    async def _worker(self):
+        outbound_priority.set(PRIORITY_BACKGROUND)
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._process(job)
+            except Exception as e:
+                logging.exception(f"upload: {job['code']} ishida kutilmagan xato: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _process(self, job: Dict[str, Any]):
+        meta = job["meta"]
+        job["state"] = "running"
+        job["attempts"] += 1
+        self._dirty.add(job["chat"])
+        caption = full_caption(code=job["code"], **{k: meta.get(k, "-") for k in MOVIE_META_FIELDS})
+        try:
+            sent, upload_path = await republisher.publish(
+                FULL_CHANNEL_ID, job["file_id"], job["file_type"], caption, filename=job.get("filename"))
+        except TelegramBadRequest as e:
+            self._fail(job, e)
+            return
+        except Exception as e:
+            if job["attempts"] >= UPLOAD_MAX_ATTEMPTS:
+                self._fail(job, e)
+                return
+            delay = min(UPLOAD_RETRY_BASE * 2 ** (job["attempts"] - 1), UPLOAD_RETRY_MAX)
+            job.update(state="retry", error=str(e)[:200], next_try=time.time() + delay)
+            self.retries += 1
+            logging.warning(f"upload: {job['code']} {job['attempts']}-urinish xato: {e}; {delay:.0f} s dan keyin")
+            self._save()
+            self._schedule(job, delay)
+            return
+        # Statistika maydonlari DB.add_movie ichida to'ldiriladi
+        record = {
+            **meta,
+            "full_message_id": sent.message_id,
+            "preview_message_id": job.get("preview_message_id"),
+            "upload_path": upload_path,
+            **media_ref(sent),
+        }
+        if job.get("batch"):
+            # Natija avval ish fayliga: restartda yo'qolmaydi, bazaga partiya bilan birga yoziladi
+            job.update(state="published", error=None, upload_path=upload_path, record=record)
+            self._dirty.add(job["chat"])
+            self._save()
+            self._commit_batch(job["batch"])
+            return
+        db.add_movie(job["code"], record)
+        job.update(state="done", error=None, upload_path=upload_path)
+        self.done += 1
+        self._dirty.add(job["chat"])
+        self._save()
+
+    def _fail(self, job: Dict[str, Any], err: Exception):
+        job.update(state="failed", error=str(err)[:200])
+        self.failed += 1
+        # Kod hovuzga qaytmaydi: preview allaqachon shu kodni e'lon qilgan bo'lishi mumkin
+        logging.error(f"upload: {job['code']} joylanmadi: {err}")
+        self._dirty.add(job["chat"])
+        self._save()
+        spawn(self.notify_failed(job))
+
+    @staticmethod
+    def failed_kb(job: Dict[str, Any]) -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text="🔁 Qayta urinish", callback_data=f"upq:retry:{job['id']}"),
+            InlineKeyboardButton(text="🗑 Bekor qilish", callback_data=f"upq:drop:{job['id']}"),
+        ]])
+
+    async def notify_failed(self, job: Dict[str, Any]):
+        """Adminga xato haqida alohida xabar (tugmalar bilan); progress xabari partiya tugagach yopiladi."""
+        text = (f"❌ «{html.escape(str(job['meta'].get('name', '?')))}» (kod {job['code']}) kanalga joylanmadi:\n"
+                f"{html.escape(job['error'] or '?')}\n\nKod band qoldi.")
+        if job.get("preview_message_id"):
+            text += " Preview kanalda shu kod bilan post bor — bekor qilinsa u o'chiriladi."
+        try:
+            await bot.send_message(job["chat"], text, reply_markup=self.failed_kb(job))
+        except Exception as e:
+            logging.info(f"upload: xato haqida xabar yuborilmadi: {e}")
+
+    # ---- progress ----
+    _ICONS = {"queued": "🕒", "running": "⏳", "retry": "🔁", "published": "📥", "done": "✅", "failed": "❌"}
+
+    def progress_text(self, chat_id: int) -> str:
+        jobs = [j for j in self.jobs.values() if j["chat"] == chat_id]
+        finished = sum(j["state"] in ("done", "failed") for j in jobs)
+        lines = [f"📤 Kanalga joylash: {finished}/{len(jobs)}"]
+        if len(jobs) > UPLOAD_REPORT_LINES:
+            # Eng qiziqlari qoladi: avval xatolar va tugallanmaganlar
+            order = {"failed": 0, "retry": 1, "running": 2, "queued": 3, "published": 4, "done": 5}
+            hidden = len(jobs) - UPLOAD_REPORT_LINES
+            jobs = sorted(jobs, key=lambda j: order[j["state"]])[:UPLOAD_REPORT_LINES]
+        else:
+            hidden = 0
+        for j in jobs:
+            line = f"{self._ICONS[j['state']]} {html.escape(str(j['meta'].get('name', '?')))} — kod {j['code']}"
+            if j["state"] == "done":
+                line += f" ({j.get('upload_path')})"
+            elif j["state"] == "running" and j["attempts"] > 1:
+                line += f" ({j['attempts']}-urinish)"
+            elif j["state"] == "retry":
+                line += f" (qayta: ~{max(j['next_try'] - time.time(), 0):.0f} s)"
+            elif j["state"] == "failed":
+                line += f"\n    xato: {html.escape(j['error'] or '?')}"
+            lines.append(line)
+        if hidden:
+            lines.append(f"… va yana {hidden} ta")
+        return "\n".join(lines)
+
+    async def _render(self, chat_id: int):
+        text = self.progress_text(chat_id)
+        mid = self.progress.get(chat_id)
+        try:
+            if mid:
+                await bot.edit_message_text(text, chat_id=chat_id, message_id=mid)
+            else:
+                msg = await bot.send_message(chat_id, text)
+                self.progress[chat_id] = msg.message_id
+        except TelegramBadRequest as e:
+            if "not modified" not in str(e):
+                logging.info(f"upload: progress xabari yangilanmadi: {e}")
+        except Exception as e:
+            logging.info(f"upload: progress xabari yangilanmadi: {e}")
+            return
+        if all(j["state"] in ("done", "failed") for j in self.jobs.values() if j["chat"] == chat_id):
+            # Partiya tugadi: keyingi ishlar yangi progress xabarini oladi; xatolar admin qarorini kutadi
+            for jid in [jid for jid, j in self.jobs.items() if j["chat"] == chat_id]:
+                job = self.jobs.pop(jid)
+                if job["state"] == "failed":
+                    self.parked[jid] = job
+            self.progress.pop(chat_id, None)
+        self._save()
+
+    async def _progress_loop(self):
+        outbound_priority.set(PRIORITY_EDIT)
+        while True:
+            await asyncio.sleep(UPLOAD_PROGRESS_EVERY)
+            dirty, self._dirty = self._dirty, set()
+            for chat_id in dirty:
+                await self._render(chat_id)
+
+    def metrics_lines(self):
+        states = Counter(j["state"] for j in self.jobs.values())
+        return [
+            "📤 Yuklash navbati:",
+            f"• navbatda: {states['queued']} | jarayonda: {states['running']} | qayta: {states['retry']}"
+            f" | saqlashni kutmoqda: {states['published']}",
+            f"• tayyor: {self.done} | xato: {self.failed} | qayta urinishlar: {self.retries}",
+            f"• qaror kutayotgan xatolar: {len(self.parked)}",
+        ]
+
+
+upload_queue = UploadQueue(UPLOAD_JOBS_PATH, UPLOAD_WORKERS)
+
+
+async def attach_preview(code: str, message_id: int) -> Optional[str]:
+    """Preview kanal xabarini kinoga bog'lash; kino hali navbatda bo'lsa, ish tugaganda yoziladi.
+
+    Adminga ko'rsatiladigan ogohlantirish qaytaradi (hammasi joyida bo'lsa None): ish xato bo'lgan
+    bo'lsa — preview unga bog'lanadi va xato xabari qayta yuboriladi; ish ham, kino ham yo'q bo'lsa —
+    kod band emas, shuning uchun preview posti kanaldan o'chiriladi.
+    """
+    if db.get_movie(code):
+        db.update_movie(code, {"preview_message_id": message_id})
+        return None
+    job = upload_queue.pending_job(code)
+    if job is not None:
+        job["preview_message_id"] = message_id
+        upload_queue._save()
+        if job["state"] == "failed":
+            spawn(upload_queue.notify_failed(job))
+            return "⚠️ Preview joylandi, lekin kino kanalga joylanmagan — quyidagi xabardan qayta urining yoki bekor qiling."
+        return None
+    logging.error(f"upload: {code} uchun preview keldi, lekin kino ham, navbat ishi ham yo'q")
+    try:
+        await bot.delete_message(PREVIEW_CHANNEL_ID, message_id)
+    except Exception as e:
+        logging.warning(f"upload: {code} yetim preview posti o'chirilmadi: {e}")
+        return f"⚠️ Kod {code} bo'yicha kino topilmadi. Preview postini kanaldan qo'lda o'chiring!"
+    return f"⚠️ Kod {code} bo'yicha kino topilmadi (yuklash bekor qilingan) — preview posti o'chirildi."
+
+
+# ====== BULK INGEST ======
+# Albom (media group) yoki forward qilingan postlar to'plami: har bir video/hujjat alohida kino bo'ladi
+BULK_WAIT = float(os.getenv("BULK_WAIT", "2") or 2)  # shuncha jimlikdan keyin partiya yopiladi (s)
+
+# Caption dagi "Kalit: qiymat" qatorlari (full_caption formati ham) -> kino maydoni
+_CAPTION_KEYS = {
+    "nomi": "name", "nom": "name", "name": "name", "kino": "name", "film": "name",
+    "yil": "year", "yili": "year", "year": "year",
+    "janr": "genre", "janri": "genre", "genre": "genre",
+    "davlat": "country", "davlati": "country", "country": "country",
+    "imdb": "imdb", "imbd": "imdb",
+    "sifat": "quality", "sifati": "quality", "quality": "quality",
+    "til": "language", "tili": "language", "language": "language",
+    "davomiylik": "duration", "davomiyligi": "duration", "duration": "duration",
+}
+_CAPTION_TITLE_RE = re.compile(r'^["“«]?(?P<name>.*?)["”»]?\s*(?:\[(?P<year>\d{4})\])?$')
+_YEAR_RE = re.compile(r"\b(?:19|20)\d{2}\b")
+_LEADING_JUNK_RE = re.compile(r"^[\W_]+")
+_TRAILING_YEAR_RE = re.compile(r"[\s|/,.\-–—]*[(\[]?(?:19|20)\d{2}[)\]]?\s*$")
+
+
+def parse_movie_caption(text: Optional[str]) -> Dict[str, str]:
+    """Post captionidan metama'lumot. Kalitsiz qator (masalan, '🎬: "Nom" [2020]') nom va yil beradi;
+    bunday qator bo'lmasa birinchi oddiy qator nom, yil esa matndagi birinchi 19xx/20xx."""
+    meta: Dict[str, str] = {}
+    plain = []
+    for line in (text or "").splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        key, sep, value = line.partition(":")
+        value = value.strip()
+        letters = re.sub(r"[^a-z]", "", key.casefold())
+        if sep and letters in _CAPTION_KEYS and value:
+            meta.setdefault(_CAPTION_KEYS[letters], value)
+        elif sep and not letters and value and "name" not in meta:
+            m = _CAPTION_TITLE_RE.match(value)
+            meta["name"] = m.group("name").strip() or value
+            if m.group("year"):
+                meta.setdefault("year", m.group("year"))
+        elif not sep or letters not in _CAPTION_KEYS:
+            plain.append(_LEADING_JUNK_RE.sub("", line))
+    if "name" not in meta and plain and plain[0]:
+        meta["name"] = _TRAILING_YEAR_RE.sub("", plain[0]) or plain[0]
+    if "year" not in meta:
+        y = _YEAR_RE.search(text or "")
+        if y:
+            meta["year"] = y.group(0)
+    return meta
+
+
+def _bulk_media(m: types.Message) -> Optional[Tuple[str, str, Optional[str]]]:
+    """(file_id, file_type, fayl nomi) — faqat video yoki video-hujjat."""
+    if m.video:
+        return m.video.file_id, "video", m.video.file_name
+    doc = m.document
+    if doc and ((doc.mime_type or "").lower().startswith("video/")
+                or (doc.file_name or "").lower().endswith((".mp4", ".mkv", ".avi", ".mov"))):
+        return doc.file_id, "document", doc.file_name
+    return None
+
+
+class BulkIngest:
+    """Admin albomi yoki /bulk rejimidagi fayllarni upload_queue partiyasiga aylantiradi.
+
+    Har fayl kelishi bilan gen_code dan kod oladi, metama'lumot captiondan olinadi va darhol
+    UploadQueue ishi sifatida faylga yoziladi — kanalga joylash, qayta urinishlar va progress xabari
+    navbatniki (parallellik UPLOAD_WORKERS bilan cheklangan). Partiya BULK_WAIT soniya jimlikdan
+    keyin (yoki /done da) yopiladi va joylangan yozuvlar bitta db.add_movies bilan saqlanadi.
+    """
+
+    def __init__(self, wait: float):
+        self.wait = wait
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self.counts: Counter = Counter()   # partiya -> navbatga qo'yilgan fayllar
+        self.queued = 0
+        self.skipped = 0
+
+    def add(self, m: types.Message, batch: str) -> Optional[Dict[str, Any]]:
+        """Faylni partiyaga qo'shadi; video bo'lmasa None."""
+        media = _bulk_media(m)
+        if media is None:
+            self.skipped += 1
+            return None
+        file_id, file_type, filename = media
+        meta = parse_movie_caption(m.caption)
+        if not meta.get("name"):
+            meta["name"] = Path(filename).stem if filename else "Kino"
+        job = upload_queue.submit(m.chat.id, gen_code(), {
+            **meta, "file_id": file_id, "file_type": file_type, "filename": filename,
+        }, batch=batch)
+        self.counts[batch] += 1
+        self.queued += 1
+        timer = self._timers.pop(batch, None)
+        if timer is not None:
+            timer.cancel()
+        self._timers[batch] = asyncio.get_running_loop().call_later(self.wait, self.close, batch)
+        return job
+
+    def close(self, batch: str) -> int:
+        """Partiyani yopadi; unga qo'shilgan fayllar sonini qaytaradi."""
+        timer = self._timers.pop(batch, None)
+        if timer is not None:
+            timer.cancel()
+        upload_queue.close_batch(batch)
+        return self.counts.pop(batch, 0)
+
+    def metrics_lines(self):
+        return [f"📦 Ommaviy qo'shish: navbatga {self.queued} ta | video emas: {self.skipped} | ochiq partiyalar: {len(self._timers)}"]
+
+
+bulk_ingest = BulkIngest(BULK_WAIT)
+
+
+async def probe_channel_message(from_chat_id, message_id: int) -> types.Message:
+    """Kanal xabarini SCRATCH_CHAT_ID ga forward qilib, darhol o'chiradi.
+
+    Xabar mavjudligini tekshirish va undagi file_id ni olishning arzon usuli.
+    Xabar yo'q bo'lsa TelegramBadRequest ko'tariladi.
+    """
+    fwd = await bot.forward_message(chat_id=SCRATCH_CHAT_ID, from_chat_id=from_chat_id,
+                                    message_id=message_id, disable_notification=True)
+    try:
+        await bot.delete_message(SCRATCH_CHAT_ID, fwd.message_id)
+    except TelegramBadRequest as e:
+        logging.warning(f"probe: scratch xabarini o'chirib bo'lmadi: {e}")
+    return fwd
+
+
+async def backfill_file_ids() -> int:
+    """file_id si yo'q kinolar uchun FULL kanal xabaridan file_id ni yig'adi (fon vazifa)."""
+    if not SCRATCH_CHAT_ID:
+        return 0
+    outbound_priority.set(PRIORITY_BACKGROUND)
+    filled = 0
+    for code, rec in list(db.movies.items()):
+        if rec.get("file_id") or rec.get("broken") or not rec.get("full_message_id"):
+            continue
+        try:
+            ref = media_ref(await probe_channel_message(FULL_CHANNEL_ID, rec["full_message_id"]))
+        except Exception as e:
+            logging.warning(f"backfill: {code} uchun file_id olinmadi: {e}")
+            continue
+        if ref:
+            db.update_movie(code, ref)
+            filled += 1
+    logging.info(f"backfill: {filled} ta kino uchun file_id saqlandi")
+    return filled
+
+
+# Fon vazifalarga kuchli havola (aks holda GC ularni yig'ib yuborishi mumkin)
+_background_tasks: set = set()
+
+def spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+# ====== CHANNEL HEALTH ======
+# Kanal xabarlarini fon rejimida tekshirish (SCRATCH_CHAT_ID kerak)
+HEALTH_RECHECK_AFTER = float(os.getenv("HEALTH_RECHECK_AFTER", str(24 * 3600)) or 24 * 3600)
+HEALTH_PROBE_DELAY = float(os.getenv("HEALTH_PROBE_DELAY", "2") or 2)  # tekshiruvlar orasidagi pauza (s)
+HEALTH_PREFETCH = int(os.getenv("HEALTH_PREFETCH", "3") or 3)
+HEALTH_ERROR_PAUSE = float(os.getenv("HEALTH_ERROR_PAUSE", "600") or 600)  # ketma-ket xatolarda eng uzun pauza (s)
+
+
+class ChannelHealth:
+    """Har bir kinoning kanal xabari tirikligini fon rejimida tekshiradi.
+
+    Natija kino yozuvida saqlanadi: rec["health"] = {"state": "ok"|"dead", "source": ..., "ts": ...}.
+    DB indekslari shu holatga qarab yangilanadi: random faqat "ok" kinolarni tanlaydi; keyingi ehtimoliy
+    nomzodlar prefetch() orqali navbatning boshiga qo'yiladi.
+
+    "dead" faqat barcha manbalar MovieDelivery.SOURCE_GONE xatosini bersa qo'yiladi. Boshqa xatolar
+    (scratch chat topilmadi, huquq yo'q, tarmoq) tekshiruv muvaffaqiyatsiz deb hisoblanadi: holat
+    o'zgarmaydi, keyingi tekshiruvlar orasidagi pauza esa HEALTH_ERROR_PAUSE gacha uzayadi.
+    """
+
+    def __init__(self, recheck_after: float, delay: float):
+        self.recheck_after = recheck_after
+        self.delay = delay
+        self._urgent: deque = deque()
+        self._wake: Optional[asyncio.Event] = None
+        self.probes = 0
+        self.alive = 0
+        self.dead = 0
+        self.errors = 0
+        self._error_streak = 0
+
+    @staticmethod
+    def state(rec: Dict[str, Any]) -> Optional[str]:
+        return (rec.get("health") or {}).get("state")
+
+    def _stale(self, rec: Dict[str, Any], now: float) -> bool:
+        return now - float((rec.get("health") or {}).get("ts", 0)) >= self.recheck_after
+
+    async def probe(self, code: str) -> Optional[bool]:
+        """True — tirik, False — o'lik, None — tekshirib bo'lmadi (holat o'zgartirilmaydi)."""
+        rec = db.get_movie(code)
+        if not rec:
+            return False
+        sources = []
+        if rec.get("full_message_id"):
+            sources.append(("full", FULL_CHANNEL_ID, rec["full_message_id"]))
+        if rec.get("preview_message_id"):
+            sources.append(("preview", PREVIEW_CHANNEL_ID, rec["preview_message_id"]))
+        fields: Dict[str, Any] = {"health": {"state": "dead", "ts": int(time.time())}}
+        failed = None
+        for label, chat, mid in sources:
+            self.probes += 1
+            try:
+                msg = await probe_channel_message(chat, mid)
+            except TelegramBadRequest as e:
+                if any(x in str(e).lower() for x in MovieDelivery.SOURCE_GONE):
+                    logging.info(f"health: {code} {label} xabari topilmadi: {e}")
+                    continue
+                failed = e
+                continue
+            except Exception as e:
+                failed = e
+                continue
+            fields["health"].update(state="ok", source=label)
+            if label == "full" and not rec.get("file_id"):
+                fields.update(media_ref(msg))
+            break
+        ok = fields["health"]["state"] == "ok"
+        if not ok and failed is not None:
+            # Manba o'chgani isbotlanmadi (masalan, scratch chat xatosi) — holatni o'zgartirmaymiz
+            self.errors += 1
+            logging.warning(f"health: {code} tekshirilmadi, holat o'zgarmadi: {failed}")
+            return None
+        if ok:
+            self.alive += 1
+        else:
+            self.dead += 1
+            logging.warning(f"health: {code} uchun tirik kanal xabari yo'q")
+        db.update_movie(code, fields)
+        return ok
+
+    def prefetch(self, codes):
+        """Yaqinda random tanlashi mumkin bo'lgan kinolarni navbatsiz tekshirish."""
+        now = time.time()
+        for code in codes:
+            rec = db.get_movie(code)
+            if rec and (self.state(rec) is None or self._stale(rec, now)) and code not in self._urgent:
+                self._urgent.append(code)
+        if self._urgent and self._wake is not None:
+            self._wake.set()
+
+    def _stale_codes(self):
+        now = time.time()
+        # Hali tekshirilmaganlar birinchi
+        codes = [c for c, r in db.movies.items() if not r.get("broken") and self._stale(r, now)]
+        codes.sort(key=lambda c: (db.movies[c].get("health") or {}).get("ts", 0))
+        return codes
+
+    async def run(self):
+        outbound_priority.set(PRIORITY_BACKGROUND)
+        self._wake = asyncio.Event()
+        scan = deque()
+        while True:
+            if self._urgent:
+                code = self._urgent.popleft()
+            elif scan:
+                code = scan.popleft()
+            else:
+                scan.extend(self._stale_codes())
+                if not scan:
+                    self._wake.clear()
+                    try:
+                        await asyncio.wait_for(self._wake.wait(), timeout=min(self.recheck_after, 3600))
+                    except asyncio.TimeoutError:
+                        pass
+                continue
+            rec = db.get_movie(code)
+            if not rec or (self.state(rec) is not None and not self._stale(rec, time.time())):
+                continue
+            try:
+                result = await self.probe(code)
+            except Exception as e:
+                logging.warning(f"health: {code} tekshiruvida xato: {e}")
+                result = None
+            self._error_streak = self._error_streak + 1 if result is None else 0
+            pause = self.delay * 2 ** min(self._error_streak, 10) if self._error_streak else self.delay
+            await asyncio.sleep(min(pause, max(HEALTH_ERROR_PAUSE, self.delay)))
+
+    def metrics_lines(self):
+        states = [self.state(r) for r in db.movies.values()]
+        return [
+            "🩺 Kanal tekshiruvi:",
+            f"• ok: {states.count('ok')} | dead: {states.count('dead')} | tekshirilmagan: {states.count(None)}",
+            f"• probe: {self.probes} (tirik {self.alive}, o'lik {self.dead}, xato {self.errors}) | navbat: {len(self._urgent)}",
+        ]
+
+
+health = ChannelHealth(HEALTH_RECHECK_AFTER, HEALTH_PROBE_DELAY)
+
+
+async def _random_history_flusher():
+    while True:
+        await asyncio.sleep(RANDOM_HISTORY_FLUSH)
+        db.flush_random_history()
+
+
+async def _channel_maintenance():
+    # Avval file_id larni yig'amiz, keyin doimiy tekshiruv (bir vaqtda ikki marta probe qilmaslik uchun)
+    await backfill_file_ids()
+    await health.run()
+
+# ====== BROADCAST ======
+# Adminlar uchun ommaviy xabar: tezlik cheklangan, restartdan keyin checkpointdan davom etadi
+BROADCAST_PATH = Path(os.getenv("BROADCAST_PATH", "") or BASE_DIR / "broadcast.json")
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "20") or 20)  # xabar/soniya (global limitdan pastroq)
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8") or 8)
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", "50") or 50)  # har partiyadan keyin checkpoint
+BROADCAST_PROGRESS_EVERY = float(os.getenv("BROADCAST_PROGRESS_EVERY", "5") or 5)  # progress tahriri (s)
+BROADCAST_MAX_TRIES = 3
+
+BROADCAST_SEGMENTS = {
+    "all": "Hammaga",
+    "users": "Oddiy foydalanuvchilarga",
+    "fav": "Sevimlilari borlarga",
+}
+
+
+def _fmt_secs(sec: float) -> str:
+    m, s = divmod(int(sec), 60)
+    h, m = divmod(m, 60)
+    return f"{h}:{m:02d}:{s:02d}" if h else f"{m}:{s:02d}"
+
+
+class Broadcaster:
+    """Admin xabarini segmentdagi barcha foydalanuvchilarga copy_message bilan yuboradi.
+
+    Foydalanuvchilar uid bo'yicha tartiblanib partiyalarda yuboriladi; har partiyadan keyin BROADCAST_PATH ga
+    checkpoint yoziladi (cursor = oxirgi ishlangan uid + hisoblagichlar), shuning uchun restartdan keyin ish
+    cursor dan davom etadi (uzilgan partiya qayta yuboriladi, ya'ni takror ko'pi bilan BROADCAST_BATCH ta).
+    Botni bloklaganlar blocked bayrog'i bilan belgilanadi va keyingi tarqatishlarga
+    kirmaydi. Bir vaqtda faqat bitta ish bo'ladi.
+    """
+
+    def __init__(self, path: Path, rate: float, concurrency: int, batch: int):
+        self.path = path
+        self.bucket = TokenBucket(rate, max(rate, 1))
+        self.concurrency = max(concurrency, 1)
+        self.batch = max(batch, 1)
+        self.job: Optional[Dict[str, Any]] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stop = False
+        self._edited = 0.0
+        self._run_started = 0.0
+        self._run_done0 = 0
+        self.jobs_done = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @staticmethod
+    def audience(segment: str) -> array:
+        """Segmentdagi (bloklamagan) foydalanuvchilar, uid bo'yicha tartiblangan."""
+        uids = []
+        for uid, u in db.users.items():
+            if u.get("blocked"):
+                continue
+            if segment == "users" and db.is_admin(uid):
+                continue
+            if segment == "fav" and not (u.fav or u.fav_x):
+                continue
+            uids.append(uid)
+        uids.sort()
+        return array("q", uids)
+
+    @staticmethod
+    def _done(job: Dict[str, Any]) -> int:
+        return job["sent"] + job["failed"] + job["blocked"]
+
+    def _save(self):
+        JsonStorage._write(self.path, json.dumps(self.job, ensure_ascii=False))
+
+    def _load(self) -> Optional[Dict[str, Any]]:
+        try:
+            return json.loads(self.path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(f"broadcast: checkpoint o'qilmadi ({self.path.name}): {e}")
+            return None
+
+    def start(self, admin_chat: int, from_chat_id: int, message_id: int, segment: str) -> Dict[str, Any]:
+        if self.running:
+            raise RuntimeError("broadcast allaqachon ishlayapti")
+        self.job = {
+            "admin_chat": admin_chat, "from_chat_id": from_chat_id, "message_id": message_id,
+            "segment": segment, "cursor": None, "total": len(self.audience(segment)),
+            "sent": 0, "failed": 0, "blocked": 0, "started": time.time(), "progress_msg": None,
+        }
+        self._save()
+        self._task = spawn(self._run())
+        return self.job
+
+    def resume(self) -> bool:
+        """Tugallanmagan checkpoint bo'lsa ishni davom ettiradi (on_startup dan)."""
+        job = self._load()
+        if not job or self.running:
+            return False
+        self.job = job
+        logging.info(f"broadcast: checkpointdan davom etilmoqda ({self._done(job)}/{job['total']})")
+        self._task = spawn(self._run())
+        return True
+
+    def stop(self):
+        self._stop = True
+
+    async def _send(self, uid: int, sem: asyncio.Semaphore) -> str:
+        job = self.job
+        async with sem:
+            for _ in range(BROADCAST_MAX_TRIES):
+                while (wait := self.bucket.delay(time.monotonic())) > 0:
+                    await asyncio.sleep(wait)
+                self.bucket.take(time.monotonic())
+                try:
+                    await bot.copy_message(uid, job["from_chat_id"], job["message_id"])
+                    return "sent"
+                except TelegramForbiddenError:
+                    db.set_blocked(uid, True)
+                    return "blocked"
+                except TelegramRetryAfter as e:
+                    # Scheduler qayta urinishlari tugagan: butun tarqatishni to'xtatib turamiz
+                    self.bucket.blocked_until = time.monotonic() + e.retry_after
+                except TelegramBadRequest as e:
+                    if "chat not found" in str(e).lower():
+                        db.set_blocked(uid, True)
+                        return "blocked"
+                    logging.info(f"broadcast: {uid} ga yuborilmadi: {e}")
+                    return "failed"
+                except Exception as e:
+                    logging.warning(f"broadcast: {uid} ga yuborishda xato: {e}")
+                    return "failed"
+            return "failed"
+
+    def progress_text(self, final: bool = False) -> str:
+        job = self.job
+        done = self._done(job)
+        total = max(job["total"], done)
+        pct = done * 100 // total if total else 100
+        seg = BROADCAST_SEGMENTS.get(job["segment"], job["segment"])
+        if final:
+            head = "⏹ Tarqatish to'xtatildi" if self._stop else "✅ Tarqatish tugadi"
+        else:
+            head = "📢 Tarqatish davom etmoqda"
+        lines = [
+            f"{head} ({seg})",
+            f"• {done}/{total} ({pct}%)",
+            f"• yuborildi: {job['sent']} | bloklagan: {job['blocked']} | xato: {job['failed']}",
+        ]
+        if final:
+            lines.append(f"• davomiyligi: {_fmt_secs(time.time() - job['started'])}")
+        else:
+            # ETA faqat shu ishga tushishdagi tezlik bo'yicha (restartdagi tanaffus hisobga kirmaydi)
+            elapsed = time.monotonic() - self._run_started
+            speed = (done - self._run_done0) / elapsed if elapsed > 0 else 0.0
+            eta = _fmt_secs((total - done) / speed) if speed > 0 else "—"
+            lines.append(f"• tezlik: {speed:.1f}/s | qoldi: ~{eta}")
+        return "\n".join(lines)
+
+    async def _progress(self, force: bool = False, final: bool = False):
+        now = time.monotonic()
+        if not force and now - self._edited < BROADCAST_PROGRESS_EVERY:
+            return
+        self._edited = now
+        job = self.job
+        kb = None if final else InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="⏹ To'xtatish", callback_data="bc:stop")]
+        ])
+        text = self.progress_text(final)
+        try:
+            if job.get("progress_msg"):
+                await bot.edit_message_text(text, chat_id=job["admin_chat"], message_id=job["progress_msg"],
+                                            reply_markup=kb)
+                return
+        except TelegramBadRequest as e:
+            if "not modified" in str(e):
+                return
+            logging.info(f"broadcast: progress xabari tahrirlanmadi: {e}")
+        except Exception as e:
+            logging.info(f"broadcast: progress xabari tahrirlanmadi: {e}")
             return
-        hist = list(u.get("rand_hist", []))
-        if code in hist:
-            hist.remove(code)
-        hist.append(code)
-        if len(hist) > max_len:
-            hist = hist[-max_len:]
-        u["rand_hist"] = hist
-        self.users[uid] = u
-        self.save_users()
+        try:
+            msg = await bot.send_message(job["admin_chat"], text, reply_markup=kb)
+            job["progress_msg"] = msg.message_id
+        except Exception as e:
+            logging.warning(f"broadcast: progress xabari yuborilmadi: {e}")
 
-    def clear_random_history(self, uid: int):
-        u = self.get_user(uid)
-        if not u:
-            return
-        u["rand_hist"] = []
-        self.users[uid] = u
-        self.save_users()
+    async def _run(self):
+        outbound_priority.set(PRIORITY_BACKGROUND)
+        job = self.job
+        self._stop = False
+        uids = self.audience(job["segment"])
+        start = 0 if job["cursor"] is None else bisect.bisect_right(uids, job["cursor"])
+        # Restartdan keyin segment o'zgargan bo'lishi mumkin: jami = bajarilgan + qolgan
+        job["total"] = self._done(job) + len(uids) - start
+        self._run_started = time.monotonic()
+        self._run_done0 = self._done(job)
+        await self._progress(force=True)
+        sem = asyncio.Semaphore(self.concurrency)
+        for i in range(start, len(uids), self.batch):
+            if self._stop:
+                break
+            chunk = uids[i:i + self.batch]
+            for res in await asyncio.gather(*(self._send(uid, sem) for uid in chunk)):
+                job[res] += 1
+            job["cursor"] = chunk[-1]
+            self._save()
+            await self._progress()
+        # Normal tugash yoki admin to'xtatishi: checkpoint kerak emas (bekor qilinsa fayl qoladi va davom etadi)
+        self.path.unlink(missing_ok=True)
+        self.jobs_done += 1
+        logging.info(f"broadcast: tugadi, yuborildi={job['sent']} bloklagan={job['blocked']} xato={job['failed']}")
+        await self._progress(force=True, final=True)
 
+    def metrics_lines(self):
+        if not self.running:
+            return [f"📢 Tarqatish: faol emas | tugagan ishlar: {self.jobs_done}"]
+        job = self.job
+        return [
+            "📢 Tarqatish:",
+            f"• {self._done(job)}/{job['total']} | yuborildi {job['sent']}, bloklagan {job['blocked']}, "
+            f"xato {job['failed']}",
+        ]
 
-db = DB(BASE_DIR)
 
-# ====== HELPERS ======
-ALPHABET = string.digits
+broadcaster = Broadcaster(BROADCAST_PATH, BROADCAST_RATE, BROADCAST_CONCURRENCY, BROADCAST_BATCH)
 
-def gen_code() -> str:
-    """2-3 xonali faqat raqamlardan iborat unikal kod"""
-    for _ in range(2000):
-        l = random.choice([2, 3])
-        c = "".join(random.choices(ALPHABET, k=l))
-        if not db.get_movie(c):
-            return c
-    # Fallback 3 xonali
-    while True:
-        c = "".join(random.choices(ALPHABET, k=3))
-        if not db.get_movie(c):
-            return c
+# ====== SUBSCRIPTION CHECK ======
+# Obuna keshi: ijobiy va salbiy natijalar uchun alohida TTL (soniya)
+SUB_POSITIVE_TTL = float(os.getenv("SUB_POSITIVE_TTL", "600") or 600)
+SUB_NEGATIVE_TTL = float(os.getenv("SUB_NEGATIVE_TTL", "30") or 30)
+# chat_member yangilanishlaridan olingan holat shuncha vaqt ishonchli hisoblanadi
+SUB_ROSTER_TTL = float(os.getenv("SUB_ROSTER_TTL", "86400") or 86400)
+SUB_CACHE_MAX = int(os.getenv("SUB_CACHE_MAX", "200000") or 200000)
+SUBSCRIBED_STATUSES = {"member", "administrator", "creator"}
 
-SAFE_NAME_RE = re.compile(r"[^a-zA-Z0-9_\- ]+")
 
-def safe_filename(name: str, ext: str) -> str:
-    base = SAFE_NAME_RE.sub("", name).strip() or "kino"
-    return f"{base}.{ext}"
+class SubscriptionCache:
+    """PREVIEW kanal obunasi uchun kesh.
 
-class KB:
-    @staticmethod
-    def admin():
-        return types.ReplyKeyboardMarkup(
-            keyboard=[
-                [types.KeyboardButton(text="🎬 Kanalga kino joylash")],
-                [types.KeyboardButton(text="👥 Foydalanuvchilar")],
-                [types.KeyboardButton(text="👥 Botdagi azolar")],
-                [types.KeyboardButton(text="📣 Kanaldagi azolar")]
-            ], resize_keyboard=True
-        )
+    - ijobiy/salbiy natijalar alohida TTL bilan saqlanadi;
+    - bir foydalanuvchi uchun bir vaqtdagi so'rovlar bitta get_chat_member ga birlashtiriladi;
+    - kanaldagi chat_member yangilanishlari keshni darhol yangilaydi (roster).
+    """
 
-    @staticmethod
-    def super_admin():
-        return types.ReplyKeyboardMarkup(
-            keyboard=[
-                [types.KeyboardButton(text="🎬 Kanalga kino joylash")],
-                [types.KeyboardButton(text="👥 Foydalanuvchilar")],
-                [types.KeyboardButton(text="👥 Botdagi azolar")],
-                [types.KeyboardButton(text="📣 Kanaldagi azolar")],
-                [types.KeyboardButton(text="➕ Yangi admin qo'shish")],
-                [types.KeyboardButton(text="🗑️ Adminni o'chirish")],
-            ], resize_keyboard=True
-        )
+    def __init__(self, positive_ttl: float, negative_ttl: float, roster_ttl: float, max_size: int):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.roster_ttl = roster_ttl
+        self.max_size = max_size
+        self._entries: Dict[int, Tuple[bool, float]] = {}  # uid -> (obuna, amal qilish muddati)
+        self._inflight: Dict[int, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.pushes = 0
+        self.errors = 0
 
+    def get(self, uid: int, recheck: bool = False) -> Optional[bool]:
+        entry = self._entries.get(uid)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires < time.monotonic() or (recheck and not value):
+            return None
+        return value
 
-    @staticmethod
-    def remove():
-        return types.ReplyKeyboardRemove()
+    def put(self, uid: int, value: bool, ttl: Optional[float] = None):
+        if ttl is None:
+            ttl = self.positive_ttl if value else self.negative_ttl
+        if len(self._entries) >= self.max_size and uid not in self._entries:
+            self._prune()
+        self._entries[uid] = (value, time.monotonic() + ttl)
 
-    @staticmethod
-    def user():
-        return types.ReplyKeyboardMarkup(
-            keyboard=[
-                [types.KeyboardButton(text="🎟 Kod yuborish")],
-                [types.KeyboardButton(text="🔍 Random"), types.KeyboardButton(text="⭐ Top")],
-                [types.KeyboardButton(text="💖 Sevimlilar"), types.KeyboardButton(text="📚 Yordam")],
-                [types.KeyboardButton(text="🔔 Obuna tekshirish")]
-            ], resize_keyboard=True
-        )
+    def push(self, uid: int, status: str):
+        """chat_member yangilanishi: holatni uzoqroq muddatga yozib qo'yamiz."""
+        self.pushes += 1
+        self.put(uid, status in SUBSCRIBED_STATUSES, ttl=self.roster_ttl)
 
+    def _prune(self):
+        now = time.monotonic()
+        self._entries = {k: v for k, v in self._entries.items() if v[1] >= now}
+        if len(self._entries) >= self.max_size:
+            # Hali ham to'la — eng eski yarmini tashlaymiz (dict tartibi = qo'shilish tartibi)
+            keep = list(self._entries.items())[len(self._entries) // 2:]
+            self._entries = dict(keep)
 
-def full_caption(name: str, year: str, genre: str, duration: str, code: str,
-                 country: str = "-", imdb: str = "-", quality: str = "-", language: str = "-") -> str:
-    # HTML parse mode: maxsus belgilarni escape qilamiz
-    s_name = html.escape(name or "-")
-    s_year = html.escape(year or "-")
-    s_genre = html.escape(genre or "-")
-    s_country = html.escape(country or "-")
-    s_imdb = html.escape(imdb or "-")
-    s_quality = html.escape(quality or "-")
-    s_language = html.escape(language or "-")
-    channel_url = f"https://t.me/{PREVIEW_CHANNEL_ID.lstrip('@')}"
-    bot_url = f"https://t.me/{Bot_url.lstrip('@')}"
-    return (
-        f"🎬: &quot;{s_name}&quot; [{s_year}]\n"
-        f"➖➖➖➖➖➖➖➖➖➖\n"
-        f"• 🌍Davlati: {s_country} \n"
-        f"• 🌟IMBD: {s_imdb} \n"
-        f"• 🎭Janri: {s_genre}\n"
-        f"• 📸Sifat: {s_quality}\n"
-        f"• 🇺🇿Tili: {s_language}\n\n"
-        f"🔢 Kino kodi: <code>{html.escape(code)}</code>\n\n"
-        f"🔹Kanal: <a href=\"{channel_url}\">©️KinolarOlami</a>\n"
-    )
+    async def check(self, uid: int, fetch, recheck: bool = False) -> bool:
+        cached = self.get(uid, recheck=recheck)
+        if cached is not None:
+            self.hits += 1
+            return cached
+        fut = self._inflight.get(uid)
+        if fut is not None:
+            self.coalesced += 1
+            return await asyncio.shield(fut)
+        self.misses += 1
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[uid] = fut
+        try:
+            value = await fetch(uid)
+            if value is None:
+                self.errors += 1
+            else:
+                self.put(uid, value)
+            fut.set_result(bool(value))
+            return bool(value)
+        except BaseException:
+            fut.set_result(False)
+            raise
+        finally:
+            self._inflight.pop(uid, None)
 
-def preview_channel_caption(code: str) -> str:
-    # Kod orqali bazadan nomni olamiz
-    bot_url = f"https://t.me/{Bot_url.lstrip('@')}"
-    rec = db.get_movie(code) or {}
-    s_name = html.escape(rec.get("name", "Kino"))
-    channel_url = f"https://t.me/{PREVIEW_CHANNEL_ID.lstrip('@')}"
-    s_code = html.escape(code)
-    return (
-        f"🎬: \"{s_name}\" botimizga to'liq holda joylandi❗\n"
-        "➖➖➖➖➖➖➖➖➖➖\n"
-        "• Filmni yuklab olish uchun botga kino kodini yuboring\n\n"
-        f"• 🔢 Kino kodi: <code>{s_code}</code>\n\n"
-        "📥 Kino kodini bu yerga  yuboring: 👇\n"
-        f"🔹Bot: <a href=\"{bot_url}\">CinemadiaUz bot</a>"
-    )
+    def metrics_lines(self):
+        total = self.hits + self.misses + self.coalesced
+        ratio = (self.hits + self.coalesced) / total * 100 if total else 0.0
+        return [
+            "🔔 Obuna keshi:",
+            f"• hit: {self.hits} | miss: {self.misses} | birlashtirilgan: {self.coalesced} ({ratio:.1f}% API siz)",
+            f"• chat_member push: {self.pushes} | xato: {self.errors} | yozuvlar: {len(self._entries)}",
+            f"• TTL: +{int(self.positive_ttl)}s / -{int(self.negative_ttl)}s",
+        ]
 
-# ====== MOVIE INTERACTIVE (likes/ratings) ======
-def _avg_rating(rec: Dict[str, Any]) -> float:
-    stats = (rec or {}).get("stats", {})
-    ratings = stats.get("ratings", {})
-    s, c = ratings.get("sum", 0), ratings.get("count", 0)
-    # Butun songa yaxlitlab ko'rsatamiz
-    return int(round((s / c))) if c else 0
 
-def _user_rating(rec: Dict[str, Any], uid: int) -> int:
-    stats = (rec or {}).get("stats", {})
-    ratings = stats.get("ratings", {})
-    users = ratings.get("users", {})
-    return int(users.get(str(uid), 0))
+sub_cache = SubscriptionCache(SUB_POSITIVE_TTL, SUB_NEGATIVE_TTL, SUB_ROSTER_TTL, SUB_CACHE_MAX)
 
-def build_stats_text(code: str, uid: int) -> str:
-    rec = db.get_movie(code) or {}
-    stats = rec.get("stats", {})
-    views = stats.get("views", 0)
-    avg = _avg_rating(rec)
-    ur = _user_rating(rec, uid)
-    stars = "".join("⭐" for _ in range(int(round(avg)))) or "-"
-    my = f"Sizning baho: {ur}/5" if ur else "Baholanmagan"
-    return (
-        "📊 Statistika\n"
-        f"👁️ Ko'rishlar: {views}\n"
-        f"⭐ O'rtacha: {avg} {stars}\n"
-        f"👤 {my}"
-    )
 
-def build_stats_kb(code: str, uid: int) -> InlineKeyboardMarkup:
-    rec = db.get_movie(code) or {}
-    ur = _user_rating(rec, uid)
-    rate_row = []
-    for n in range(1, 6):
-        text = f"{('✅' if ur==n else '')}⭐{n}"
-        rate_row.append(InlineKeyboardButton(text=text, callback_data=f"rate:{code}:{n}"))
-    share_btn = InlineKeyboardButton(text="Ulashish 🔗", callback_data=f"share:{code}")
-    favs = set(db.get_favorites(uid) or [])
-    fav_on = code in favs
-    fav_btn = InlineKeyboardButton(text=("💖 Sevimli" if fav_on else "🤍 Sevimlilar"), callback_data=f"fav:{code}")
-    # Like va Yangilash tugmalari olib tashlandi
-    rows = [rate_row, [fav_btn, share_btn]]
-    return InlineKeyboardMarkup(inline_keyboard=rows)
+async def _fetch_subscription(user_id: int) -> Optional[bool]:
+    try:
+        member = await bot.get_chat_member(PREVIEW_CHANNEL_ID, user_id)
+        return member.status in SUBSCRIBED_STATUSES
+    except Exception as e:
+        logging.warning(f"get_chat_member failed for {user_id}: {e}")
+        return None
 
-# Yagona caption yaratish: kanaldagi asosiy tafsilotlar + pastdagi statistika
-def build_combined_caption(rec: Dict[str, Any], code: str, uid: int) -> str:
-    name = rec.get("name", "Kino")
-    year = rec.get("year", "-")
-    genre = rec.get("genre", "-")
-    duration = rec.get("duration", "-")
-    country = rec.get("country", "-")
-    imdb = rec.get("imdb", "-")
-    quality = rec.get("quality", "-")
-    language = rec.get("language", "-")
-
-    top = full_caption(
-        name=name, year=year, genre=genre, duration=duration, code=code,
-        country=country, imdb=imdb, quality=quality, language=language
-    ).rstrip()
 
-    # Statistikada endi kod, nom va like ko'rsatilmaydi
-    stats = rec.get("stats", {})
-    views = stats.get("views", 0)
-    avg = _avg_rating(rec)
-    ur = _user_rating(rec, uid)
-    stars = "".join("⭐" for _ in range(int(round(avg)))) or "-"
+async def is_subscribed_to_preview(user_id: int, recheck: bool = False) -> bool:
+    """recheck=True: foydalanuvchi o'zi qayta tekshirishni so'raganda salbiy kesh e'tiborga olinmaydi."""
+    return await sub_cache.check(user_id, _fetch_subscription, recheck=recheck)
 
-    bottom = (
-        f"\n\n📊 Statistika\n"
-        f"👁️ Ko'rishlar: {views}\n"
-        f"⭐ O'rtacha: {avg} {stars}\n"
-        f"👤 Sizning baho: {ur if ur else 0}/5"
-    )
-    return top + bottom
 
-# ====== SUBSCRIPTION CHECK ======
-async def is_subscribed_to_preview(user_id: int) -> bool:
+def _is_preview_chat(chat: types.Chat) -> bool:
+    ref = str(PREVIEW_CHANNEL_ID).strip()
+    if ref.startswith("@"):
+        return (chat.username or "").lower() == ref[1:].lower()
     try:
-        member = await bot.get_chat_member(PREVIEW_CHANNEL_ID, user_id)
-        return member.status in {"member", "administrator", "creator"}
-    except Exception:
+        return chat.id == int(ref)
+    except ValueError:
         return False
 
 def subscribe_kb() -> InlineKeyboardMarkup:
@@ -533,10 +3674,10 @@ class IsSuperAdmin(BaseFilter):
         return db.is_super_admin(m.from_user.id)
 
 class IsCode(BaseFilter):
-    """Foydalanuvchi xabari kino kodi ko'rinishida ekanini tekshiradi (faqat 2-3 xonali raqam)."""
+    """Foydalanuvchi xabari kino kodi ko'rinishida ekanini tekshiradi (2 xonadan code_alloc.max_len gacha raqam)."""
     async def __call__(self, m: types.Message) -> bool:
         t = (m.text or "").strip()
-        return t.isdigit() and 2 <= len(t) <= 3
+        return t.isdigit() and CODE_MIN_LEN <= len(t) <= code_alloc.max_len
 
 # ====== STATES ======
 class Reg(StatesGroup):
@@ -559,6 +3700,13 @@ class AdminManage(StatesGroup):
     add_admin = State()
     del_admin = State()
 
+class BulkMode(StatesGroup):
+    collect = State()
+
+class Broadcast(StatesGroup):
+    message = State()
+    segment = State()
+
 # ====== COMMANDS ======
 @dp.message(Command("start"))
 async def start(m: types.Message, state: FSMContext):
@@ -575,6 +3723,8 @@ async def start(m: types.Message, state: FSMContext):
         await state.update_data(start_code=payload_code)
     u = db.get_user(m.from_user.id)
     if u:
+        # Botni blokdan chiqarib /start bosgan foydalanuvchi yana tarqatishlarga qo'shiladi
+        db.set_blocked(m.from_user.id, False)
         if db.is_super_admin(m.from_user.id):
             await m.answer("Salom Super Admin! Boshqaruv menyusi: ", reply_markup=KB.super_admin())
         elif u.get("is_admin"):
@@ -584,20 +3734,10 @@ async def start(m: types.Message, state: FSMContext):
             data = await state.get_data()
             code = data.get("start_code")
             if code and await is_subscribed_to_preview(m.from_user.id):
-                rec = db.get_movie(code)
-                if rec:
+                if db.get_movie(code):
                     try:
-                        db.inc_view(code)
-                        msg_id = rec.get("full_message_id")
-                        if not msg_id:
-                            raise ValueError("full_message_id missing")
-                        sent = await bot.copy_message(chat_id=m.chat.id, from_chat_id=FULL_CHANNEL_ID, message_id=msg_id)
-                        combined = build_combined_caption(rec, code, m.from_user.id)
-                        try:
-                            await bot.edit_message_caption(chat_id=m.chat.id, message_id=sent.message_id, caption=combined, reply_markup=build_stats_kb(code, m.from_user.id))
-                        except TelegramBadRequest:
-                            await m.answer(build_stats_text(code, m.from_user.id), reply_markup=build_stats_kb(code, m.from_user.id))
-                        await state.update_data(start_code=None)
+                        await delivery.deliver(m.chat.id, code, m.from_user.id)
+                        await state.clear()
                         return
                     except Exception:
                         pass
@@ -647,19 +3787,9 @@ async def reg_name(m: types.Message, state: FSMContext):
     else:
         # Agar deep-link kodi bo'lsa va obuna bo'lsa, avtomatik kino yuboramiz
         if pending_code and await is_subscribed_to_preview(m.from_user.id):
-            rec = db.get_movie(pending_code)
-            if rec:
+            if db.get_movie(pending_code):
                 try:
-                    db.inc_view(pending_code)
-                    msg_id = rec.get("full_message_id")
-                    if not msg_id:
-                        raise ValueError("full_message_id missing")
-                    sent = await bot.copy_message(chat_id=m.chat.id, from_chat_id=FULL_CHANNEL_ID, message_id=msg_id)
-                    combined = build_combined_caption(rec, pending_code, m.from_user.id)
-                    try:
-                        await bot.edit_message_caption(chat_id=m.chat.id, message_id=sent.message_id, caption=combined, reply_markup=build_stats_kb(pending_code, m.from_user.id))
-                    except TelegramBadRequest:
-                        await m.answer(build_stats_text(pending_code, m.from_user.id), reply_markup=build_stats_kb(pending_code, m.from_user.id))
+                    await delivery.deliver(m.chat.id, pending_code, m.from_user.id)
                     return
                 except Exception:
                     pass
@@ -737,6 +3867,66 @@ async def sa_del_admin_apply(m: types.Message, state: FSMContext):
     await state.clear()
     await m.answer(f"✅ {target_uid} adminlikdan olib tashlandi.", reply_markup=KB.super_admin())
 
+# ====== ADMIN: BROADCAST ======
+def _admin_menu(uid: int):
+    return KB.super_admin() if db.is_super_admin(uid) else KB.admin()
+
+@dp.message(IsAdmin(), F.text == "📢 Xabar tarqatish")
+@dp.message(IsAdmin(), Command("broadcast"))
+async def bc_start(m: types.Message, state: FSMContext):
+    if broadcaster.running:
+        await m.answer(broadcaster.progress_text())
+        return
+    await state.set_state(Broadcast.message)
+    await m.answer(
+        "Tarqatiladigan xabarni yuboring (matn, rasm, video — istalgan turdagi).\nBekor qilish: /cancel",
+        reply_markup=KB.remove(),
+    )
+
+@dp.message(Broadcast.message)
+async def bc_message(m: types.Message, state: FSMContext):
+    if (m.text or "").strip() == "/cancel":
+        await state.clear()
+        await m.answer("Bekor qilindi.", reply_markup=_admin_menu(m.from_user.id))
+        return
+    await state.update_data(bc_chat=m.chat.id, bc_msg=m.message_id)
+    await state.set_state(Broadcast.segment)
+    rows = [[InlineKeyboardButton(text=label, callback_data=f"bc:seg:{key}")]
+            for key, label in BROADCAST_SEGMENTS.items()]
+    rows.append([InlineKeyboardButton(text="❌ Bekor qilish", callback_data="bc:cancel")])
+    await m.answer("Kimlarga yuborilsin?", reply_markup=InlineKeyboardMarkup(inline_keyboard=rows))
+
+@dp.callback_query(Broadcast.segment, F.data.startswith("bc:seg:"))
+async def bc_segment(call: types.CallbackQuery, state: FSMContext):
+    segment = call.data.split(":", 2)[2]
+    data = await state.get_data()
+    if not db.is_admin(call.from_user.id) or segment not in BROADCAST_SEGMENTS or "bc_msg" not in data:
+        await call.answer("Noto'g'ri so'rov", show_alert=True)
+        return
+    if broadcaster.running:
+        await call.answer("Boshqa tarqatish hali tugamagan", show_alert=True)
+        return
+    await state.clear()
+    job = broadcaster.start(call.message.chat.id, data["bc_chat"], data["bc_msg"], segment)
+    await call.answer("Boshlandi")
+    await call.message.edit_text(f"📢 Tarqatish boshlandi: {job['total']} ta foydalanuvchi.")
+    await call.message.answer("Menyu", reply_markup=_admin_menu(call.from_user.id))
+
+@dp.callback_query(F.data == "bc:cancel")
+async def bc_cancel(call: types.CallbackQuery, state: FSMContext):
+    await state.clear()
+    await call.answer()
+    await call.message.edit_text("Bekor qilindi.")
+    await call.message.answer("Menyu", reply_markup=_admin_menu(call.from_user.id))
+
+@dp.callback_query(F.data == "bc:stop")
+async def bc_stop(call: types.CallbackQuery):
+    if not db.is_admin(call.from_user.id):
+        await call.answer()
+        return
+    broadcaster.stop()
+    await call.answer("To'xtatilmoqda...")
+
 # ====== ADMIN UPLOAD ======
 @dp.message(IsAdmin(), F.text == "🎬 Kanalga kino joylash")
 async def admin_hint(m: types.Message, state: FSMContext):
@@ -746,22 +3936,93 @@ async def admin_hint(m: types.Message, state: FSMContext):
         await m.answer("Avval preview (rasm yoki qisqa video) yuboring.")
         return
     await state.set_state(Up.file)
-    await m.answer("Iltimos video yoki video-hujjat yuboring.", reply_markup=KB.remove())
+    await m.answer("Iltimos video yoki video-hujjat yuboring.\n"
+                   "Bir nechta kino: albom qilib yuboring yoki /bulk buyrug'idan foydalaning.",
+                   reply_markup=KB.remove())
+
+USERS_PAGE_SIZE = int(os.getenv("USERS_PAGE_SIZE", "20") or 20)
+# callback_data 64 bayt bilan cheklangan: qidiruv so'rovi shunchalik qisqartiriladi
+USERS_QUERY_MAX_BYTES = 32
+
+def _users_query(text: str) -> str:
+    q = " ".join((text or "").split())
+    return q.encode("utf-8")[:USERS_QUERY_MAX_BYTES].decode("utf-8", "ignore")
+
+def _user_line(uid: int) -> str:
+    info = db.users.get(uid) or {}
+    flag = "(admin)" if info.get("is_admin") else ""
+    return f"• {html.escape(str(info.get('name', '?')))} {flag} — {info.get('phone', '?')} — id:{uid}"
+
+def render_users_page(query: str = "", anchor: Optional[int] = None, forward: bool = True):
+    """Foydalanuvchilar sahifasi: (matn, inline klaviatura).
+
+    query — ism prefiksi, yoki raqam bo'lsa id/telefon bo'yicha aniq qidiruv. anchor — oldingi sahifaning
+    chetidagi uid (forward=True: undan keyingilar, False: undan oldingilar).
+    """
+    d = db.directory
+    digits = query.lstrip("+").replace(" ", "")
+    if query and digits.isdigit():
+        found = []
+        if int(digits) in db.users:
+            found.append(int(digits))
+        by_phone = d.phones.get(int(digits))
+        if by_phone is not None and by_phone not in found:
+            found.append(by_phone)
+        lines = [f"🔎 «{html.escape(query)}»: {len(found)} ta topildi"] + [_user_line(uid) for uid in found]
+        return "\n".join(lines), None
+    lo, hi = d.prefix_range(query)
+    start = lo
+    if anchor is not None and anchor in db.users:
+        pos = d.position(anchor, db.users[anchor])
+        start = pos + 1 if forward else pos - USERS_PAGE_SIZE
+    start = max(lo, min(start, hi - 1))
+    stop = min(start + USERS_PAGE_SIZE, hi)
+    uids = d.page(start, stop)
+    if query:
+        head = f"🔎 «{html.escape(query)}»: {hi - lo} ta topildi"
+    else:
+        head = f"👥 Jami foydalanuvchilar: {len(db.users)}"
+    lines = [head]
+    if uids:
+        lines.append(f"({start - lo + 1}–{stop - lo} / {hi - lo})")
+    lines += [_user_line(uid) for uid in uids]
+    if not query:
+        lines.append("\nQidirish: /users <ism | telefon | id>")
+    nav = []
+    if uids and start > lo:
+        nav.append(InlineKeyboardButton(text="⬅️ Oldingi", callback_data=f"ud:p:{uids[0]}:{query}"))
+    if uids and stop < hi:
+        nav.append(InlineKeyboardButton(text="Keyingi ➡️", callback_data=f"ud:n:{uids[-1]}:{query}"))
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=[nav]) if nav else None
 
 @dp.message(IsAdmin(), F.text == "👥 Foydalanuvchilar")
 async def admin_users(m: types.Message):
-    users = db.users
-    total = len(users)
-    # Bir nechta namuna ko'rsatamiz (eng ko'pi 20 ta)
-    lines = [f"👥 Jami foydalanuvchilar: {total}"]
-    cnt = 0
-    for uid, info in users.items():
-        cnt += 1
-        flag = "(admin)" if info.get("is_admin") else ""
-        lines.append(f"• {info.get('name','?')} {flag} — {info.get('phone','?')} — id:{uid}")
-        if cnt >= 20:
-            break
-    await m.answer("\n".join(lines), reply_markup=KB.admin())
+    text, kb = render_users_page()
+    await m.answer(text, reply_markup=kb)
+
+@dp.message(IsAdmin(), Command("users"))
+async def admin_users_search(m: types.Message):
+    parts = (m.text or "").split(maxsplit=1)
+    text, kb = render_users_page(_users_query(parts[1] if len(parts) > 1 else ""))
+    await m.answer(text, reply_markup=kb)
+
+@dp.callback_query(F.data.startswith("ud:"))
+async def cb_users_page(call: types.CallbackQuery):
+    if not db.is_admin(call.from_user.id):
+        await call.answer()
+        return
+    try:
+        _, direction, anchor, query = call.data.split(":", 3)
+        anchor = int(anchor)
+    except ValueError:
+        await call.answer()
+        return
+    text, kb = render_users_page(query, anchor, forward=direction == "n")
+    await call.answer()
+    try:
+        await call.message.edit_text(text, reply_markup=kb)
+    except TelegramBadRequest:
+        pass
 
 @dp.message(IsAdmin(), F.text == "👥 Botdagi azolar")
 async def admin_bot_members(m: types.Message):
@@ -801,6 +4062,51 @@ async def admin_channel_members(m: types.Message):
         lines.append("ℹ️ Botni kanallarga admin qiling va to'g'ri ID/username kiriting.")
     await m.answer("\n".join(lines), reply_markup=KB.admin())
 
+def collect_metrics():
+    """Admin /stats uchun barcha komponentlar ko'rsatkichlari."""
+    return (sub_cache.metrics_lines() + outbound.metrics_lines() + delivery.metrics_lines()
+            + health.metrics_lines() + broadcaster.metrics_lines() + inline_cache.metrics_lines()
+            + republisher.metrics_lines() + upload_queue.metrics_lines() + bulk_ingest.metrics_lines())
+
+@dp.message(IsAdmin(), Command("stats"))
+async def admin_stats(m: types.Message):
+    await m.answer("\n".join(collect_metrics()))
+
+# ====== ADMIN: BULK INGEST ======
+# Albom yoki /bulk rejimi — ommaviy qo'shish (bitta-bitta Up oqimidan oldin tekshiriladi).
+# Yakka forward Up oqimiga tushadi: ommaviy rejim faqat albom yoki aniq buyruq bilan yoqiladi.
+@dp.message(IsAdmin(), StateFilter(None, Up.file), Command("bulk"))
+async def bulk_start(m: types.Message, state: FSMContext):
+    await state.set_state(BulkMode.collect)
+    await state.update_data(bulk_batch=f"bulk{m.chat.id}-{int(time.time() * 1000)}")
+    await m.answer("📦 Ommaviy qo'shish rejimi. Kinolarni (captioni bilan) yuboring yoki forward qiling — "
+                   "har biri alohida kod oladi va kanalga joylanadi.\nTugatish: /done", reply_markup=KB.remove())
+
+@dp.message(IsAdmin(), BulkMode.collect, Command("done"))
+async def bulk_done(m: types.Message, state: FSMContext):
+    data = await state.get_data()
+    await state.clear()
+    n = bulk_ingest.close(data.get("bulk_batch", ""))
+    await m.answer(f"✅ Ommaviy qo'shish tugadi: {n} ta fayl navbatga qo'yildi.",
+                   reply_markup=_admin_menu(m.from_user.id))
+
+@dp.message(IsAdmin(), BulkMode.collect, F.video | F.document)
+async def bulk_collect(m: types.Message, state: FSMContext):
+    data = await state.get_data()
+    if bulk_ingest.add(m, data["bulk_batch"]) is None:
+        await m.reply("Bu video emas — o'tkazib yuborildi.")
+
+@dp.message(IsAdmin(), BulkMode.collect)
+async def bulk_other(m: types.Message):
+    await m.answer("Video yoki video-hujjat yuboring. Tugatish: /done")
+
+@dp.message(IsAdmin(), StateFilter(None, Up.file), F.video | F.document, F.media_group_id)
+async def admin_album(m: types.Message, state: FSMContext):
+    await state.clear()
+    if bulk_ingest.add(m, f"mg{m.media_group_id}") is None:
+        await m.reply("Bu video emas — o'tkazib yuborildi.")
+
+
 @dp.message(IsAdmin(), F.video)
 async def admin_video(m: types.Message, state: FSMContext):
     # Agar hozir preview bosqichida bo'lsa, bu handler ishlamasin
@@ -877,81 +4183,40 @@ async def up_language(m: types.Message, state: FSMContext):
 @dp.message(Up.duration)
 async def up_duration(m: types.Message, state: FSMContext):
     await state.update_data(duration=(m.text or "").strip())
-    # Kodni bot o'zi tanlaydi (2-3 xonali raqam, unikal)
+    # Kodni bot o'zi tanlaydi (bo'sh kodlar hovuzidan, unikal)
     code = gen_code()
     await state.update_data(code=code)
 
-    # Faylni yuklab olish va FULL_CHANNEL_ID ga yuborish
+    # Kanalga joylash fon navbatida: handler darhol qaytadi, admin keyingi kinoni ham yuborishi mumkin
     data = await state.get_data()
-    name = data["name"]
-    file_id = data["file_id"]
-    file_type = data.get("file_type", "video")
-    downloaded = False
-    ext = "mp4"
-    local_path = None
-    try:
-        tg_file = await bot.get_file(file_id)
-        if file_type == "document":
-            fn = data.get("filename") or "file.bin"
-            low = fn.lower()
-            if low.endswith((".mkv", ".avi", ".mov", ".mp4")):
-                ext = low.split(".")[-1]
-        local_name = safe_filename(name, ext)
-        local_path = KINOLAR_DIR / local_name
-        await bot.download(tg_file, destination=local_path)
-        downloaded = True
-    except TelegramBadRequest as e:
-        logging.warning(f"Faylni yuklab olish imkoni yo'q (TelegramBadRequest): {e}. file_id orqali yuborishga o'tamiz.")
-    except Exception as e:
-        logging.warning(f"Faylni yuklab olishda xato: {e}. file_id orqali yuborishga o'tamiz.")
-
-    cap_full = full_caption(
-        name=name,
-        year=data.get('year','-'),
-        genre=data.get('genre','-'),
-        duration=data.get('duration','-'),
-        code=code,
-        country=data.get('country','-'),
-        imdb=data.get('imdb','-'),
-        quality=data.get('quality','-'),
-        language=data.get('language','-'),
-    )
+    upload_queue.submit(m.chat.id, code, data)
+    await m.answer(f"⏳ «{html.escape(data['name'])}» joylash navbatiga qo'shildi (kod: {code}).\n"
+                   "Asosiy kanal (preview) uchun rasm yoki qisqa video yuboring:")
+    await state.set_state(Up.preview)
 
-    sent_full: types.Message
-    if file_type == "document":
-        if downloaded and local_path is not None:
-            sent_full = await bot.send_document(FULL_CHANNEL_ID, FSInputFile(local_path), caption=cap_full)
-        else:
-            sent_full = await bot.send_document(FULL_CHANNEL_ID, file_id, caption=cap_full)
+@dp.callback_query(F.data.startswith("upq:"))
+async def cb_upload_job(call: types.CallbackQuery):
+    if not db.is_admin(call.from_user.id):
+        await call.answer()
+        return
+    _, action, job_id = call.data.split(":", 2)
+    if action == "retry":
+        job = upload_queue.retry(job_id)
+        if job is None:
+            await call.answer("Ish topilmadi yoki allaqachon hal qilingan", show_alert=True)
+            return
+        await call.answer("Navbatga qaytarildi")
+        text = f"🔁 «{html.escape(str(job['meta'].get('name', '?')))}» (kod {job['code']}) qayta navbatga qo'yildi."
     else:
-        if downloaded and local_path is not None:
-            sent_full = await bot.send_video(FULL_CHANNEL_ID, FSInputFile(local_path), caption=cap_full)
-        else:
-            sent_full = await bot.send_video(FULL_CHANNEL_ID, file_id, caption=cap_full)
-
-    # Lokal faylni faqat yuklangan bo'lsa o'chiramiz
-    if downloaded and local_path is not None:
-        try:
-            local_path.unlink(missing_ok=True)
-        except Exception as e:
-            logging.warning(f"Fayl o'chirishda xatolik: {e}")
-
-    # Bazaga to'liq ma'lumotlarni saqlaymiz (statistika maydonlari DB.add_movie ichida setdefault qilinadi)
-    db.add_movie(code, {
-        "name": name,
-        "year": data.get("year","-"),
-        "genre": data.get("genre","-"),
-        "country": data.get("country","-"),
-        "imdb": data.get("imdb","-"),
-        "quality": data.get("quality","-"),
-        "language": data.get("language","-"),
-        "duration": data.get("duration","-"),
-        "full_message_id": sent_full.message_id,
-        "preview_message_id": None
-    })
-
-    await m.answer("Asosiy kanal (preview) uchun rasm yoki qisqa video yuboring:")
-    await state.set_state(Up.preview)
+        await call.answer()
+        text = await upload_queue.drop(job_id)
+    # Bekor qilish muvaffaqiyatsiz bo'lsa (preview o'chmadi), tugmalar qoladi
+    job = upload_queue._get(job_id)
+    kb = upload_queue.failed_kb(job) if job and job["state"] == "failed" else None
+    try:
+        await call.message.edit_text(text, reply_markup=kb)
+    except TelegramBadRequest:
+        pass
 
 @dp.message(Up.preview, F.photo)
 async def up_preview_photo(m: types.Message, state: FSMContext):
@@ -966,10 +4231,8 @@ async def up_preview_photo(m: types.Message, state: FSMContext):
         logging.error(f"Preview photo yuborishda xato: {e}")
         await m.answer("Preview kanalga yuborishda xato. Botni preview kanalga admin qilganingizni va fayl formatini tekshirib qayta urinib ko'ring.")
         return
-    rec = db.get_movie(code) or {}
-    rec["preview_message_id"] = sent.message_id
-    db.add_movie(code, rec)
-    await m.answer("Preview kanalga joylandi!", reply_markup=KB.admin())
+    warn = await attach_preview(code, sent.message_id)
+    await m.answer(warn or "Preview kanalga joylandi!", reply_markup=KB.admin())
     await state.clear()
 
 # Up.preview holatida noto'g'ri kontent turlari uchun javob (fallback) - eng oxirida turishi kerak
@@ -990,10 +4253,8 @@ async def up_preview_video_note(m: types.Message, state: FSMContext):
     except Exception:
         # Agar video_note yuborish mumkin bo'lmasa, oddiy video sifatida urinib ko'ramiz
         sent = await bot.send_video(PREVIEW_CHANNEL_ID, m.video_note.file_id, caption=cap_prev)
-    rec = db.get_movie(code) or {}
-    rec["preview_message_id"] = sent.message_id
-    db.add_movie(code, rec)
-    await m.answer("Preview kanalga joylandi!", reply_markup=KB.admin())
+    warn = await attach_preview(code, sent.message_id)
+    await m.answer(warn or "Preview kanalga joylandi!", reply_markup=KB.admin())
     await state.clear()
 
 @dp.message(Up.preview, F.animation)
@@ -1003,10 +4264,8 @@ async def up_preview_gif(m: types.Message, state: FSMContext):
     name = data["name"]
     cap_prev = preview_channel_caption(code)
     sent = await bot.send_animation(PREVIEW_CHANNEL_ID, m.animation.file_id, caption=cap_prev)
-    rec = db.get_movie(code) or {}
-    rec["preview_message_id"] = sent.message_id
-    db.add_movie(code, rec)
-    await m.answer("Preview kanalga joylandi!", reply_markup=KB.admin())
+    warn = await attach_preview(code, sent.message_id)
+    await m.answer(warn or "Preview kanalga joylandi!", reply_markup=KB.admin())
     await state.clear()
 
 # Document sifatida yuborilgan preview (rasm/video) ni ham qabul qilamiz
@@ -1032,10 +4291,8 @@ async def up_preview_document(m: types.Message, state: FSMContext):
         await m.answer("Preview yuborishda xatolik. Keyinroq urinib ko'ring yoki boshqa format yuboring.")
         return
 
-    rec = db.get_movie(code) or {}
-    rec["preview_message_id"] = sent.message_id
-    db.add_movie(code, rec)
-    await m.answer("Preview kanalga joylandi!", reply_markup=KB.admin())
+    warn = await attach_preview(code, sent.message_id)
+    await m.answer(warn or "Preview kanalga joylandi!", reply_markup=KB.admin())
     await state.clear()
 
 @dp.message(Up.preview, F.video)
@@ -1051,10 +4308,8 @@ async def up_preview_video(m: types.Message, state: FSMContext):
         logging.error(f"Preview video yuborishda xato: {e}")
         await m.answer("Preview kanalga yuborishda xato. Botni preview kanalga admin qilganingizni va fayl formatini tekshirib qayta urinib ko'ring.")
         return
-    rec = db.get_movie(code) or {}
-    rec["preview_message_id"] = sent.message_id
-    db.add_movie(code, rec)
-    await m.answer("Preview kanalga joylandi!", reply_markup=KB.admin())
+    warn = await attach_preview(code, sent.message_id)
+    await m.answer(warn or "Preview kanalga joylandi!", reply_markup=KB.admin())
     await state.clear()
 
 # ====== USER: GET BY CODE ======
@@ -1066,31 +4321,24 @@ async def user_by_code(m: types.Message):
         return
     if u.get("is_admin"):
         return  # admin uchun kod handler ishlatmaymiz
+    await send_movie_by_code(m, m.from_user.id, (m.text or "").strip().upper())
+
+async def send_movie_by_code(m: types.Message, user_id: int, code: str):
+    """Kod bo'yicha kinoni m.chat ga yuborish (kod xabari va qidiruv natijasi tugmasi uchun umumiy)."""
     # Obuna tekshiruvi
-    if not await is_subscribed_to_preview(m.from_user.id):
+    if not await is_subscribed_to_preview(user_id):
         await m.answer("Botdan foydalanish uchun kanalga obuna bo'ling:", reply_markup=subscribe_kb())
         return
-    code = (m.text or "").strip().upper()
     rec = db.get_movie(code)
     if not rec:
         await m.answer("Bunday kod topilmadi!")
         return
+    if not (rec.get("file_id") or rec.get("full_message_id")):
+        await m.answer("Afsus, ushbu kino fayli hozircha mavjud emas.")
+        return
     try:
-        # Ko'rishlar sonini oshiramiz
-        db.inc_view(code)
-        msg_id = rec.get("full_message_id")
-        if not msg_id:
-            await m.answer("Afsus, ushbu kino fayli hozircha mavjud emas.")
-            return
-        # Avval kanal xabarini foydalanuvchiga ko'chiramiz
-        sent = await bot.copy_message(chat_id=m.chat.id, from_chat_id=FULL_CHANNEL_ID, message_id=msg_id, protect_content=True)
-        # So'ng captionni bitta birlashtirilgan ko'rinishga o'zgartiramiz
-        combined = build_combined_caption(rec, code, m.from_user.id)
-        try:
-            await bot.edit_message_caption(chat_id=m.chat.id, message_id=sent.message_id, caption=combined, reply_markup=build_stats_kb(code, m.from_user.id))
-        except TelegramBadRequest:
-            # Agar captionni tahrirlab bo'lmasa, alohida statistika xabarini yuboramiz (fallback)
-            await m.answer(build_stats_text(code, m.from_user.id), reply_markup=build_stats_kb(code, m.from_user.id))
+        # Manbani deliver tanlaydi: saqlangan file_id, bo'lmasa FULL kanal xabari (caption va tugmalar bilan)
+        await delivery.deliver(m.chat.id, code, user_id, protect_content=True)
     except Exception as e:
         logging.error(f"copy_message error: {e}")
         await m.answer("Hozircha yuborib bo'lmadi. Keyinroq urinib ko'ring.")
@@ -1099,27 +4347,19 @@ async def user_by_code(m: types.Message):
 @dp.callback_query(F.data == "check_sub")
 async def cb_check_sub(call: types.CallbackQuery):
     user_id = call.from_user.id
-    if await is_subscribed_to_preview(user_id):
+    if await is_subscribed_to_preview(user_id, recheck=True):
         # Agar start_code bo'lsa, avtomatik kinoni yuborishga urinamiz
         key = StorageKey(bot_id=call.bot.id, chat_id=call.message.chat.id, user_id=user_id)
         data = await dp.storage.get_data(key)
         start_code = (data or {}).get("start_code")
         if start_code:
-            rec = db.get_movie(start_code)
-            if rec:
+            if db.get_movie(start_code):
                 try:
-                    db.inc_view(start_code)
-                    msg_id = rec.get("full_message_id")
-                    if not msg_id:
-                        raise ValueError("full_message_id missing")
-                    sent = await bot.copy_message(chat_id=call.message.chat.id, from_chat_id=FULL_CHANNEL_ID, message_id=msg_id)
-                    combined = build_combined_caption(rec, start_code, user_id)
-                    try:
-                        await bot.edit_message_caption(chat_id=call.message.chat.id, message_id=sent.message_id, caption=combined, reply_markup=build_stats_kb(start_code, user_id))
-                    except TelegramBadRequest:
-                        await call.message.answer(build_stats_text(start_code, user_id), reply_markup=build_stats_kb(start_code, user_id))
-                    # start_code ni tozalaymiz
-                    await dp.storage.update_data(key, {"start_code": None})
+                    await delivery.deliver(call.message.chat.id, start_code, user_id)
+                    # start_code ni o'chiramiz (None qoldirmaymiz — bo'sh holat storage dan o'chadi)
+                    data = dict(data or {})
+                    data.pop("start_code", None)
+                    await dp.storage.set_data(key, data)
                     await call.answer()
                     return
                 except Exception:
@@ -1129,6 +4369,14 @@ async def cb_check_sub(call: types.CallbackQuery):
         await call.message.answer("Hali obuna bo'lmadingiz. Iltimos, kanalga obuna bo'ling.", reply_markup=subscribe_kb())
     await call.answer()
 
+# ====== CHANNEL: chat_member yangilanishlari (obuna keshi uchun) ======
+@dp.chat_member()
+async def on_preview_chat_member(event: types.ChatMemberUpdated):
+    if not _is_preview_chat(event.chat):
+        return
+    member = event.new_chat_member
+    sub_cache.push(member.user.id, member.status)
+
 # ====== CALLBACK: LIKE / RATE / REFRESH ======
 @dp.callback_query(F.data.startswith("like:"))
 async def cb_like(call: types.CallbackQuery):
@@ -1268,7 +4516,7 @@ async def msg_help(m: types.Message):
 
 @dp.message(F.text == "🔔 Obuna tekshirish")
 async def msg_sub_check(m: types.Message):
-    if await is_subscribed_to_preview(m.from_user.id):
+    if await is_subscribed_to_preview(m.from_user.id, recheck=True):
         await m.answer("✅ Obuna bor")
     else:
         await m.answer("Kanalga obuna bo'ling:", reply_markup=subscribe_kb())
@@ -1309,28 +4557,18 @@ async def msg_random(m: types.Message):
     if not db.movies:
         await m.answer("Hozircha bazada kinolar yo'q.")
         return
-    # Faqat nusxa olish mumkin bo'lgan (full yoki preview) va 'broken' bo'lmagan kinolardan tanlaymiz
-    candidates = [
-        code for code, rec in db.movies.items()
-        if (rec.get("full_message_id") or rec.get("preview_message_id")) and not rec.get("broken")
-    ]
-    if not candidates:
+    # Tanlov DB indeksidan: faqat yetkaziladigan (broken/dead emas) kodlar, tekshirilganlar ustuvor
+    if not len(db.random_index):
         await m.answer("Hozircha random uchun tayyor kino yo'q.")
         return
-    # Foydalanuvchi tarixidan foydalanib takrorlanmasin
-    seen_list = db.get_random_history(m.from_user.id)
-    seen = set(seen_list)
-    base_pool = [c for c in candidates if c not in seen] or candidates
-    # Hozirgina chiqqan filmni qayta bermaslikka harakat qilamiz
-    if len(base_pool) > 1 and seen_list and seen_list[-1] in base_pool:
-        base_pool = [c for c in base_pool if c != seen_list[-1]]
-
-    import random as _r
-    pool = base_pool[:]
-    _r.shuffle(pool)
-
-    # Bir bosishda bir nechta variantni sinab ko'ramiz
-    for code in pool:
+    if SCRATCH_CHAT_ID:
+        health.prefetch([db.random_index.sample() for _ in range(HEALTH_PREFETCH)])
+
+    # Bir bosishda bir nechta variantni sinab ko'ramiz (muvaffaqiyatsizi broken bo'lib indeksdan chiqadi)
+    for _ in range(RANDOM_MAX_TRIES):
+        code = db.sample_random(m.from_user.id)
+        if code is None:
+            break
         rec = db.get_movie(code)
         if not rec:
             continue
@@ -1347,65 +4585,321 @@ async def msg_random(m: types.Message):
             attempts.append((FULL_CHANNEL_ID, prev_id, "X-PREVIEW@FULL"))
         if full_id and FULL_CHANNEL_ID != PREVIEW_CHANNEL_ID:
             attempts.append((PREVIEW_CHANNEL_ID, full_id, "X-FULL@PREVIEW"))
+        # file_id saqlangan bo'lsa kanalga murojaat shart emas (ishlamasa deliver o'zi FULL nusxaga o'tadi)
+        if rec.get("file_id"):
+            attempts = [(None, None, "FILE_ID")]
 
         success = False
+        gone = True  # barcha manbalar "xabar topilmadi" dedimi
         for chan, mid, label in attempts:
             try:
-                db.inc_view(code)
                 logging.info(f"random: trying {label} copy code={code} msg_id={mid} chan={chan}")
-                await bot.copy_message(chat_id=m.chat.id, from_chat_id=chan, message_id=mid, protect_content=True)
-                await m.answer(build_stats_text(code, m.from_user.id), reply_markup=build_stats_kb(code, m.from_user.id))
+                await delivery.deliver(m.chat.id, code, m.from_user.id, from_chat_id=chan, message_id=mid,
+                                       protect_content=True)
                 db.push_random_history(m.from_user.id, code)
                 success = True
                 break
             except Exception as e:
                 logging.error(f"random copy_message attempt failed ({label}): {e}")
+                if not (isinstance(e, TelegramBadRequest)
+                        and any(x in str(e).lower() for x in MovieDelivery.SOURCE_GONE)):
+                    gone = False
                 continue
 
         if success:
             return
-        # Hamma urinishlar ham muvaffaqiyatsiz bo'lsa — broken deb belgilaymiz
-        logging.warning(f"random: marking code={code} as broken (all attempts failed)")
-        db.mark_broken(code)
+        if gone:
+            # Manba xabarlari haqiqatan o'chgan — broken deb belgilaymiz
+            logging.warning(f"random: marking code={code} as broken (all sources gone)")
+            db.mark_broken(code)
+        else:
+            # Tarmoq/limit/timeout — kino buzuq emas, health tekshiruviga qoldiramiz
+            logging.warning(f"random: code={code} yuborilmadi (vaqtinchalik xato), health tekshiruviga berildi")
+            if SCRATCH_CHAT_ID:
+                health.prefetch([code])
         continue
 
     # Agar hammasi muvaffaqiyatsiz bo'lsa, xabar beramiz
     await m.answer("Hozircha random yuborib bo'lmadi. Keyinroq urinib ko'ring.")
 
-@dp.message(F.text == "⭐ Top")
-async def msg_top(m: types.Message):
-    if not db.movies:
-        await m.answer("Kino topilmadi.")
-        return
+# Tayyor Top matni: db.top.version o'zgarmaguncha qayta qurilmaydi
+_top_cache: Dict[str, Any] = {"version": None, "text": ""}
+
+def render_top() -> str:
+    if _top_cache["version"] == db.top.version:
+        return _top_cache["text"]
     bot_username = (Bot_url or "").lstrip("@")
-    items = []
-    for code, rec in db.movies.items():
+    lines = ["Top kinolar:"]
+    for i, code in enumerate(db.top.top(), start=1):
+        rec = db.get_movie(code) or {}
         stats = rec.get("stats", {})
         likes = stats.get("likes", {}).get("count", 0)
         views = stats.get("views", 0)
-        # avg rating
-        avg = _avg_rating(rec)
+        votes = stats.get("ratings", {}).get("count", 0)
         name = rec.get("name", code)
-        url = f"https://t.me/{bot_username}?start={code}" if bot_username else None
-        items.append((avg, likes, views, name, code, url))
-    # Saralash: avg desc, likes desc, views desc
-    items.sort(key=lambda x: (x[0], x[1], x[2]), reverse=True)
-    if not items:
-        await m.answer("Kino topilmadi.")
-        return
-    lines = ["Top kinolar:"]
-    for i, (_avg, _likes, _views, name, code, url) in enumerate(items[:10], start=1):
-        if url:
+        if bot_username:
+            url = f"https://t.me/{bot_username}?start={code}"
             title = f"<a href='{html.escape(url)}'>🎬 {html.escape(name)}</a>"
         else:
             title = f"🎬 {html.escape(name)}"
-        lines.append(f"{i}. {title} — ⭐ {_avg} | ❤️ {_likes} | 👁️ {_views}")
-    await m.answer("\n".join(lines), disable_web_page_preview=True)
+        lines.append(f"{i}. {title} — ⭐ {_avg_rating(rec)} ({votes}) | ❤️ {likes} | 👁️ {views}")
+    _top_cache.update(version=db.top.version, text="\n".join(lines))
+    return _top_cache["text"]
+
+@dp.message(F.text == "⭐ Top")
+async def msg_top(m: types.Message):
+    # Saralash DB.top da (Bayes o'rtachasi, keyin like va ko'rishlar) — har bosishda katalog aylanilmaydi
+    if not len(db.top):
+        await m.answer("Kino topilmadi.")
+        return
+    await m.answer(render_top(), disable_web_page_preview=True)
+
+# ====== USER: NOM BO'YICHA QIDIRUV ======
+# Kod ham, menyu tugmasi ham bo'lmagan matn — kino nomi deb qidiriladi (shuning uchun eng oxirgi handler)
+SEARCH_LIMIT = int(os.getenv("SEARCH_LIMIT", "8") or 8)
+SEARCH_QUERY_MAX = 64
+
+@dp.message(StateFilter(None), F.text, ~F.text.startswith("/"))
+async def msg_search(m: types.Message):
+    if not db.get_user(m.from_user.id):
+        await m.answer("Avval /start orqali ro'yxatdan o'ting.")
+        return
+    query = m.text.strip()[:SEARCH_QUERY_MAX]
+    codes = db.titles.search(query, limit=SEARCH_LIMIT)
+    if not codes:
+        await m.answer("Hech narsa topilmadi. Kino kodini yoki boshqacha nomini yuboring.")
+        return
+    rows = []
+    for code in codes:
+        rec = db.get_movie(code) or {}
+        year = rec.get("year")
+        label = f"{code} · {rec.get('name', '?')}" + (f" ({year})" if year and year != "-" else "")
+        rows.append([InlineKeyboardButton(text=label[:64], callback_data=f"pick:{code}")])
+    await m.answer(f"🔎 «{html.escape(query)}» bo'yicha topilgan kinolar:",
+                   reply_markup=InlineKeyboardMarkup(inline_keyboard=rows))
+
+@dp.callback_query(F.data.startswith("pick:"))
+async def cb_pick(call: types.CallbackQuery):
+    code = call.data.split(":", 1)[1]
+    await call.answer()
+    if not db.get_user(call.from_user.id):
+        await call.message.answer("Avval /start orqali ro'yxatdan o'ting.")
+        return
+    await send_movie_by_code(call.message, call.from_user.id, code)
+
+# ====== INLINE MODE ======
+# @bot <nom yoki kod> — istalgan chatda kinoni yuborish (BotFather da /setinline yoqilgan bo'lishi kerak)
+INLINE_PAGE_SIZE = min(int(os.getenv("INLINE_PAGE_SIZE", "20") or 20), 50)  # Telegram: ko'pi bilan 50
+INLINE_MAX_RESULTS = int(os.getenv("INLINE_MAX_RESULTS", "100") or 100)
+# Telegram tomonidagi kesh (s); natijalar is_personal, chunki obuna har foydalanuvchi uchun tekshiriladi
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "300") or 300)
+INLINE_CACHE_SIZE = int(os.getenv("INLINE_CACHE_SIZE", "2000") or 2000)
+INLINE_CACHE_TTL = float(os.getenv("INLINE_CACHE_TTL", "120") or 120)
+
+
+class InlineResultCache:
+    """Normalizatsiya qilingan so'rov -> {"codes": tartiblangan kodlar, "pages": {offset: sahifa}}, LRU + TTL.
+
+    Bir xil so'rovlar to'lqini (mashhur prefikslar) bitta qidiruv va har sahifa uchun bitta qurish bilan
+    xizmat qilinadi. Nomlar indeksi o'zgarsa (db.titles.version) yozuv eskiradi; file_id/caption
+    o'zgarishlari TTL o'tgach ko'rinadi.
+    """
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self._items: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def entry(self, query: str) -> Dict[str, Any]:
+        item = self._items.get(query)
+        now = time.monotonic()
+        if item is not None and item[0] == db.titles.version and now - item[1] < self.ttl:
+            self._items.move_to_end(query)
+            self.hits += 1
+            return item[2]
+        self.misses += 1
+        entry = {"codes": inline_codes(query), "pages": {}}
+        self._items[query] = (db.titles.version, now, entry)
+        self._items.move_to_end(query)
+        if len(self._items) > self.size:
+            self._items.popitem(last=False)
+        return entry
+
+    def metrics_lines(self):
+        return [f"🔎 Inline kesh: {len(self._items)} so'rov | hit {self.hits} / miss {self.misses}"]
+
+
+inline_cache = InlineResultCache(INLINE_CACHE_SIZE, INLINE_CACHE_TTL)
+
+
+def inline_codes(query: str) -> list:
+    """So'rov bo'yicha kodlar: bo'sh — top reyting, kod bo'lsa u birinchi, keyin nom bo'yicha qidiruv."""
+    if not query:
+        codes = db.top.ranked(INLINE_MAX_RESULTS)
+    else:
+        codes = db.titles.search(query, limit=INLINE_MAX_RESULTS)
+        if query in db.movies:
+            codes = [query] + [c for c in codes if c != query]
+    return [c for c in codes if c in db.random_index]
+
+
+def inline_result(code: str, rec: Dict[str, Any]):
+    """Bitta kino: file_id bo'lsa cached video/hujjat, aks holda cb_share dagi kabi deep-link maqola."""
+    name = rec.get("name", "Kino")
+    year = rec.get("year")
+    title = f"{name} ({year})" if year and year != "-" else name
+    description = f"Kod: {code} • {rec.get('genre', '-')}"
+    bot_username = (Bot_url or "").lstrip("@")
+    url = f"https://t.me/{bot_username}?start={code}"
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🎬 Botda ochish", url=url)]
+    ]) if bot_username else None
+    file_id = rec.get("file_id")
+    if file_id:
+        caption = captions.get(code, rec)
+        if rec.get("media_type") == "document":
+            return types.InlineQueryResultCachedDocument(
+                id=code, title=title, document_file_id=file_id, description=description,
+                caption=caption, parse_mode=ParseMode.HTML, reply_markup=kb)
+        return types.InlineQueryResultCachedVideo(
+            id=code, video_file_id=file_id, title=title, description=description,
+            caption=caption, parse_mode=ParseMode.HTML, reply_markup=kb)
+    if not bot_username:
+        return None
+    text = f"<a href='{html.escape(url)}'>🎬 {html.escape(name)} — kod {html.escape(code)}</a>"
+    return types.InlineQueryResultArticle(
+        id=code, title=title, description=description, reply_markup=kb,
+        input_message_content=types.InputTextMessageContent(message_text=text, parse_mode=ParseMode.HTML,
+                                                            link_preview_options=types.LinkPreviewOptions(is_disabled=True)))
+
+
+def inline_page(query: str, offset: int) -> Tuple[list, str]:
+    """(natijalar, next_offset) — keshdan yoki bir marta quriladi."""
+    entry = inline_cache.entry(query)
+    page = entry["pages"].get(offset)
+    if page is None:
+        codes = entry["codes"]
+        results = []
+        for code in codes[offset:offset + INLINE_PAGE_SIZE]:
+            rec = db.get_movie(code)
+            res = inline_result(code, rec) if rec else None
+            if res is not None:
+                results.append(res)
+        end = offset + INLINE_PAGE_SIZE
+        page = entry["pages"][offset] = (results, str(end) if end < len(codes) else "")
+    return page
+
+
+@dp.inline_query()
+async def inline_search(q: types.InlineQuery):
+    if not await is_subscribed_to_preview(q.from_user.id):
+        await q.answer([], is_personal=True, cache_time=10, button=types.InlineQueryResultsButton(
+            text="📣 Avval kanalga obuna bo'ling", start_parameter="subscribe"))
+        return
+    try:
+        offset = max(int(q.offset or 0), 0)
+    except ValueError:
+        offset = 0
+    results, next_offset = inline_page(normalize_title(q.query[:SEARCH_QUERY_MAX]), offset)
+    await q.answer(results, is_personal=True, cache_time=INLINE_CACHE_TIME, next_offset=next_offset)
 
 # ====== RUN ======
+# Ishga tushirish rejimi: polling (standart) yoki webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "").rstrip("/")  # masalan: https://kino.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Bo'sh bo'lsa har ishga tushishda tasodifiy secret yaratiladi (set_webhook bilan birga yuboriladi)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "") or secrets.token_urlsafe(32)
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080") or 8080)
+# Bir vaqtda qayta ishlanadigan update lar soni (ikkala rejimda ham)
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "32") or 32)
+
+
+class ConcurrencyLimitMiddleware(BaseMiddleware):
+    """Bir vaqtda ishlayotgan handlerlar sonini cheklaydi."""
+
+    def __init__(self, limit: int):
+        self.limit = max(limit, 1)
+        self._sem: Optional[asyncio.Semaphore] = None
+
+    async def __call__(self, handler, event, data):
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.limit)
+        async with self._sem:
+            return await handler(event, data)
+
+
+dp.update.outer_middleware(ConcurrencyLimitMiddleware(UPDATE_WORKERS))
+
+
+@dp.startup()
+async def on_startup():
+    await db.storage.start()
+    if isinstance(dp.storage, SqliteFSMStorage):
+        dp.storage.start_sweeper()
+    if SCRATCH_CHAT_ID:
+        spawn(_channel_maintenance())
+    broadcaster.resume()
+    upload_queue.start()
+    spawn(_random_history_flusher())
+
+@dp.shutdown()
+async def on_shutdown():
+    # SIGTERM/SIGINT da aiogram pollingni to'xtatadi va shutdown ni chaqiradi — kutilayotgan yozuvlarni saqlaymiz
+    db.flush_random_history()
+    db.storage.flush()
+
 async def main():
     logging.basicConfig(level=logging.INFO)
-    await dp.start_polling(bot)
+    try:
+        # Oldin webhook o'rnatilgan bo'lsa getUpdates ishlamaydi
+        await bot.delete_webhook(drop_pending_updates=False)
+        # chat_member yangilanishlari faqat allowed_updates da aniq so'ralsa keladi
+        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    finally:
+        db.storage.close()
+        await dp.storage.close()
+
+async def on_webhook_startup(bot: Bot):
+    if not WEBHOOK_BASE_URL:
+        raise RuntimeError("BOT_MODE=webhook uchun .env da WEBHOOK_BASE_URL ni kiriting.")
+    await bot.set_webhook(
+        f"{WEBHOOK_BASE_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+        max_connections=min(max(UPDATE_WORKERS, 1), 100),
+    )
+
+def build_webhook_app() -> web.Application:
+    app = web.Application()
+    # handle_in_background: Telegram ga darhol 200 qaytariladi, update fon vazifada qayta ishlanadi
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET,
+                         handle_in_background=True).register(app, path=WEBHOOK_PATH)
+    dp.startup.register(on_webhook_startup)
+    setup_application(app, dp, bot=bot)
+    app.on_cleanup.append(_close_storage)
+    return app
+
+async def _close_storage(_app: web.Application):
+    db.storage.close()
+    await dp.storage.close()
+
+def run_webhook():
+    logging.basicConfig(level=logging.INFO)
+    # aiohttp SIGTERM/SIGINT da to'xtaydi va dp.shutdown ni chaqiradi
+    web.run_app(build_webhook_app(), host=WEBAPP_HOST, port=WEBAPP_PORT)
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # Bir martalik ko'chirish: python kino_bot2.py migrate-sqlite [kino.db]
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate-sqlite":
+        logging.basicConfig(level=logging.INFO)
+        target = Path(sys.argv[2]) if len(sys.argv) > 2 else SQLITE_PATH
+        n_users, n_movies = migrate_json_to_sqlite(BASE_DIR, target)
+        print(f"Ko'chirildi: {n_users} foydalanuvchi, {n_movies} kino -> {target}")
+    elif BOT_MODE == "webhook":
+        run_webhook()
+    else:
+        asyncio.run(main())